@@ -1,21 +1,26 @@
 import re
 import os
-from flask import Flask, session, render_template, request, jsonify, send_file
+from flask import Flask, session, render_template, request, jsonify, send_file, Response, stream_with_context
 from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import ClosingIterator
 import threading
 import time
-from walmart import HEADERS, get_browse, get_link, extract_options, start_crawl, switch_workspace, add_trademark_id, upload_excel_trademark_ids, delete_trademark_id
+from walmart import HEADERS, get_browse, get_link, extract_options, start_crawl, switch_workspace, add_trademark_id, upload_excel_trademark_ids, delete_trademark_id, backfill_price_fields, is_price_backfilled
 from multix import get_automation_token_fast, start_quick_profile, initialize_multilogin_service
-from import_excel import save_uploaded_file, process_uploaded_excel, get_uploaded_files
+from import_excel import save_uploaded_file, process_uploaded_excel, get_uploaded_files, invalidate_template_metadata
 import requests
 import uuid
-from bson import json_util
+from bson import json_util, ObjectId
+from bson.errors import InvalidId
 from config import *
 import json
 from rapidfuzz import fuzz
 from datetime import datetime
-from config import collection_log
+from config import get_database, get_log_collection, get_mongo_pool_stats, INTERNAL_COLLECTIONS
 from selenium.webdriver.common.by import By
+from cache import TTLCache, on_collection_write, notify_collection_write
+from fill_jobs import submit_fill_job, get_fill_job, wait_for_fill_job_change, list_fill_jobs, FINISHED_STATES
+import image_export_jobs
 
 # Smart login system initialization
 def initialize_smart_login():
@@ -56,32 +61,17 @@ def initialize_smart_login():
         print("App sẽ fallback về chế độ đăng nhập thường")
         return False
 
-def scheduled_file_delete(file_path, delay_seconds=2):
-    """Xóa file sau một khoảng thời gian delay (background task)"""
-    def delete_after_delay():
-        try:
-            time.sleep(delay_seconds)
-            max_retries = 10
-            for attempt in range(max_retries):
-                try:
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        print(f"Đã xóa file: {file_path} (attempt {attempt + 1})")
-                    else:
-                        print(f"File đã không tồn tại: {file_path}")
-                    break
-                except PermissionError:
-                    if attempt == max_retries - 1:
-                        print(f"Không thể xóa file sau {max_retries} lần thử: {file_path}")
-                    else:
-                        time.sleep(0.5)  # Đợi lâu hơn cho background task
-        except Exception as e:
-            print(f"Lỗi trong scheduled delete: {e}")
-    
-    # Chạy trong background thread
-    thread = threading.Thread(target=delete_after_delay, daemon=True)
-    thread.start()
-    return thread
+def delete_file_quietly(file_path):
+    """Xóa file (dùng làm callback sau khi response download đóng file), chỉ log nếu lỗi"""
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            invalidate_template_metadata(file_path)
+            print(f"Đã xóa file: {file_path}")
+        else:
+            print(f"File đã không tồn tại: {file_path}")
+    except Exception as e:
+        print(f"Không thể xóa file {file_path}: {e}")
 
 def count_similar_phrases(phrase, phrase_list, threshold=0.7):
     count = 0
@@ -187,7 +177,7 @@ def is_stop_requested(state):
 def crawl_option1(department, collection, proxy, state, start, end):
     print("crawl_option1 started!")
     # Log crawl start
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "start_time": datetime.now(),
@@ -260,7 +250,7 @@ def crawl_option1(department, collection, proxy, state, start, end):
             pass  # Ignore if reset fails
         
         # Log crawl end
-        collection_log.insert_one({
+        get_log_collection().insert_one({
             "department": department,
             "collection": collection.name,
             "end_time": datetime.now(),
@@ -271,7 +261,7 @@ def crawl_option1(department, collection, proxy, state, start, end):
 def crawl_option2(department, collection, proxy, state, start, end):
     print("crawl_option2 started!")
     # Log crawl start
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "start_time": datetime.now(),
@@ -310,7 +300,7 @@ def crawl_option2(department, collection, proxy, state, start, end):
         pass  # Ignore if reset fails
     
     # Log crawl end
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "end_time": datetime.now(),
@@ -320,7 +310,7 @@ def crawl_option2(department, collection, proxy, state, start, end):
 
 def crawl_option3(department, collection, proxy, state, start, end):
     # Log crawl start
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "start_time": datetime.now(),
@@ -366,7 +356,7 @@ def crawl_option3(department, collection, proxy, state, start, end):
         pass  # Ignore if reset fails
     
     # Log crawl end
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "end_time": datetime.now(),
@@ -376,7 +366,7 @@ def crawl_option3(department, collection, proxy, state, start, end):
 
 def crawl_option4(department, collection, proxy, state, start, end):
     # Log crawl start
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "start_time": datetime.now(),
@@ -416,7 +406,7 @@ def crawl_option4(department, collection, proxy, state, start, end):
         pass  # Ignore if reset fails
     
     # Log crawl end
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "end_time": datetime.now(),
@@ -426,7 +416,7 @@ def crawl_option4(department, collection, proxy, state, start, end):
 
 def crawl_option5(department, collection, proxy, state):
     # Log crawl start
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "start_time": datetime.now(),
@@ -459,7 +449,7 @@ def crawl_option5(department, collection, proxy, state):
         pass  # Ignore if reset fails
     
     # Log crawl end
-    collection_log.insert_one({
+    get_log_collection().insert_one({
         "department": department,
         "collection": collection.name,
         "end_time": datetime.now(),
@@ -513,7 +503,7 @@ def crawl():
     if not department or not option:
         return jsonify({"error": "Missing 'department' or 'option'"}), 400
 
-    collection = db[collection_name]
+    collection = get_database()[collection_name]
     crawl_data = []
     # Khởi tạo session crawl
     crawl_sessions[session_id] = {
@@ -773,7 +763,7 @@ entities_cache = []
 def load_trademark_data():
     global trademark_ids_cache, slug_trie_cache, entities_cache
     try:
-        db_test = client["test"]
+        db_test = get_database("test")
 
         trademark_doc = db_test["trademark_ids"].find_one({"trademarks": {"$exists": True}})
         trademark_ids_cache = set(trademark_doc.get("trademarks", [])) if trademark_doc else set()
@@ -801,6 +791,12 @@ try:
 except Exception as e:
     print(f"Warning: Failed to load trademark data at startup: {e}")
 
+def is_trademark_link(link):
+    """Slug trong link /ip/<slug>/<id> gần giống slug trademark nào đó"""
+    match = re.search(r"/ip/(.*?)/\d+", link or '')
+    slug_part = match.group(1) if match else ""
+    return count_similar_phrases(slug_part, slug_trie_cache) > 0
+
 def is_entity_matched(product_name, brand_name=None):
     if not product_name or not entities_cache:
         return False
@@ -816,19 +812,318 @@ def is_entity_matched(product_name, brand_name=None):
     return product_match or brand_match
 
 
+# Chỉ lấy các field mà /api/products thực sự render, bỏ payload ld+json còn lại
+PRODUCT_LIST_PROJECTION = {
+    'name': 1,
+    'sku': 1,
+    'link': 1,
+    'reseller': 1,
+    'gtin13': 1,
+    'image': 1,
+    'note': 1,
+    'brand_name': 1,
+    'options': 1,
+    'offers': {'$slice': 1},
+    'hasVariant': {'$slice': 1},
+    'image_derivatives': 1,
+}
+
+def product_thumbnail(product, image):
+    """Thumbnail S3 của ảnh đang hiển thị (chỉ khi derivative được tạo từ đúng ảnh đó), None nếu chưa có"""
+    derivatives = product.get('image_derivatives') or {}
+    if image and derivatives.get('source') == image:
+        return derivatives.get('thumb')
+    return None
+
+# Phân trang /api/products
+PRODUCTS_PAGE_SIZE = 20
+PRODUCTS_MAX_PAGE_SIZE = 200
+PRODUCTS_COUNT_TTL = 60  # giây, sau đó count được refresh nền
+
+products_count_cache = {}
+products_count_refreshing = set()
+products_count_lock = threading.Lock()
+
+def _count_products(collection, filter_query):
+    # Không có filter -> dùng metadata của collection, không cần scan
+    if not filter_query:
+        return collection.estimated_document_count()
+    return collection.count_documents(filter_query)
+
+def _refresh_products_count(key, collection, filter_query):
+    try:
+        total = _count_products(collection, filter_query)
+        with products_count_lock:
+            products_count_cache[key] = (total, time.time())
+    except Exception as e:
+        print(f"Lỗi khi refresh count cho {key[0]}: {e}")
+    finally:
+        with products_count_lock:
+            products_count_refreshing.discard(key)
+
+def get_products_count(collection, filter_query):
+    """
+    Đếm số sản phẩm khớp filter, cache theo (collection, filter).
+    Khi cache hết hạn thì trả về giá trị cũ và refresh ở background thread.
+    """
+    key = (collection.name, json_util.dumps(filter_query, sort_keys=True))
+    now = time.time()
+    with products_count_lock:
+        cached = products_count_cache.get(key)
+        if cached:
+            total, computed_at = cached
+            if now - computed_at >= PRODUCTS_COUNT_TTL and key not in products_count_refreshing:
+                products_count_refreshing.add(key)
+                threading.Thread(
+                    target=_refresh_products_count,
+                    args=(key, collection, filter_query),
+                    daemon=True
+                ).start()
+            return total
+
+    # Lần đầu gặp filter này -> đếm đồng bộ
+    total = _count_products(collection, filter_query)
+    with products_count_lock:
+        products_count_cache[key] = (total, now)
+    return total
+
+# Cache response /api/products theo (collection, query đã chuẩn hóa)
+products_cache = TTLCache(maxsize=API_CACHE_MAX_ENTRIES, ttl=API_CACHE_TTL)
+
+@on_collection_write
+def _invalidate_products_cache(collection_name, document=None):
+    products_cache.invalidate(collection_name)
+
+# Collection đã backfill giá xong (cache của marker trong MongoDB) / đang backfill
+price_ready_collections = set()
+price_backfill_running = set()
+price_ready_lock = threading.Lock()
+
+def _run_price_backfill(collection):
+    try:
+        backfill_price_fields(collection)
+        with price_ready_lock:
+            price_ready_collections.add(collection.name)
+    except Exception as e:
+        print(f"Lỗi backfill giá cho collection '{collection.name}': {e}")
+    finally:
+        with price_ready_lock:
+            price_backfill_running.discard(collection.name)
+
+def start_price_backfill(collection):
+    """Chạy backfill giá ở background (bỏ qua nếu đang chạy), trả về False nếu đang chạy"""
+    with price_ready_lock:
+        if collection.name in price_backfill_running:
+            return False
+        price_backfill_running.add(collection.name)
+    threading.Thread(target=_run_price_backfill, args=(collection,), daemon=True).start()
+    return True
+
+def ensure_price_ready(collection):
+    """
+    True nếu filter giá dùng được price_primary (collection đã backfill xong).
+    Chưa xong thì chạy backfill price_primary/price_min (kèm tạo index) ở background
+    cho các document crawl trước đây và trả về False.
+    """
+    with price_ready_lock:
+        if collection.name in price_ready_collections:
+            return True
+    if is_price_backfilled(collection):
+        with price_ready_lock:
+            price_ready_collections.add(collection.name)
+        return True
+    start_price_backfill(collection)
+    return False
+
+@app.route('/api/collections/<name>/backfill-prices', methods=['POST'])
+def backfill_prices(name):
+    """Backfill field giá số + index cho collection (chạy background)"""
+    if name not in get_database().list_collection_names():
+        return jsonify({"success": False, "message": "Collection không tồn tại"}), 404
+    start_price_backfill(get_database()[name])
+    return jsonify({"success": True, "message": f"Đã bắt đầu backfill giá cho collection: {name}"})
+
+# Thống kê collection (/api/collections/<name>/stats)
+STATS_CACHE_TTL = 300  # giây, sau đó refresh nền
+STATS_TOP_BRANDS = 50
+PRICE_BUCKET_BOUNDARIES = [0, 10, 25, 50, 100, 250, 500, 1000, 10 ** 9]
+
+collection_stats_cache = {}
+collection_stats_refreshing = set()
+collection_stats_lock = threading.Lock()
+
+def _price_bucket_label(price):
+    if price is None:
+        return 'unknown'
+    for low, high in zip(PRICE_BUCKET_BOUNDARIES, PRICE_BUCKET_BOUNDARIES[1:]):
+        if low <= price < high:
+            return f"{low}-{high}" if high != PRICE_BUCKET_BOUNDARIES[-1] else f"{low}+"
+    return 'unknown'
+
+def _facet_to_dict(rows):
+    return {str(row['_id']): row['count'] for row in rows}
+
+def _compute_collection_stats(collection):
+    """Tính thống kê bằng một aggregation $facet + một lượt quét link cho trademark"""
+    has_variants = {"$gt": [{"$size": {"$cond": [{"$isArray": "$hasVariant"}, "$hasVariant", []]}}, 0]}
+    has_reseller = {"$gt": [{"$size": {"$cond": [{"$isArray": "$reseller"}, "$reseller", []]}}, 0]}
+    pipeline = [{
+        "$facet": {
+            "total": [{"$count": "count"}],
+            "by_product_type": [{"$group": {"_id": "$product_type", "count": {"$sum": 1}}}],
+            "by_brand": [{"$group": {"_id": "$brand_name", "count": {"$sum": 1}}}],
+            "by_kind": [{"$group": {"_id": {"$cond": [has_variants, "variant", "single"]}, "count": {"$sum": 1}}}],
+            "by_reseller": [{"$group": {"_id": {"$cond": [has_reseller, "with_reseller", "without_reseller"]}, "count": {"$sum": 1}}}],
+            "by_price": [{
+                "$bucket": {
+                    "groupBy": "$price_primary",
+                    "boundaries": PRICE_BUCKET_BOUNDARIES,
+                    "default": "unknown",
+                    "output": {"count": {"$sum": 1}}
+                }
+            }]
+        }
+    }]
+    facets = next(collection.aggregate(pipeline, allowDiskUse=True))
+
+    by_price = {}
+    for row in facets['by_price']:
+        label = 'unknown' if row['_id'] == 'unknown' else _price_bucket_label(row['_id'])
+        by_price[label] = by_price.get(label, 0) + row['count']
+
+    # Trademark dựa trên fuzzy match slug nên không làm được trong Mongo -> chỉ lấy field link
+    by_trademark = {'trademark': 0, 'clear': 0}
+    for product in collection.find({}, {'link': 1, '_id': 0}):
+        by_trademark['trademark' if is_trademark_link(product.get('link', '')) else 'clear'] += 1
+
+    return {
+        'total': facets['total'][0]['count'] if facets['total'] else 0,
+        'by_product_type': _facet_to_dict(facets['by_product_type']),
+        'by_brand': _facet_to_dict(facets['by_brand']),
+        'by_kind': _facet_to_dict(facets['by_kind']),
+        'by_reseller': _facet_to_dict(facets['by_reseller']),
+        'by_price': by_price,
+        'by_trademark': by_trademark
+    }
+
+def _apply_product_to_stats(stats, product):
+    """Cộng một sản phẩm mới insert vào thống kê đã cache (không cần chạy lại aggregation)"""
+    def incr(facet, key):
+        stats[facet][key] = stats[facet].get(key, 0) + 1
+
+    variants = product.get('hasVariant')
+    resellers = product.get('reseller')
+    stats['total'] += 1
+    incr('by_product_type', str(product.get('product_type')))
+    incr('by_brand', str(product.get('brand_name')))
+    incr('by_kind', 'variant' if isinstance(variants, list) and variants else 'single')
+    incr('by_reseller', 'with_reseller' if isinstance(resellers, list) and resellers else 'without_reseller')
+    incr('by_price', _price_bucket_label(product.get('price_primary')))
+    incr('by_trademark', 'trademark' if is_trademark_link(product.get('link', '')) else 'clear')
+
+def _refresh_collection_stats(collection):
+    try:
+        stats = _compute_collection_stats(collection)
+        with collection_stats_lock:
+            collection_stats_cache[collection.name] = {'stats': stats, 'computed_at': time.time(), 'stale': False}
+    except Exception as e:
+        print(f"Lỗi khi tính thống kê collection '{collection.name}': {e}")
+    finally:
+        with collection_stats_lock:
+            collection_stats_refreshing.discard(collection.name)
+
+@on_collection_write
+def _update_collection_stats(collection_name, document=None):
+    with collection_stats_lock:
+        entry = collection_stats_cache.get(collection_name)
+        if not entry:
+            return
+        if document is None:
+            # Không biết document nào thay đổi (hoặc document cũ bị ghi đè) -> tính lại ở lần request kế tiếp
+            entry['stale'] = True
+            return
+        try:
+            _apply_product_to_stats(entry['stats'], document)
+        except Exception as e:
+            print(f"Lỗi khi cập nhật thống kê collection '{collection_name}': {e}")
+            entry['stale'] = True
+
+@app.route('/api/collections/<name>/stats', methods=['GET'])
+def get_collection_stats(name):
+    """Thống kê collection: theo product_type, brand, variant/single, reseller, khoảng giá, trademark"""
+    with collection_stats_lock:
+        entry = collection_stats_cache.get(name)
+        if entry:
+            expired = time.time() - entry['computed_at'] >= STATS_CACHE_TTL
+            if (expired or entry['stale']) and name not in collection_stats_refreshing:
+                collection_stats_refreshing.add(name)
+                threading.Thread(target=_refresh_collection_stats, args=(get_database()[name],), daemon=True).start()
+            stats = json.loads(json.dumps(entry['stats']))
+            computed_at = entry['computed_at']
+
+    if not entry:
+        if name not in get_database().list_collection_names():
+            return jsonify({"success": False, "message": "Collection không tồn tại"}), 404
+        try:
+            stats = _compute_collection_stats(get_database()[name])
+        except Exception as e:
+            print(f"Lỗi khi tính thống kê collection '{name}': {e}")
+            return jsonify({"success": False, "message": str(e)}), 500
+        computed_at = time.time()
+        with collection_stats_lock:
+            collection_stats_cache[name] = {'stats': stats, 'computed_at': computed_at, 'stale': False}
+        stats = json.loads(json.dumps(stats))
+
+    brands = sorted(stats['by_brand'].items(), key=lambda item: item[1], reverse=True)
+    stats['brand_count'] = len(brands)
+    stats['by_brand'] = dict(brands[:STATS_TOP_BRANDS])
+
+    return jsonify({
+        "success": True,
+        "collection": name,
+        "stats": stats,
+        "computed_at": datetime.fromtimestamp(computed_at).strftime("%Y-%m-%d %H:%M:%S")
+    })
+
 @app.route('/api/products', methods=['GET'])
 def get_all_products():
-    page = int(request.args.get('page', 1))
-    limit = 20
+    page = request.args.get('page', 1, type=int) or 1
+    limit = request.args.get('limit', PRODUCTS_PAGE_SIZE, type=int) or PRODUCTS_PAGE_SIZE
+    limit = max(1, min(limit, PRODUCTS_MAX_PAGE_SIZE))
     skip = (page - 1) * limit
 
+    # Keyset pagination: ?after=<_id cuối của trang trước>, không cần skip
+    after = request.args.get('after')
+    after_id = None
+    if after:
+        try:
+            after_id = ObjectId(after)
+        except (InvalidId, TypeError):
+            return jsonify({"error": "Invalid 'after' cursor"}), 400
+
     collection_name = request.args.get('collection', 'products')
-    if collection_name not in db.list_collection_names():
-        return jsonify({"error": "Collection not found"})
-    print("COLLECTION:", collection_name)
-    collection = db[collection_name]
     product_type = request.args.get('type', None)
     reseller_only = request.args.get('resellerOnly', 'false').lower() == 'true'
+    min_price = request.args.get('min_price', type=float)
+    max_price = request.args.get('max_price', type=float)
+
+    cache_key = (
+        page if after_id is None else None,
+        limit,
+        after,
+        product_type if product_type in ('variant', 'single') else None,
+        min_price,
+        max_price,
+        reseller_only
+    )
+    cached = products_cache.get(collection_name, cache_key)
+    if cached is not None:
+        return jsonify(dict(cached, page=page))
+
+    if collection_name not in get_database().list_collection_names():
+        return jsonify({"error": "Collection not found"})
+    print("COLLECTION:", collection_name)
+    collection = get_database()[collection_name]
 
     # Lọc theo loại sản phẩm
     if product_type == 'variant':
@@ -839,22 +1134,25 @@ def get_all_products():
         product_type_filter = None
 
     # Lọc theo giá
-    min_price = request.args.get('min_price', type=float)
-    max_price = request.args.get('max_price', type=float)
-
     price_filter = {}
     if min_price is not None:
         price_filter["$gte"] = min_price
     if max_price is not None:
         price_filter["$lte"] = max_price
 
+    # Kết quả chỉ được cache khi không phải filter giá fallback (backfill chưa xong)
+    cacheable = True
     if price_filter:
-        price_condition = {
-            "$or": [
-                {"hasVariant.0.offers.0.price": price_filter},
-                {"offers.0.price": price_filter}
-            ]
-        }
+        if ensure_price_ready(collection):
+            price_condition = {"price_primary": price_filter}
+        else:
+            cacheable = False
+            price_condition = {
+                "$or": [
+                    {"hasVariant.0.offers.0.price": price_filter},
+                    {"offers.0.price": price_filter}
+                ]
+            }
     else:
         price_condition = None
 
@@ -875,7 +1173,11 @@ def get_all_products():
 
     print("FILTER:", filter_query)
 
-    products_cursor = collection.find(filter_query).sort('_id', -1).skip(skip).limit(limit)
+    if after_id is not None:
+        page_query = {"$and": conditions + [{"_id": {"$lt": after_id}}]}
+        products_cursor = collection.find(page_query, PRODUCT_LIST_PROJECTION).sort('_id', -1).limit(limit)
+    else:
+        products_cursor = collection.find(filter_query, PRODUCT_LIST_PROJECTION).sort('_id', -1).skip(skip).limit(limit)
     products = list(products_cursor)
 
     results = []
@@ -884,11 +1186,7 @@ def get_all_products():
         product['_id'] = str(product['_id'])
         if 'hasVariant' in product and isinstance(product['hasVariant'], list) and product['hasVariant']:
             variant = product['hasVariant'][0]
-            link_check = product.get('link', '')
-            match = re.search(r"/ip/(.*?)/\d+", link_check)
-            slug_part = match.group(1) if match else ""
-
-            is_violated = count_similar_phrases(slug_part, slug_trie_cache) > 0
+            is_violated = is_trademark_link(product.get('link', ''))
             is_entity_violated = is_entity_matched(
                 variant.get('name', product.get('name', 'N/A')), 
                 product.get('brand_name', 'N/A')
@@ -903,6 +1201,7 @@ def get_all_products():
                 'color': variant.get('color', 'N/A'),
                 'size': variant.get('size', 'N/A'),
                 'image': variant.get('image', ''),
+                'thumbnail': product_thumbnail(product, variant.get('image')),
                 'price': variant.get('offers', [{}])[0].get('price', 'N/A'),
                 "note": product.get('note', ''),
                 "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
@@ -913,11 +1212,7 @@ def get_all_products():
             })
         else:
             # existing_product = collection.find_one({"name": product.get("name")})
-            link_check = product.get('link', '')
-            match = re.search(r"/ip/(.*?)/\d+", link_check)
-            slug_part = match.group(1) if match else ""
-
-            is_violated = count_similar_phrases(slug_part, slug_trie_cache) > 0
+            is_violated = is_trademark_link(product.get('link', ''))
             is_entity_violated = is_entity_matched(
                 product.get('name', 'N/A'), 
                 product.get('brand_name', 'N/A')
@@ -931,6 +1226,7 @@ def get_all_products():
                 'size': product['options'][1] if len(product['options']) > 1 else 'N/A',
                 'gtin13': str(product.get('gtin13', 'N/A')),
                 'image': product.get('image', ''),
+                'thumbnail': product_thumbnail(product, product.get('image')),
                 'price': product.get('offers', [{}])[0].get('price', 'N/A'),
                 "note": product.get('note', ''),
                 "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
@@ -940,24 +1236,43 @@ def get_all_products():
                 'timestamp': timestamp.strftime("%Y-%m-%d %H:%M:%S")
             })
 
-    total_products = collection.count_documents(filter_query)
+    if cacheable:
+        total_products = get_products_count(collection, filter_query)
+    else:
+        total_products = _count_products(collection, filter_query)
     total_pages = (total_products + limit - 1) // limit
 
-    return jsonify({
+    # Cursor cho trang kế tiếp (None nếu đã hết dữ liệu)
+    next_after = products[-1]['_id'] if len(products) == limit else None
+
+    response_data = {
         'products': results,
         'page': page,
+        'limit': limit,
+        'next_after': next_after,
         'total_pages': total_pages,
         'total_products': total_products,
+    }
+    if cacheable:
+        products_cache.set(collection_name, cache_key, response_data)
+
+    return jsonify(response_data)
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Thống kê cache (hit/miss...) để theo dõi hiệu năng"""
+    return jsonify({
+        'products_cache': products_cache.stats(),
+        'mongo_pool': get_mongo_pool_stats()
     })
 
 
 @app.route('/collections')
 def get_collections():
     # Lấy danh sách collections (loại trừ system collections và internal collections)
-    excluded_collections = {'batch_ids', 'generated_skus', 'logs'}
     collections = []
-    for collection_name in db.list_collection_names():
-        if not collection_name.startswith('system.') and collection_name not in excluded_collections:
+    for collection_name in get_database().list_collection_names():
+        if not collection_name.startswith('system.') and collection_name not in INTERNAL_COLLECTIONS:
             collections.append(collection_name)
     return jsonify({"collections": collections})
 
@@ -969,13 +1284,13 @@ def add_collection():
     if not name:
         return jsonify({"success": False, "message": "Thiếu tên collection"})
 
-    if name in db.list_collection_names():
+    if name in get_database().list_collection_names():
         return jsonify({"success": True, "message": "Đã tồn tại"})
 
-    db.create_collection(name)
+    get_database().create_collection(name)
     return jsonify({"success": True, "message": "Tạo thành công"})
 
-current_collection = db['default']  # Mặc định, hoặc chọn từ danh sách
+current_collection = get_database()['default']  # Mặc định, hoặc chọn từ danh sách
 
 @app.route('/set-collection', methods=['POST'])
 def set_collection():
@@ -983,10 +1298,10 @@ def set_collection():
     data = request.json
     name = data.get('name')
 
-    if name not in db.list_collection_names():
+    if name not in get_database().list_collection_names():
         return jsonify({'error': 'Collection không tồn tại'}), 400
 
-    current_collection = db[name]
+    current_collection = get_database()[name]
     return jsonify({'message': f'Đã chuyển sang collection: {name}'}), 200
 
 
@@ -1002,7 +1317,7 @@ def save_note():
             return jsonify({"success": False, "message": "Thiếu thông tin bắt buộc."}), 400
 
         # Kết nối tới collection tương ứng
-        collection = db[collection_name]
+        collection = get_database()[collection_name]
 
         # Cập nhật ghi chú dựa trên `link`
         result = collection.update_one(
@@ -1014,6 +1329,8 @@ def save_note():
         if result.matched_count == 0 and not result.upserted_id:
             return jsonify({"success": False, "message": "Không tìm thấy sản phẩm với link được cung cấp."}), 404
 
+        notify_collection_write(collection_name)
+
         return jsonify({"success": True, "message": "Ghi chú đã được lưu thành công."})
 
     except Exception as e:
@@ -1168,20 +1485,6 @@ def download_and_delete_excel(filename):
         file_size = os.path.getsize(file_path)
         print(f"File size: {file_size} bytes")
         
-        # Đọc file vào memory trước khi xóa
-        print(f"Reading file into memory...")
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
-        print(f"File read successfully: {len(file_data)} bytes")
-        
-        # Schedule xóa file sau khi download (tránh file locking trên Windows)
-        scheduled_file_delete(file_path, delay_seconds=1)
-        print(f"Đã schedule xóa file: {filename} sau 1 giây")
-        
-        # Tạo response từ memory
-        from io import BytesIO
-        file_like = BytesIO(file_data)
-        
         # Xác định mimetype dựa trên extension
         if filename.lower().endswith('.xlsx'):
             mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -1189,18 +1492,31 @@ def download_and_delete_excel(filename):
             mimetype = 'application/vnd.ms-excel'
         elif filename.lower().endswith('.csv'):
             mimetype = 'text/csv'
+        elif filename.lower().endswith('.zip'):
+            mimetype = 'application/zip'
         else:
             mimetype = 'application/octet-stream'
         
         print(f"Sending file with mimetype: {mimetype}")
         
+        # Stream trực tiếp từ file (wsgi.file_wrapper / sendfile), không đọc cả file vào memory
         response = send_file(
-            file_like,
+            file_path,
             as_attachment=True,
             download_name=filename,
-            mimetype=mimetype
+            mimetype=mimetype,
+            conditional=False,
+            max_age=0
         )
         
+        # send_file đã mở file và response dùng direct passthrough (Response.call_on_close không được gọi)
+        if os.name == 'nt':
+            # Windows không xóa được file đang mở: xóa khi server đóng body response (gửi xong / client ngắt)
+            response.response = ClosingIterator(response.response, lambda: delete_file_quietly(file_path))
+        else:
+            # POSIX: unlink ngay, file descriptor đang mở vẫn đọc được tới khi gửi xong (giữ được sendfile)
+            delete_file_quietly(file_path)
+        
         print(f"Download response created successfully")
         return response
         
@@ -1211,42 +1527,50 @@ def download_and_delete_excel(filename):
         traceback.print_exc()
         return jsonify({'success': False, 'error': f'Lỗi server: {str(e)}'}), 500
 
+def _parse_fill_params(data):
+    """Đọc tham số fill từ request JSON (dùng chung cho fill đồng bộ và fill job)"""
+    return {
+        'filename': data.get('filename'),
+        'collection': data.get('collection'),
+        'column': data.get('column', 'E'),
+        'sku_column': data.get('sku_column', 'A'),
+        'batch_column': data.get('batch_column', 'CU'),
+        'image_column': data.get('image_column', 'T'),
+        'fill_images_from_s3': data.get('fill_images_from_s3', False),  # Changed from fill_images_from_drive
+        'start_row': data.get('start_row', 7),
+        'fill_mode': data.get('fill_mode', 'repeat'),  # 'repeat' or 'duplicate'
+        'engine': data.get('engine', 'auto'),  # 'auto', 'openpyxl' or 'streaming'
+        'sheet_name': data.get('sheet_name')  # mặc định sheet đang active
+    }
+
 # Route: Fill data into Excel file
 @app.route('/api/excel/fill-data', methods=['POST'])
 def fill_excel_data():
-    """API endpoint để fill dữ liệu từ database vào file Excel"""
+    """API endpoint để fill dữ liệu từ database vào file Excel (đồng bộ, file lớn nên dùng /api/excel/fill-jobs)"""
     try:
-        data = request.get_json()
-        filename = data.get('filename')
-        collection = data.get('collection')
-        column = data.get('column', 'E')
-        sku_column = data.get('sku_column', 'A')
-        batch_column = data.get('batch_column', 'CU')
-        image_column = data.get('image_column', 'T')
-        fill_images_from_s3 = data.get('fill_images_from_s3', False)  # Changed from fill_images_from_drive
-        start_row = data.get('start_row', 7)
-        fill_mode = data.get('fill_mode', 'repeat')  # 'repeat' or 'duplicate'
-        
-        if not filename or not collection:
-            return jsonify({'success': False, 'error': 'Thiếu thông tin filename hoặc collection'}), 400
+        params = _parse_fill_params(request.get_json())
         
-        # Get products from database
-        from walmart import get_products
-        products = get_products(collection)
+        if not params['filename'] or not params['collection']:
+            return jsonify({'success': False, 'error': 'Thiếu thông tin filename hoặc collection'}), 400
         
-        if not products:
-            return jsonify({'success': False, 'error': 'Không tìm thấy sản phẩm trong collection'}), 400
+        # Cursor sản phẩm từ database (duplicate mode gộp trùng tên ở phía MongoDB)
+        from walmart import iter_products
+        products = iter_products(params['collection'], unique_names=params['fill_mode'] == 'duplicate')
         
-        print(f"Đã lấy {len(products)} sản phẩm từ collection '{collection}'")
-        print(f"Fill mode: {fill_mode}")
-        print(f"Product name column: {column}, SKU column: {sku_column}, Batch ID column: {batch_column}")
-        if fill_images_from_s3:
-            print(f"Image column: {image_column} (fill from AWS S3: ON)")
-        print(f"Sẽ tự động fill từ dòng {start_row} đến cuối file")
+        print(f"Fill từ collection '{params['collection']}'")
+        print(f"Fill mode: {params['fill_mode']}")
+        print(f"Product name column: {params['column']}, SKU column: {params['sku_column']}, Batch ID column: {params['batch_column']}")
+        if params['fill_images_from_s3']:
+            print(f"Image column: {params['image_column']} (fill from AWS S3: ON)")
+        print(f"Sẽ tự động fill từ dòng {params['start_row']} đến cuối file")
         
         # Read Excel file and fill data
         from import_excel import fill_excel_with_data
-        result = fill_excel_with_data(filename, products, column, start_row, fill_mode, sku_column, batch_column, image_column, fill_images_from_s3)
+        result = fill_excel_with_data(
+            params['filename'], products, params['column'], params['start_row'], params['fill_mode'],
+            params['sku_column'], params['batch_column'], params['image_column'],
+            params['fill_images_from_s3'], params['engine'], sheet_name=params['sheet_name']
+        )
         
         return jsonify(result)
         
@@ -1254,6 +1578,93 @@ def fill_excel_data():
         print(f"Error in fill_excel_data: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Route: Fill data chạy nền
+@app.route('/api/excel/fill-jobs', methods=['POST'])
+def submit_fill_job_api():
+    """Tạo job fill Excel chạy nền, trả về job_id để theo dõi tiến độ"""
+    try:
+        params = _parse_fill_params(request.get_json())
+        
+        if not params['filename'] or not params['collection']:
+            return jsonify({'success': False, 'error': 'Thiếu thông tin filename hoặc collection'}), 400
+        
+        if not os.path.exists(os.path.join('uploads', params['filename'])):
+            return jsonify({'success': False, 'error': f"File không tồn tại: {params['filename']}"}), 404
+        
+        job_id = submit_fill_job(params)
+        return jsonify({'success': True, 'job_id': job_id}), 202
+        
+    except Exception as e:
+        print(f"Error in submit_fill_job_api: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Route: Batch fill nhiều file / sheet (chạy nền, kết quả là một file zip)
+@app.route('/api/excel/fill-batch', methods=['POST'])
+def submit_fill_batch_api():
+    """
+    Tạo job fill nhiều file Excel từ cùng một collection.
+    Body: giống /api/excel/fill-data, thay filename bằng files: [{"filename": ..., "sheets": [...]}]
+    Khi job xong, result.zip_filename tải về qua /api/excel/download/<zip_filename>
+    """
+    try:
+        data = request.get_json()
+        params = _parse_fill_params(data)
+        files = data.get('files') or []
+        # Cho phép truyền danh sách tên file đơn giản
+        params['targets'] = [{'filename': item} if isinstance(item, str) else item for item in files]
+        
+        if not params['targets'] or not params['collection']:
+            return jsonify({'success': False, 'error': 'Thiếu thông tin files hoặc collection'}), 400
+        
+        for target in params['targets']:
+            if not target.get('filename') or not os.path.exists(os.path.join('uploads', target['filename'])):
+                return jsonify({'success': False, 'error': f"File không tồn tại: {target.get('filename')}"}), 404
+        
+        job_id = submit_fill_job(params)
+        return jsonify({'success': True, 'job_id': job_id}), 202
+        
+    except Exception as e:
+        print(f"Error in submit_fill_batch_api: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/excel/fill-jobs', methods=['GET'])
+def list_fill_jobs_api():
+    """Danh sách các job fill đang chạy / còn giữ kết quả"""
+    return jsonify({'success': True, 'jobs': list_fill_jobs()})
+
+@app.route('/api/excel/fill-jobs/<job_id>', methods=['GET'])
+def get_fill_job_api(job_id):
+    """Trạng thái và tiến độ của một job fill"""
+    job = get_fill_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job không tồn tại hoặc đã hết hạn'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/excel/fill-jobs/<job_id>/events', methods=['GET'])
+def stream_fill_job_api(job_id):
+    """Stream tiến độ job fill dưới dạng Server-Sent Events, kết thúc khi job xong"""
+    if get_fill_job(job_id) is None:
+        return jsonify({'success': False, 'error': 'Job không tồn tại hoặc đã hết hạn'}), 404
+    
+    def generate():
+        last_version = -1
+        while True:
+            job = wait_for_fill_job_change(job_id, last_version)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job không tồn tại hoặc đã hết hạn'})}\n\n"
+                return
+            if job['version'] == last_version:
+                # Giữ kết nối sống qua proxy
+                yield ": keep-alive\n\n"
+                continue
+            last_version = job['version']
+            yield f"data: {json.dumps(job)}\n\n"
+            if job['status'] in FINISHED_STATES:
+                return
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/excel/download/<filename>')
 def download_file_only(filename):
     """API endpoint để download file (không tự động xóa)"""
@@ -1270,6 +1681,8 @@ def download_file_only(filename):
             mimetype = 'application/vnd.ms-excel'
         elif filename.lower().endswith('.csv'):
             mimetype = 'text/csv'
+        elif filename.lower().endswith('.zip'):
+            mimetype = 'application/zip'
         else:
             mimetype = 'application/octet-stream'
         
@@ -1289,19 +1702,13 @@ def download_file_only(filename):
 def get_collections_api():
     """API endpoint để lấy danh sách collections từ MongoDB"""
     try:
-        from pymongo import MongoClient
-        import os
-        
-        # Kết nối MongoDB
-        client = MongoClient(os.getenv("MONGO_URI"))
-        db = client['walmart']
+        db = get_database()
         
         # Lấy danh sách collections (loại trừ system collections và internal collections)
-        # Collections bị loại trừ: system collections, batch_ids, generated_skus, logs
-        excluded_collections = {'batch_ids', 'generated_skus', 'logs'}
+        # Collections bị loại trừ: system collections và INTERNAL_COLLECTIONS (config.py)
         collections = []
         for collection_name in db.list_collection_names():
-            if not collection_name.startswith('system.') and collection_name not in excluded_collections:
+            if not collection_name.startswith('system.') and collection_name not in INTERNAL_COLLECTIONS:
                 collections.append(collection_name)
         
         print(f"Tìm thấy {len(collections)} collections: {collections}")
@@ -1322,7 +1729,7 @@ def get_collections_api():
 # Route: Download images to AWS S3
 @app.route('/api/download-images-to-s3', methods=['POST'])
 def download_images_to_s3():
-    """API endpoint để download hình ảnh từ database lên AWS S3"""
+    """API endpoint để download hình ảnh từ database lên AWS S3 (đồng bộ, giới hạn limit; cả collection dùng /api/image-exports)"""
     try:
         data = request.get_json()
         collection_name = data.get('collection')
@@ -1341,30 +1748,20 @@ def download_images_to_s3():
                 'error': 'AWS S3 handler chưa được setup. Vui lòng cài đặt dependencies và credentials.'
             }), 500
         
-        # Get products from database
+        # Get products from database (giới hạn số lượng ở phía MongoDB)
         from walmart import get_products
-        products = get_products(collection_name)
+        products = get_products(collection_name, limit=limit)
         
         if not products:
             return jsonify({'success': False, 'error': 'Không tìm thấy sản phẩm trong collection'}), 400
         
         # Filter products có hình ảnh
         products_with_images = []
-        for product in products[:limit]:  # Giới hạn số lượng
-            image_url = None
+        for product in products:
+            # Ảnh đầu tiên (image_url / image / variant đầu tiên) đã được chọn sẵn trong query
+            image_url = product.get('image')
             
-            # Check multiple possible image locations
-            if product.get('image_url'):
-                image_url = product.get('image_url')
-            elif product.get('image'):
-                image_url = product.get('image')
-            elif product.get('hasVariant') and len(product['hasVariant']) > 0:
-                # Check first variant for image
-                variant = product['hasVariant'][0]
-                if variant.get('image'):
-                    image_url = variant.get('image')
-            
-            if image_url and image_url.strip():  # Make sure URL is not empty
+            if isinstance(image_url, str) and image_url.strip():  # Make sure URL is not empty
                 product_name = product.get('name', 'Unknown Product')
                 
                 # Tạo filename safe
@@ -1411,6 +1808,10 @@ def download_images_to_s3():
             'failed_uploads': results['failed_count'],
             'uploaded_files': results['uploaded_files'],
             'failed_files': results['failed_files'],
+            'skipped_uploads': results.get('skipped_count', 0),
+            'copied_uploads': results.get('copied_count', 0),
+            'transfer_metrics': results.get('transfer_metrics'),
+            'optimize_stats': results.get('optimize_stats'),
             'folders_created': results.get('folders_created', []),
             'total_folders': len(results.get('folders_created', []))
         }
@@ -1421,6 +1822,117 @@ def download_images_to_s3():
         print(f"Error in download_images_to_s3: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# Route: Export ảnh sản phẩm lên S3 dạng job nền có manifest (resume được)
+IMAGE_EXPORT_EVENTS_POLL_SECONDS = 1
+IMAGE_EXPORT_EVENTS_KEEPALIVE_SECONDS = 15
+
+@app.route('/api/image-exports', methods=['POST'])
+def submit_image_export_api():
+    """Tạo job export toàn bộ ảnh của collection lên S3, trả về job_id để theo dõi tiến độ"""
+    try:
+        data = request.get_json() or {}
+        collection_name = data.get('collection')
+        folder_name = data.get('folder_name') or f'Product_Images_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+
+        if not collection_name:
+            return jsonify({'success': False, 'error': 'Thiếu thông tin collection'}), 400
+
+        job_id = image_export_jobs.submit_image_export(collection_name, folder_name)
+        return jsonify({'success': True, 'job_id': job_id, 'folder_name': folder_name}), 202
+
+    except Exception as e:
+        print(f"Error in submit_image_export_api: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/image-exports', methods=['GET'])
+def list_image_exports_api():
+    """Danh sách job export ảnh gần nhất"""
+    return jsonify({'success': True, 'jobs': image_export_jobs.list_image_exports()})
+
+@app.route('/api/image-exports/<job_id>', methods=['GET'])
+def get_image_export_api(job_id):
+    """Trạng thái job export ảnh (số item theo state)"""
+    job = image_export_jobs.get_image_export(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job không tồn tại'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/image-exports/<job_id>/resume', methods=['POST'])
+def resume_image_export_api(job_id):
+    """Chạy tiếp job export (bỏ qua item đã upload, retry item lỗi nếu retry_failed, mặc định true)"""
+    data = request.get_json(silent=True) or {}
+    job = image_export_jobs.resume_image_export(job_id, retry_failed=bool(data.get('retry_failed', True)))
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job không tồn tại'}), 404
+    return jsonify({'success': True, 'job': job}), 202
+
+@app.route('/api/image-exports/<job_id>/items', methods=['GET'])
+def list_image_export_items_api(job_id):
+    """Item trong manifest của job (?state=failed để xem lý do lỗi)"""
+    state = request.args.get('state')
+    if state and state not in image_export_jobs.ITEM_STATES:
+        return jsonify({'success': False, 'error': f'state không hợp lệ: {state}'}), 400
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    items = image_export_jobs.list_image_export_items(job_id, state=state, limit=limit)
+    return jsonify({'success': True, 'items': items})
+
+@app.route('/api/image-exports/<job_id>/events', methods=['GET'])
+def stream_image_export_api(job_id):
+    """Stream tiến độ job export ảnh dưới dạng Server-Sent Events, kết thúc khi job xong"""
+    if image_export_jobs.get_image_export(job_id) is None:
+        return jsonify({'success': False, 'error': 'Job không tồn tại'}), 404
+
+    def generate():
+        # Trạng thái job nằm trong MongoDB (job có thể chạy ở worker process khác) nên poll định kỳ
+        last_version = -1
+        last_sent = time.time()
+        while True:
+            job = image_export_jobs.get_image_export(job_id)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job không tồn tại'})}\n\n"
+                return
+            if job['version'] != last_version or job['status'] in image_export_jobs.FINISHED_STATES:
+                last_version = job['version']
+                last_sent = time.time()
+                yield f"data: {json.dumps(job)}\n\n"
+                if job['status'] in image_export_jobs.FINISHED_STATES:
+                    return
+            elif time.time() - last_sent >= IMAGE_EXPORT_EVENTS_KEEPALIVE_SECONDS:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+            time.sleep(IMAGE_EXPORT_EVENTS_POLL_SECONDS)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/products/image-derivatives', methods=['POST'])
+def generate_image_derivatives():
+    """Tạo thumbnail/medium/full (WebP/AVIF) trên S3 cho ảnh sản phẩm và lưu URL vào sản phẩm"""
+    try:
+        data = request.get_json() or {}
+        collection_name = data.get('collection')
+        limit = data.get('limit')
+        overwrite = bool(data.get('overwrite', False))
+
+        if not collection_name:
+            return jsonify({'success': False, 'error': 'Thiếu thông tin collection'}), 400
+
+        try:
+            from aws_s3_handler import AWSS3Uploader
+            uploader = AWSS3Uploader()
+        except Exception as e:
+            return jsonify({'success': False, 'error': f'Lỗi khi kết nối AWS S3: {str(e)}'}), 500
+
+        stats = uploader.generate_product_derivatives(collection_name, limit=limit, overwrite=overwrite)
+        if stats['generated']:
+            notify_collection_write(collection_name)
+
+        return jsonify({'success': True, 'collection': collection_name, **stats})
+
+    except Exception as e:
+        print(f"Error in generate_image_derivatives: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 if __name__ == '__main__':
     # Khởi tạo Smart Login System trước khi chạy app
     print("=" * 60)
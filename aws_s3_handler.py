@@ -1,18 +1,32 @@
 import boto3
-import requests
+import math
+import time
 import io
 import os
 import mimetypes
-import concurrent.futures
-from PIL import Image
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from PIL import Image, ImageOps, features
 from urllib.parse import urlparse
-from botocore.exceptions import NoCredentialsError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import NoCredentialsError, ClientError
 from datetime import datetime
 import re
+from s3_image_index import record_s3_object, list_indexed_objects, iter_s3_objects
+from http_fetcher import fetch_url
+from image_registry import content_hash, find_image, register_image, add_source_url, forget_image
 
 # --- Cấu hình AWS ---
 try:
-    from config import AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET_NAME, AWS_FOLDER_NAME, AWS_REGION
+    from config import AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_BUCKET_NAME, AWS_FOLDER_NAME, AWS_REGION, IMAGE_PROCESS_WORKERS
+    from config import IMAGE_DERIVATIVE_SIZES, IMAGE_DERIVATIVE_FORMAT, IMAGE_DERIVATIVE_QUALITY
+    from config import IMAGE_PASSTHROUGH_MAX_BYTES, IMAGE_MIN_SAVINGS_PERCENT
+    from config import (S3_MAX_POOL_CONNECTIONS, S3_MAX_ATTEMPTS, S3_RETRY_MODE, S3_MULTIPART_THRESHOLD_MB,
+                        S3_MULTIPART_CHUNKSIZE_MB, S3_TRANSFER_CONCURRENCY, S3_ENDPOINT_URL)
     BUCKET_NAME = AWS_BUCKET_NAME
     FOLDER_NAME = AWS_FOLDER_NAME
     REGION = AWS_REGION
@@ -25,26 +39,296 @@ except ImportError:
     FOLDER_NAME = os.getenv("AWS_FOLDER_NAME", "images")
     REGION = os.getenv("AWS_REGION", "us-east-2")
     BUCKET_HOSTING_URL = f"http://{BUCKET_NAME}.s3-website.{REGION}.amazonaws.com"
+    IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+    IMAGE_DERIVATIVE_SIZES = os.getenv("IMAGE_DERIVATIVE_SIZES", "thumb:160,medium:600,full:0")
+    IMAGE_DERIVATIVE_FORMAT = os.getenv("IMAGE_DERIVATIVE_FORMAT", "WEBP")
+    IMAGE_DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+    IMAGE_PASSTHROUGH_MAX_BYTES = int(os.getenv("IMAGE_PASSTHROUGH_MAX_BYTES", str(30 * 1024)))
+    IMAGE_MIN_SAVINGS_PERCENT = int(os.getenv("IMAGE_MIN_SAVINGS_PERCENT", "10"))
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+    S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "5"))
+    S3_RETRY_MODE = os.getenv("S3_RETRY_MODE", "adaptive")
+    S3_MULTIPART_THRESHOLD_MB = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8"))
+    S3_MULTIPART_CHUNKSIZE_MB = int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", "8"))
+    S3_TRANSFER_CONCURRENCY = int(os.getenv("S3_TRANSFER_CONCURRENCY", "4"))
+    S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
 
 # --- Cấu hình khác ---
 MAX_WORKERS = 10        # số luồng tải ảnh song song
-TIMEOUT = 15            # timeout request
 COMPRESSION_QUALITY = 85  # chất lượng ảnh sau khi nén (0-100)
 
-# --- Khởi tạo S3 client ---
-try:
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY,
-        region_name=REGION,
-    )
-except Exception as e:
-    print(f"Lỗi khởi tạo S3 client: {e}")
-    s3 = None
+# --- Pipeline tải -> nén -> upload ---
+DOWNLOAD_WORKERS = MAX_WORKERS            # số luồng tải ảnh
+OPTIMIZE_WORKERS = 2 * IMAGE_PROCESS_WORKERS  # số luồng gửi ảnh sang process pool nén (x2 để process không chờ IPC)
+UPLOAD_WORKERS = MAX_WORKERS              # số luồng upload S3
+PIPELINE_QUEUE_DEPTH = 2 * MAX_WORKERS    # số ảnh tối đa chờ giữa 2 stage (giới hạn memory)
+
+# Đánh dấu hết dữ liệu trong queue của pipeline
+_PIPELINE_DONE = object()
+
+# --- Ảnh derivative (thumbnail / medium / full) ---
+DERIVATIVE_PREFIX = 'derivatives'
+# [(tên, cạnh dài tối đa)], 0 = giữ kích thước gốc
+DERIVATIVE_SIZES = [
+    (name.strip(), int(max_side))
+    for name, max_side in (item.split(':') for item in IMAGE_DERIVATIVE_SIZES.split(',') if item.strip())
+]
+DERIVATIVE_FORMATS = {'WEBP': ('webp', 'image/webp'), 'AVIF': ('avif', 'image/avif')}
+# AVIF cần Pillow build kèm libavif, không có thì dùng WEBP
+DERIVATIVE_FORMAT = IMAGE_DERIVATIVE_FORMAT.upper()
+if DERIVATIVE_FORMAT not in DERIVATIVE_FORMATS or not features.check(DERIVATIVE_FORMAT.lower()):
+    DERIVATIVE_FORMAT = 'WEBP'
+DERIVATIVE_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # key theo hash nội dung nên không bao giờ đổi
+DERIVATIVE_PRODUCT_CHUNK = 500
+
+# --- Quyết định có nén lại ảnh hay không ---
+# Bảng lượng tử hóa luminance chuẩn JPEG (Annex K), dùng để ước lượng quality của ảnh nguồn
+JPEG_STD_LUMINANCE_QTABLE_SUM = sum([
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99
+])
+# Kết quả quyết định: upload nguyên bản không decode / đã nén lại / nén lại không đáng nên giữ bản gốc
+OPTIMIZE_PASSTHROUGH = 'passthrough'
+OPTIMIZE_RECOMPRESSED = 'recompressed'
+OPTIMIZE_KEPT_ORIGINAL = 'kept_original'
+
+
+def url_file_name(url):
+    """Tên file lấy từ path của URL ảnh ('' nếu URL không có tên file)"""
+    return os.path.basename(urlparse(url).path)
+
+
+# Process pool nén ảnh: Pillow decode/encode tốn CPU và bị GIL khóa nếu chạy bằng thread
+_image_process_pool = None
+_image_process_pool_lock = threading.Lock()
+
+
+def estimate_jpeg_quality(image):
+    """Ước lượng quality (1-100) của JPEG từ bảng lượng tử hóa trong header (không cần decode)"""
+    tables = getattr(image, 'quantization', None)
+    if not tables or 0 not in tables:
+        return None
+    scale = sum(tables[0]) * 100 / JPEG_STD_LUMINANCE_QTABLE_SUM
+    return (200 - scale) / 2 if scale <= 100 else 5000 / scale
+
+
+def _passthrough_reason(image, size):
+    """Lý do upload nguyên bản chỉ dựa vào header (Image.open chưa decode pixel), None nếu cần nén lại"""
+    image_format = (image.format or '').upper()
+    if image_format not in ('JPEG', 'WEBP', 'PNG'):
+        return None
+    if size <= IMAGE_PASSTHROUGH_MAX_BYTES:
+        return 'small'
+    if image_format == 'WEBP':
+        return 'webp'
+    if image_format == 'PNG' and image.mode == 'P':
+        return 'palette_png'
+    if image_format == 'JPEG':
+        quality = estimate_jpeg_quality(image)
+        if quality is not None and quality <= COMPRESSION_QUALITY:
+            return 'jpeg_quality'
+    return None
+
+
+def optimize_image_bytes(file_name, content):
+    """
+    Nén ảnh (chạy trong process pool nên chỉ nhận/trả bytes).
+    Ảnh đã tối ưu sẵn (xem _passthrough_reason) hoặc nén lại tiết kiệm dưới IMAGE_MIN_SAVINGS_PERCENT
+    được giữ nguyên bản. Trả về (filename, content_bytes, content_type, info) hoặc None nếu lỗi,
+    info = {'decision', 'reason', 'input_bytes', 'output_bytes', 'cpu_seconds'}.
+    """
+    cpu_started = time.process_time()
+    try:
+        # Mở ảnh bằng Pillow (chỉ đọc header, pixel được decode khi save/convert)
+        image = Image.open(io.BytesIO(content))
+        image_format = image.format or "JPEG"
+        source_format = image_format.upper()
+
+        def result(data, content_type, decision, reason=None):
+            return (file_name, data, content_type, {
+                'decision': decision,
+                'reason': reason,
+                'input_bytes': len(content),
+                'output_bytes': len(data),
+                'cpu_seconds': time.process_time() - cpu_started
+            })
+
+        reason = _passthrough_reason(image, len(content))
+        if reason:
+            return result(content, f"image/{image_format.lower()}", OPTIMIZE_PASSTHROUGH, reason)
+
+        # Nén ảnh vào memory buffer
+        buffer = io.BytesIO()
+        if image_format.upper() in ["JPEG", "JPG"]:
+            image.save(buffer, format="JPEG", optimize=True, quality=COMPRESSION_QUALITY)
+        elif image_format.upper() == "PNG":
+            image = image.convert("P", palette=Image.ADAPTIVE)
+            image.save(buffer, format="PNG", optimize=True)
+        else:
+            # convert các định dạng lạ sang JPEG
+            rgb_im = image.convert("RGB")
+            image_format = "JPEG"
+            rgb_im.save(buffer, format="JPEG", optimize=True, quality=COMPRESSION_QUALITY)
+
+        data = buffer.getvalue()
+        if source_format in ("JPEG", "PNG"):
+            # Nén lại không đáng thì giữ bản gốc (không mất thêm chất lượng)
+            saved_percent = (len(content) - len(data)) * 100 / len(content)
+            if saved_percent < IMAGE_MIN_SAVINGS_PERCENT:
+                return result(content, f"image/{source_format.lower()}", OPTIMIZE_KEPT_ORIGINAL,
+                              f"saved {saved_percent:.1f}%")
+        return result(data, f"image/{image_format.lower()}", OPTIMIZE_RECOMPRESSED)
+
+    except Exception as e:
+        print(f"Lỗi khi nén {file_name}: {e}")
+        return None
+
+
+def make_image_derivatives(content, sizes=DERIVATIVE_SIZES, image_format=DERIVATIVE_FORMAT,
+                           quality=IMAGE_DERIVATIVE_QUALITY):
+    """Tạo các bản resize của ảnh (chạy trong process pool), trả về [(tên size, content_bytes)]"""
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(content)))
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    derivatives = []
+    for name, max_side in sizes:
+        derivative = image.copy()
+        if max_side:
+            derivative.thumbnail((max_side, max_side), Image.LANCZOS)
+        buffer = io.BytesIO()
+        derivative.save(buffer, format=image_format, quality=quality)
+        derivatives.append((name, buffer.getvalue()))
+    return derivatives
+
+
+def _get_image_process_pool():
+    """Process pool dùng chung (tạo lazy, tạo lại nếu pool cũ bị hỏng)"""
+    global _image_process_pool
+    with _image_process_pool_lock:
+        if _image_process_pool is None:
+            _image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+        return _image_process_pool
+
+
+def _reset_image_process_pool(broken_pool):
+    global _image_process_pool
+    with _image_process_pool_lock:
+        if _image_process_pool is broken_pool:
+            _image_process_pool = None
+    broken_pool.shutdown(wait=False)
+
+
+def run_in_image_pool(fn, *args):
+    """Chạy fn(*args) trong process pool ảnh; pool hỏng (process con chết...) thì tạo lại và chạy tại chỗ"""
+    pool = _get_image_process_pool()
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        print(f"Process pool xử lý ảnh bị hỏng, chạy {fn.__name__} trong process hiện tại")
+        _reset_image_process_pool(pool)
+        return fn(*args)
+
+# --- S3 client / transfer ---
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+    retries={'total_max_attempts': S3_MAX_ATTEMPTS, 'mode': S3_RETRY_MODE}
+)
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency=S3_TRANSFER_CONCURRENCY
+)
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """S3 client dùng chung cho cả process (tạo lazy, tạo mới sau khi fork), None nếu không tạo được"""
+    global _s3_client, _s3_client_pid
+    pid = os.getpid()
+    if _s3_client is not None and _s3_client_pid == pid:
+        return _s3_client
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != pid:
+            try:
+                _s3_client = boto3.client(
+                    "s3",
+                    aws_access_key_id=AWS_ACCESS_KEY,
+                    aws_secret_access_key=AWS_SECRET_KEY,
+                    region_name=REGION,
+                    endpoint_url=S3_ENDPOINT_URL,
+                    config=S3_CLIENT_CONFIG
+                )
+                _s3_client_pid = pid
+            except Exception as e:
+                print(f"Lỗi khởi tạo S3 client: {e}")
+                return None
+    return _s3_client
+
+
+class TransferMetrics:
+    """Thống kê upload của một batch: bytes/s, objects/s, độ trễ p50/p95, lỗi theo mã"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = []
+        self._bytes = 0
+        self._failed = 0
+        self._errors = {}
+        self._first_start = None
+        self._last_end = None
+
+    def record(self, started, size, error=None):
+        """Ghi nhận 1 upload bắt đầu lúc started (time.perf_counter()), error = mã lỗi nếu thất bại"""
+        ended = time.perf_counter()
+        with self._lock:
+            self._first_start = started if self._first_start is None else min(self._first_start, started)
+            self._last_end = ended if self._last_end is None else max(self._last_end, ended)
+            if error is None:
+                self._latencies.append(ended - started)
+                self._bytes += size or 0
+            else:
+                self._failed += 1
+                self._errors[error] = self._errors.get(error, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            elapsed = (self._last_end - self._first_start) if self._first_start is not None else 0
+
+            def percentile(fraction):
+                if not latencies:
+                    return None
+                return round(latencies[max(math.ceil(fraction * len(latencies)) - 1, 0)] * 1000, 1)
+
+            return {
+                'objects': len(latencies),
+                'bytes': self._bytes,
+                'failed': self._failed,
+                'errors': dict(self._errors),
+                'elapsed_seconds': round(elapsed, 3),
+                'bytes_per_second': round(self._bytes / elapsed, 1) if elapsed else None,
+                'objects_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+                'p50_latency_ms': percentile(0.5),
+                'p95_latency_ms': percentile(0.95)
+            }
+
+
+def _error_code(error):
+    """Mã lỗi S3 (SlowDown, AccessDenied...) hoặc tên exception"""
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') or 'ClientError'
+    return type(error).__name__
+
 
 class AWSS3Uploader:
     def __init__(self):
+        s3 = get_s3_client()
         if not s3:
             raise Exception("S3 client chưa được khởi tạo. Vui lòng kiểm tra AWS credentials.")
         
@@ -60,55 +344,272 @@ class AWSS3Uploader:
         except Exception as e:
             raise Exception(f"Không thể kết nối tới S3 bucket '{BUCKET_NAME}': {str(e)}")
 
+    def fetch_image(self, url):
+        """Tải ảnh, trả về (filename, content_bytes), raise nếu lỗi."""
+        content, _ = fetch_url(url)
+        file_name = url_file_name(url) or f"image_{os.urandom(4).hex()}.jpg"
+        return (file_name, content)
+
+    def download_image(self, url):
+        """Tải ảnh, trả về (filename, content_bytes) hoặc None nếu lỗi."""
+        try:
+            return self.fetch_image(url)
+        except Exception as e:
+            print(f"Lỗi khi tải {url}: {e}")
+            return None
+
     def download_and_optimize_image(self, url):
         """Tải và nén ảnh trong memory, trả về (filename, content_bytes, content_type)."""
-        try:
-            response = requests.get(url, timeout=TIMEOUT)
-            response.raise_for_status()
-
-            parsed = urlparse(url)
-            file_name = os.path.basename(parsed.path) or f"image_{os.urandom(4).hex()}.jpg"
-            content_type = response.headers.get("Content-Type") or mimetypes.guess_type(file_name)[0]
-
-            # Mở ảnh bằng Pillow
-            image = Image.open(io.BytesIO(response.content))
-            image_format = image.format or "JPEG"
-
-            # Nén ảnh vào memory buffer
-            buffer = io.BytesIO()
-            if image_format.upper() in ["JPEG", "JPG"]:
-                image.save(buffer, format="JPEG", optimize=True, quality=COMPRESSION_QUALITY)
-            elif image_format.upper() == "PNG":
-                image = image.convert("P", palette=Image.ADAPTIVE)
-                image.save(buffer, format="PNG", optimize=True)
-            else:
-                # convert các định dạng lạ sang JPEG
-                rgb_im = image.convert("RGB")
-                image_format = "JPEG"
-                rgb_im.save(buffer, format="JPEG", optimize=True, quality=COMPRESSION_QUALITY)
+        downloaded = self.download_image(url)
+        if downloaded is None:
+            return None
+        return self.optimize_image(*downloaded)
 
-            buffer.seek(0)
-            return (file_name, buffer, f"image/{image_format.lower()}")
+    def optimize_image(self, file_name, content):
+        """Nén ảnh trong process pool, trả về (filename, buffer, content_type) hoặc None nếu lỗi."""
+        optimized = self.optimize_image_with_stats(file_name, content)
+        return optimized[:3] if optimized is not None else None
 
-        except Exception as e:
-            print(f"Lỗi khi tải {url}: {e}")
+    def optimize_image_with_stats(self, file_name, content):
+        """Như optimize_image, kèm info (quyết định nén, bytes vào/ra, CPU) - xem optimize_image_bytes."""
+        optimized = run_in_image_pool(optimize_image_bytes, file_name, content)
+        if optimized is None:
             return None
+        file_name, data, content_type, info = optimized
+        return (file_name, io.BytesIO(data), content_type, info)
 
-    def upload_to_s3(self, file_name, buffer, content_type):
-        """Upload 1 ảnh lên S3 và trả về URL public."""
+    def upload_to_s3(self, file_name, buffer, content_type, metrics=None, folder=None):
+        """Upload 1 ảnh vào folder (mặc định FOLDER_NAME) và trả về URL public (ghi thống kê vào metrics nếu có)."""
+        started = time.perf_counter()
+        size = buffer.getbuffer().nbytes if isinstance(buffer, io.BytesIO) else None
         try:
-            s3_key = f"{FOLDER_NAME}/{file_name}"
-            s3.upload_fileobj(
+            s3_key = f"{folder or self.FOLDER_NAME}/{file_name}"
+            self.s3.upload_fileobj(
                 Fileobj=buffer,
                 Bucket=BUCKET_NAME,
                 Key=s3_key,
                 ExtraArgs={"ContentType": content_type},
+                Config=S3_TRANSFER_CONFIG
             )
+            if metrics is not None:
+                metrics.record(started, size)
+            try:
+                record_s3_object(BUCKET_NAME, s3_key, size=size)
+            except Exception as e:
+                # Index chỉ để tăng tốc, lỗi ghi index không làm hỏng upload (full sync sẽ bổ sung)
+                print(f"Lỗi cập nhật S3 index cho {s3_key}: {e}")
             return f"{BUCKET_HOSTING_URL}/{s3_key}"
         except Exception as e:
+            if metrics is not None:
+                metrics.record(started, size, error=_error_code(e))
             print(f"Lỗi upload {file_name}: {e}")
             return None
 
+    def reuse_registered_image(self, source_url, file_name=None, content_digest=None, folder=None):
+        """
+        Dùng lại ảnh đã có trên S3, tìm trong registry theo content_digest (nếu có) hoặc source_url:
+        đã có đúng key trong folder (mặc định FOLDER_NAME) -> bỏ qua, có ở folder khác -> copy server-side.
+        Trả về (URL public, 'skipped' | 'copied'), None nếu phải tải/upload bình thường.
+        """
+        entry = None
+        folder = folder or self.FOLDER_NAME
+        try:
+            preferred_key = f"{folder}/{file_name}" if file_name else None
+            if content_digest is None:
+                entry = find_image(BUCKET_NAME, source_url=source_url, preferred_key=preferred_key)
+            else:
+                entry = find_image(BUCKET_NAME, content_digest=content_digest, preferred_key=preferred_key)
+            if entry is None:
+                return None
+
+            target_key = preferred_key or f"{folder}/{entry['key'].rsplit('/', 1)[-1]}"
+            if entry['key'] == target_key:
+                # Kiểm tra object còn trên S3 (HEAD rẻ hơn nhiều so với tải + upload lại)
+                self.s3.head_object(Bucket=BUCKET_NAME, Key=target_key)
+                add_source_url(BUCKET_NAME, target_key, source_url)
+                return (f"{BUCKET_HOSTING_URL}/{target_key}", 'skipped')
+
+            self.s3.copy_object(
+                Bucket=BUCKET_NAME,
+                Key=target_key,
+                CopySource={'Bucket': BUCKET_NAME, 'Key': entry['key']}
+            )
+            register_image(BUCKET_NAME, target_key, source_url, entry['content_hash'],
+                           entry.get('size'), entry.get('content_type'))
+            record_s3_object(BUCKET_NAME, target_key, size=entry.get('size'))
+            return (f"{BUCKET_HOSTING_URL}/{target_key}", 'copied')
+
+        except ClientError as e:
+            if entry is not None and e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                # Object trong registry đã bị xóa khỏi S3
+                forget_image(BUCKET_NAME, entry['key'])
+            else:
+                print(f"Lỗi dùng lại ảnh {source_url} trên S3: {e}")
+            return None
+        except Exception as e:
+            # Registry chỉ để tăng tốc, lỗi thì upload bình thường
+            print(f"Lỗi registry ảnh cho {source_url}: {e}")
+            return None
+
+    def run_image_pipeline(self, url_list, folder=None, on_item=None):
+        """
+        Tải -> nén -> upload vào folder (mặc định FOLDER_NAME) theo kiểu pipeline: mỗi stage có pool luồng
+        riêng, giữa các stage là queue giới hạn PIPELINE_QUEUE_DEPTH (stage nhanh phải chờ stage chậm),
+        nên memory chỉ giữ tối đa vài queue ảnh thay vì cả batch và upload chạy song song với download.
+        Ảnh đã có trong registry (theo URL hoặc hash nội dung) được bỏ qua / copy server-side, URL trùng
+        trong batch chỉ xử lý một lần. Folder được truyền theo từng batch (không dùng biến global)
+        nên nhiều batch có thể chạy đồng thời trong cùng process.
+        on_item(url, state, s3_url, reason) (nếu có) được gọi khi từng URL chuyển trạng thái:
+        'downloaded', 'uploaded' (kể cả bỏ qua / copy) hoặc 'failed' kèm lý do.
+        Trả về (danh sách URL đã upload, danh sách lỗi,
+        thống kê {'uploaded', 'skipped', 'copied', 'transfer': TransferMetrics.snapshot(),
+        'optimize': bytes tiết kiệm / CPU của bước nén}).
+        """
+        url_queue = queue.Queue()
+        downloaded_queue = queue.Queue(maxsize=PIPELINE_QUEUE_DEPTH)
+        optimized_queue = queue.Queue(maxsize=PIPELINE_QUEUE_DEPTH)
+        uploaded_urls = []
+        failed = []
+        stats = {'uploaded': 0, 'skipped': 0, 'copied': 0}
+        metrics = TransferMetrics()
+        optimize_stats = {
+            OPTIMIZE_PASSTHROUGH: 0, OPTIMIZE_RECOMPRESSED: 0, OPTIMIZE_KEPT_ORIGINAL: 0,
+            'input_bytes': 0, 'output_bytes': 0, 'cpu_seconds': 0.0
+        }
+        folder = folder or self.FOLDER_NAME
+        # URL nguồn -> URL S3 (hoặc lỗi) để trả kết quả cho các URL trùng trong batch
+        results_by_url = {}
+        results_lock = threading.Lock()
+
+        unique_urls = list(dict.fromkeys(url_list))
+        for url in unique_urls:
+            url_queue.put(url)
+
+        def fail(url, stage, error=None):
+            message = f"{stage} failed: {url}" + (f" ({error})" if error else "")
+            with results_lock:
+                failed.append(message)
+                results_by_url[url] = (None, message)
+            if on_item:
+                on_item(url, 'failed', None, message)
+
+        def done(url, uploaded_url, how):
+            with results_lock:
+                uploaded_urls.append(uploaded_url)
+                stats[how] += 1
+                results_by_url[url] = (uploaded_url, None)
+            if on_item:
+                on_item(url, 'uploaded', uploaded_url, None)
+            print(f"{how.capitalize()}: {uploaded_url}")
+
+        def run_stage(stage, workers, source, target, handle):
+            """Chạy workers luồng đọc từ source; luồng cuối cùng kết thúc sẽ báo hết dữ liệu cho stage sau"""
+            remaining = [workers]
+            lock = threading.Lock()
+
+            def worker():
+                try:
+                    while True:
+                        item = source.get()
+                        if item is _PIPELINE_DONE:
+                            break
+                        try:
+                            handle(item)
+                        except Exception as e:
+                            # Worker phải sống tiếp, nếu không stage trước sẽ bị block khi queue đầy;
+                            # item là URL hoặc tuple (URL, ...), ghi nhận lỗi để URL không bị mất khỏi kết quả
+                            print(f"Lỗi pipeline ảnh: {e}")
+                            fail(item if isinstance(item, str) else item[0], stage, e)
+                finally:
+                    with lock:
+                        remaining[0] -= 1
+                        is_last = remaining[0] == 0
+                    if is_last and target is not None:
+                        for _ in range(target_workers[target]):
+                            target.put(_PIPELINE_DONE)
+
+            return [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+
+        def download(url):
+            reused = self.reuse_registered_image(url, file_name=url_file_name(url), folder=folder)
+            if reused:
+                done(url, *reused)
+                return
+            try:
+                downloaded = self.fetch_image(url)
+            except Exception as e:
+                fail(url, 'Download', e)
+                return
+            if on_item:
+                on_item(url, 'downloaded', None, None)
+            # URL khác nhưng cùng nội dung với ảnh đã upload
+            digest = content_hash(downloaded[1])
+            reused = self.reuse_registered_image(url, file_name=downloaded[0], content_digest=digest, folder=folder)
+            if reused:
+                done(url, *reused)
+            else:
+                downloaded_queue.put((url, digest, downloaded))
+
+        def optimize(item):
+            url, digest, downloaded = item
+            optimized = self.optimize_image_with_stats(*downloaded)
+            if optimized is None:
+                fail(url, 'Optimize')
+                return
+            info = optimized[3]
+            with results_lock:
+                optimize_stats[info['decision']] += 1
+                optimize_stats['input_bytes'] += info['input_bytes']
+                optimize_stats['output_bytes'] += info['output_bytes']
+                optimize_stats['cpu_seconds'] += info['cpu_seconds']
+            optimized_queue.put((url, digest, optimized[:3]))
+
+        def upload(item):
+            url, digest, (file_name, buffer, content_type) = item
+            size = buffer.getbuffer().nbytes
+            uploaded_url = self.upload_to_s3(file_name, buffer, content_type, metrics=metrics, folder=folder)
+            if not uploaded_url:
+                fail(url, 'Upload')
+                return
+            try:
+                register_image(BUCKET_NAME, f"{folder}/{file_name}", url, digest, size, content_type)
+            except Exception as e:
+                print(f"Lỗi ghi registry ảnh {url}: {e}")
+            done(url, uploaded_url, 'uploaded')
+
+        target_workers = {downloaded_queue: OPTIMIZE_WORKERS, optimized_queue: UPLOAD_WORKERS}
+        for _ in range(DOWNLOAD_WORKERS):
+            url_queue.put(_PIPELINE_DONE)
+
+        threads = (
+            run_stage('Download', DOWNLOAD_WORKERS, url_queue, downloaded_queue, download)
+            + run_stage('Optimize', OPTIMIZE_WORKERS, downloaded_queue, optimized_queue, optimize)
+            + run_stage('Upload', UPLOAD_WORKERS, optimized_queue, None, upload)
+        )
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # URL trùng trong batch dùng lại kết quả của lần xử lý đầu tiên
+        seen = set()
+        for url in url_list:
+            if url not in seen:
+                seen.add(url)
+                continue
+            uploaded_url, error = results_by_url.get(url, (None, f"Failed: {url}"))
+            if uploaded_url:
+                uploaded_urls.append(uploaded_url)
+                stats['skipped'] += 1
+            else:
+                failed.append(error)
+
+        stats['transfer'] = metrics.snapshot()
+        optimize_stats['bytes_saved'] = optimize_stats['input_bytes'] - optimize_stats['output_bytes']
+        optimize_stats['cpu_seconds'] = round(optimize_stats['cpu_seconds'], 3)
+        stats['optimize'] = optimize_stats
+        return uploaded_urls, failed, stats
+
     def batch_upload_images(self, products_with_images, folder_name=None):
         """Upload nhiều ảnh song song lên S3."""
         if not products_with_images:
@@ -117,83 +618,158 @@ class AWSS3Uploader:
                 'failed_count': 0,
                 'uploaded_files': [],
                 'failed_files': [],
-                'folders_created': []
+                'folders_created': [],
+                'skipped_count': 0,
+                'copied_count': 0,
+                'transfer_metrics': TransferMetrics().snapshot(),
+                'optimize_stats': None
             }
 
         # Tạo folder name nếu không có
         if not folder_name:
             folder_name = f"Product_Images_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        
-        # Cập nhật FOLDER_NAME global
-        global FOLDER_NAME
-        original_folder = FOLDER_NAME
-        FOLDER_NAME = folder_name
 
-        uploaded_urls = []
-        failed_uploads = []
         url_list = [item['url'] for item in products_with_images]
 
-        print(f"Bắt đầu xử lý {len(url_list)} ảnh với {MAX_WORKERS} luồng...")
-
-        # Bước 1: tải và nén song song
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            results = list(executor.map(self.download_and_optimize_image, url_list))
-
-        # Bước 2: upload lên S3 song song
-        valid_results = [r for r in results if r is not None]
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [
-                executor.submit(self.upload_to_s3, file_name, buffer, content_type)
-                for (file_name, buffer, content_type) in valid_results
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                url = future.result()
-                if url:
-                    uploaded_urls.append(url)
-                    print(f"Uploaded: {url}")
-                else:
-                    failed_uploads.append("Upload failed")
+        print(f"Bắt đầu xử lý {len(url_list)} ảnh (tải {DOWNLOAD_WORKERS} / nén {OPTIMIZE_WORKERS} / upload {UPLOAD_WORKERS} luồng)...")
 
-        # Khôi phục FOLDER_NAME
-        FOLDER_NAME = original_folder
+        # Tải, nén và upload chạy song song theo pipeline
+        uploaded_urls, failed_uploads, stats = self.run_image_pipeline(url_list, folder=folder_name)
 
-        print(f"\nHoàn thành! {len(uploaded_urls)}/{len(url_list)} ảnh đã upload.")
+        transfer = stats['transfer']
+        print(f"\nHoàn thành! {len(uploaded_urls)}/{len(url_list)} ảnh đã upload "
+              f"({stats['skipped']} đã có sẵn, {stats['copied']} copy từ folder khác). "
+              f"Upload: {transfer['objects_per_second']} ảnh/s, {transfer['bytes_per_second']} B/s, "
+              f"p95 {transfer['p95_latency_ms']} ms")
+        optimize = stats['optimize']
+        print(f"Nén: tiết kiệm {optimize['bytes_saved']} bytes, CPU {optimize['cpu_seconds']}s "
+              f"({optimize[OPTIMIZE_RECOMPRESSED]} nén lại, {optimize[OPTIMIZE_PASSTHROUGH]} giữ nguyên, "
+              f"{optimize[OPTIMIZE_KEPT_ORIGINAL]} nén không đáng)")
         
         return {
             'success_count': len(uploaded_urls),
             'failed_count': len(failed_uploads),
             'uploaded_files': uploaded_urls,
             'failed_files': failed_uploads,
-            'folders_created': [folder_name]
+            'folders_created': [folder_name],
+            'skipped_count': stats['skipped'],
+            'copied_count': stats['copied'],
+            'transfer_metrics': stats['transfer'],
+            'optimize_stats': stats['optimize']
         }
 
     def migrate_images_to_s3(self, url_list):
         """Tải, nén và upload nhiều ảnh song song lên S3."""
-        uploaded_urls = []
+        print(f"Bắt đầu xử lý {len(url_list)} ảnh (tải {DOWNLOAD_WORKERS} / nén {OPTIMIZE_WORKERS} / upload {UPLOAD_WORKERS} luồng)...")
 
-        print(f"Bắt đầu xử lý {len(url_list)} ảnh với {MAX_WORKERS} luồng...")
+        # Tải, nén và upload chạy song song theo pipeline
+        uploaded_urls, _, _ = self.run_image_pipeline(url_list)
 
-        # Bước 1: tải và nén song song
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            results = list(executor.map(self.download_and_optimize_image, url_list))
+        print(f"\nHoàn thành! {len(uploaded_urls)}/{len(url_list)} ảnh đã upload.")
+        return uploaded_urls
 
-        # Bước 2: upload lên S3 song song
-        valid_results = [r for r in results if r is not None]
+    def derivative_keys(self, content_digest):
+        """Key S3 của các derivative, xác định theo hash nội dung ảnh gốc: {tên size: key}"""
+        extension = DERIVATIVE_FORMATS[DERIVATIVE_FORMAT][0]
+        return {
+            name: f"{DERIVATIVE_PREFIX}/{content_digest[:2]}/{content_digest}/{name}.{extension}"
+            for name, _ in DERIVATIVE_SIZES
+        }
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [
-                executor.submit(self.upload_to_s3, file_name, buffer, content_type)
-                for (file_name, buffer, content_type) in valid_results
-            ]
-            for future in concurrent.futures.as_completed(futures):
-                url = future.result()
-                if url:
-                    uploaded_urls.append(url)
-                    print(f"Uploaded: {url}")
+    def generate_derivatives(self, source_url):
+        """
+        Tạo và upload các derivative (DERIVATIVE_SIZES) của một ảnh.
+        Trả về {tên size: URL public, 'source': source_url}, None nếu lỗi.
+        """
+        try:
+            content, _ = fetch_url(source_url)
+            keys = self.derivative_keys(content_hash(content))
+            # Các size được upload theo thứ tự, có size cuối trên S3 nghĩa là đã tạo đủ từ trước
+            last_key = keys[DERIVATIVE_SIZES[-1][0]]
+            try:
+                self.s3.head_object(Bucket=BUCKET_NAME, Key=last_key)
+                exists = True
+            except ClientError:
+                exists = False
 
-        print(f"\nHoàn thành! {len(uploaded_urls)}/{len(url_list)} ảnh đã upload.")
-        return uploaded_urls
+            if not exists:
+                content_type = DERIVATIVE_FORMATS[DERIVATIVE_FORMAT][1]
+                for name, data in run_in_image_pool(make_image_derivatives, content):
+                    self.s3.put_object(
+                        Bucket=BUCKET_NAME,
+                        Key=keys[name],
+                        Body=data,
+                        ContentType=content_type,
+                        CacheControl=DERIVATIVE_CACHE_CONTROL
+                    )
+
+            derivatives = {name: f"{BUCKET_HOSTING_URL}/{key}" for name, key in keys.items()}
+            derivatives['source'] = source_url
+            return derivatives
+        except Exception as e:
+            print(f"Lỗi tạo derivative cho {source_url}: {e}")
+            return None
+
+    def generate_product_derivatives(self, collection_name, limit=None, overwrite=False):
+        """
+        Tạo derivative cho ảnh đầu tiên của các sản phẩm trong collection và lưu URL vào
+        field image_derivatives của sản phẩm (mặc định bỏ qua sản phẩm đã có).
+        Trả về {'processed', 'generated', 'failed'}.
+        """
+        from config import get_database
+        from pymongo import UpdateOne
+        from walmart import iter_products
+
+        match = None if overwrite else {'image_derivatives': {'$exists': False}}
+        products = iter_products(collection_name, limit=limit, match=match)
+        collection = get_database()[collection_name]
+        # Nhiều sản phẩm (biến thể) dùng chung ảnh -> chỉ tạo 1 lần mỗi URL
+        by_url = {}
+        stats = {'processed': 0, 'generated': 0, 'failed': 0}
+
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            while True:
+                chunk = list(islice(products, DERIVATIVE_PRODUCT_CHUNK))
+                if not chunk:
+                    break
+                # Chỉ sản phẩm có URL ảnh dạng chuỗi (image thiếu / dạng list bị bỏ qua)
+                chunk = [product for product in chunk
+                         if isinstance(product.get('image'), str) and product['image'].strip()]
+                new_urls = list({product['image'] for product in chunk} - by_url.keys())
+                by_url.update(zip(new_urls, executor.map(self.generate_derivatives, new_urls)))
+
+                operations = []
+                for product in chunk:
+                    derivatives = by_url[product['image']]
+                    stats['processed'] += 1
+                    if derivatives is None:
+                        stats['failed'] += 1
+                        continue
+                    stats['generated'] += 1
+                    operations.append(UpdateOne(
+                        {'_id': product['_id']},
+                        {'$set': {'image_derivatives': dict(derivatives, updated_at=datetime.now())}}
+                    ))
+                if operations:
+                    collection.bulk_write(operations, ordered=False)
+
+        return stats
+
+    def list_images(self, prefix=None, refresh=True):
+        """
+        Tất cả ảnh dưới prefix (mặc định FOLDER_NAME/) dạng [{'name', 'url', 'key'}], theo thứ tự key.
+        Đọc từ index MongoDB; nếu index lỗi thì list trực tiếp S3 (có phân trang).
+        """
+        prefix = prefix if prefix is not None else f"{self.FOLDER_NAME}/"
+        try:
+            keys = list_indexed_objects(self.s3, self.BUCKET_NAME, prefix, refresh=refresh)
+        except Exception as e:
+            print(f"Lỗi đọc S3 index, list trực tiếp bucket: {e}")
+            keys = [obj['Key'] for obj in iter_s3_objects(self.s3, self.BUCKET_NAME, prefix)]
+        return [
+            {'name': key.split('/')[-1], 'url': f"{self.BUCKET_HOSTING_URL}/{key}", 'key': key}
+            for key in keys
+        ]
 
     def create_safe_filename(self, product_name, product_id=None):
         """Tạo filename an toàn cho S3."""
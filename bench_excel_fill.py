@@ -0,0 +1,82 @@
+"""
+Benchmark fill Excel: so sánh engine 'openpyxl' (sửa trực tiếp) và 'streaming' (write-only).
+
+Chạy:
+    python bench_excel_fill.py [template.xlsx] [số_dòng_output]
+
+Mỗi engine chạy trong một process riêng để đo peak RSS chính xác.
+SKU/Batch ID được tạo giả lập nên không cần kết nối MongoDB.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+DEFAULT_TEMPLATE = 'FileUploadDemo.xlsx'
+DEFAULT_ROWS = 100000
+
+
+def run_engine(template_name, target_rows, engine):
+    """Chạy fill trong process hiện tại, in ra 'rows seconds peak_rss_mb'"""
+    import resource
+
+    import openpyxl
+    import walmart
+    import import_excel
+
+    walmart.allocate_skus = lambda count, batch_id=None: [f"BENCH{i:045d}" for i in range(count)]
+    walmart.generate_batch_id = lambda: 'BENCH_BATCH'
+    walmart.mark_batch_used = lambda batch_id, count: None
+
+    # Số dòng template được fill (giống cách fill_excel_with_data tự phát hiện)
+    worksheet = openpyxl.load_workbook(os.path.join(import_excel.UPLOAD_FOLDER, template_name)).active
+    start_row = 7
+    group_rows = max(worksheet.max_row - start_row + 1, 10)
+    product_count = max(target_rows // group_rows, 1)
+    products = [{'name': f'Benchmark product {i}'} for i in range(product_count)]
+
+    started = time.perf_counter()
+    result = import_excel.fill_excel_with_data(template_name, products, start_row=start_row,
+                                               fill_mode='duplicate', engine=engine)
+    elapsed = time.perf_counter() - started
+    if not result.get('success'):
+        print(f"ERROR {result.get('error')}")
+        sys.exit(1)
+
+    os.remove(os.path.join(import_excel.UPLOAD_FOLDER, result['new_filename']))
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{result['filled_count']} {elapsed:.2f} {peak_rss_mb:.1f}")
+
+
+def main():
+    template_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TEMPLATE
+    target_rows = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_ROWS
+
+    from import_excel import UPLOAD_FOLDER, ensure_upload_folder
+    ensure_upload_folder()
+    template_name = f"bench_{os.path.basename(template_path)}"
+    shutil.copy(template_path, os.path.join(UPLOAD_FOLDER, template_name))
+
+    print(f"Template: {template_path}, ~{target_rows} dòng output (duplicate mode)")
+    try:
+        for engine in ('openpyxl', 'streaming'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--engine', engine, template_name, str(target_rows)],
+                capture_output=True, text=True
+            )
+            line = output.stdout.strip().splitlines()[-1] if output.stdout.strip() else output.stderr.strip()
+            if output.returncode != 0:
+                print(f"{engine:>10}: lỗi - {line}")
+                continue
+            rows, seconds, rss = line.split()
+            print(f"{engine:>10}: {rows} dòng, {seconds}s, peak RSS {rss} MB")
+    finally:
+        os.remove(os.path.join(UPLOAD_FOLDER, template_name))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--engine':
+        run_engine(sys.argv[3], int(sys.argv[4]), sys.argv[2])
+    else:
+        main()
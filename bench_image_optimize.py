@@ -0,0 +1,78 @@
+"""
+Benchmark nén ảnh: so sánh nén bằng thread pool (MAX_WORKERS luồng, bị GIL khóa)
+và process pool (IMAGE_PROCESS_WORKERS process) như pipeline upload S3 đang dùng.
+
+Chạy:
+    python bench_image_optimize.py [số_ảnh]
+
+Ảnh mẫu (JPEG/PNG nhiều kích thước) được sinh trong memory nên không cần mạng hay S3.
+"""
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+DEFAULT_IMAGES = 1000
+SAMPLE_SIZES = ((1500, 1500), (1000, 1000), (800, 600), (500, 500))
+# Số ảnh khác nhau được sinh ra, các ảnh còn lại lặp lại từ tập này
+DISTINCT_SAMPLES = 24
+
+
+def make_sample(index):
+    """Ảnh gradient + noise (gần với ảnh sản phẩm hơn ảnh một màu)"""
+    width, height = SAMPLE_SIZES[index % len(SAMPLE_SIZES)]
+    image = Image.merge('RGB', (
+        Image.linear_gradient('L').resize((width, height)),
+        Image.effect_noise((width, height), 40 + index),
+        Image.radial_gradient('L').resize((width, height)),
+    ))
+    buffer = io.BytesIO()
+    if index % 4 == 3:
+        image.save(buffer, format='PNG')
+        return (f'sample_{index}.png', buffer.getvalue())
+    image.save(buffer, format='JPEG', quality=95)
+    return (f'sample_{index}.jpg', buffer.getvalue())
+
+
+def run_threads(samples):
+    from aws_s3_handler import MAX_WORKERS, optimize_image_bytes
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(lambda sample: optimize_image_bytes(*sample), samples))
+
+
+def run_processes(samples):
+    from aws_s3_handler import AWSS3Uploader, OPTIMIZE_WORKERS
+
+    # Giống stage nén của pipeline: các luồng gửi ảnh sang process pool và chờ kết quả
+    uploader = AWSS3Uploader.__new__(AWSS3Uploader)
+    with ThreadPoolExecutor(max_workers=OPTIMIZE_WORKERS) as executor:
+        return list(executor.map(lambda sample: uploader.optimize_image(*sample), samples))
+
+
+def main():
+    image_count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_IMAGES
+
+    import aws_s3_handler
+
+    distinct = [make_sample(i) for i in range(min(DISTINCT_SAMPLES, image_count))]
+    samples = [distinct[i % len(distinct)] for i in range(image_count)]
+    input_mb = sum(len(content) for _, content in samples) / 1024 / 1024
+
+    # Khởi động process pool trước để không tính thời gian tạo process
+    aws_s3_handler._get_image_process_pool().submit(int).result()
+
+    print(f"{image_count} ảnh ({input_mb:.1f} MB), {aws_s3_handler.MAX_WORKERS} luồng / "
+          f"{aws_s3_handler.IMAGE_PROCESS_WORKERS} process")
+    for name, runner in (('threads', run_threads), ('processes', run_processes)):
+        started = time.perf_counter()
+        results = runner(samples)
+        elapsed = time.perf_counter() - started
+        ok = sum(1 for result in results if result is not None)
+        print(f"{name:>10}: {ok}/{image_count} ảnh, {elapsed:.2f}s, {ok / elapsed:.1f} ảnh/s")
+
+
+if __name__ == '__main__':
+    main()
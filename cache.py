@@ -0,0 +1,95 @@
+"""
+Cache dùng chung cho các API đọc dữ liệu (TTL + LRU)
+và hook để invalidate theo collection khi có thao tác ghi
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Cache TTL + LRU, key gồm (namespace, key) để invalidate theo namespace (collection)"""
+
+    def __init__(self, maxsize=512, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, namespace, key):
+        """Trả về value đã cache hoặc None nếu không có / đã hết hạn"""
+        full_key = (namespace, key)
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(full_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._data[full_key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(full_key)
+            self.hits += 1
+            return value
+
+    def set(self, namespace, key, value):
+        full_key = (namespace, key)
+        with self._lock:
+            self._data[full_key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(full_key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, namespace):
+        """Xóa tất cả entry của một namespace"""
+        with self._lock:
+            keys = [k for k in self._data if k[0] == namespace]
+            for k in keys:
+                del self._data[k]
+            self.invalidations += 1
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+# Listener được gọi mỗi khi một collection sản phẩm bị ghi (crawl upsert, note, backfill...)
+_write_listeners = []
+
+
+def on_collection_write(listener):
+    """Đăng ký listener(collection_name, document) - dùng được như decorator"""
+    _write_listeners.append(listener)
+    return listener
+
+
+def notify_collection_write(collection_name, document=None):
+    """Báo cho các cache biết collection vừa thay đổi"""
+    for listener in list(_write_listeners):
+        try:
+            listener(collection_name, document)
+        except Exception as e:
+            print(f"Lỗi trong cache listener cho collection '{collection_name}': {e}")
@@ -0,0 +1,138 @@
+"""
+Job fill Excel chạy nền: submit trả về job ID ngay, pool worker giới hạn chạy
+iter_products + fill_excel_with_data, tiến độ được poll hoặc stream qua SSE
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import FILL_JOB_WORKERS, FILL_JOB_RETENTION_SECONDS
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+FINISHED_STATES = (JOB_DONE, JOB_FAILED)
+
+_executor = ThreadPoolExecutor(max_workers=FILL_JOB_WORKERS, thread_name_prefix='fill-job')
+_jobs = {}
+_jobs_lock = threading.Lock()
+# Báo cho các SSE stream biết có job thay đổi tiến độ
+_jobs_changed = threading.Condition(_jobs_lock)
+
+
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        job.update(fields)
+        job['updated_at'] = time.time()
+        job['version'] += 1
+        _jobs_changed.notify_all()
+
+
+def _prune_finished_jobs():
+    """Xóa các job đã xong quá FILL_JOB_RETENTION_SECONDS (gọi khi đang giữ lock)"""
+    cutoff = time.time() - FILL_JOB_RETENTION_SECONDS
+    expired = [
+        job_id for job_id, job in _jobs.items()
+        if job['status'] in FINISHED_STATES and job['finished_at'] < cutoff
+    ]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+def _run_fill_job(job_id, params):
+    from walmart import iter_products
+    from import_excel import fill_excel_with_data, fill_excel_batch
+
+    _update_job(job_id, status=JOB_RUNNING, phase='loading_products', started_at=time.time())
+    try:
+        products = iter_products(params['collection'], unique_names=params['fill_mode'] == 'duplicate')
+
+        def on_progress(phase, rows_filled, total_rows):
+            _update_job(job_id, phase=phase, rows_filled=rows_filled, total_rows=total_rows)
+
+        if params.get('targets'):
+            result = fill_excel_batch(
+                params['targets'], products, params['column'], params['start_row'], params['fill_mode'],
+                params['sku_column'], params['batch_column'], params['image_column'],
+                params['fill_images_from_s3'], params['engine'], progress_callback=on_progress
+            )
+        else:
+            result = fill_excel_with_data(
+                params['filename'], products, params['column'], params['start_row'], params['fill_mode'],
+                params['sku_column'], params['batch_column'], params['image_column'],
+                params['fill_images_from_s3'], params['engine'], progress_callback=on_progress,
+                sheet_name=params.get('sheet_name')
+            )
+        if result.get('success'):
+            _update_job(job_id, status=JOB_DONE, phase='done', result=result,
+                        rows_filled=result['filled_count'], finished_at=time.time())
+        else:
+            _update_job(job_id, status=JOB_FAILED, phase='failed', error=result.get('error'),
+                        finished_at=time.time())
+    except Exception as e:
+        print(f"Fill job {job_id} lỗi: {e}")
+        _update_job(job_id, status=JOB_FAILED, phase='failed', error=str(e), finished_at=time.time())
+
+
+def submit_fill_job(params):
+    """Đưa job fill vào hàng đợi (params['targets'] = batch nhiều file), trả về job ID"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _jobs_lock:
+        _prune_finished_jobs()
+        _jobs[job_id] = {
+            'job_id': job_id,
+            'status': JOB_QUEUED,
+            'phase': 'queued',
+            'filename': params.get('filename'),
+            'targets': params.get('targets'),
+            'collection': params['collection'],
+            'fill_mode': params['fill_mode'],
+            'rows_filled': 0,
+            'total_rows': 0,
+            'result': None,
+            'error': None,
+            'created_at': now,
+            'started_at': None,
+            'finished_at': None,
+            'updated_at': now,
+            'version': 0
+        }
+    _executor.submit(_run_fill_job, job_id, params)
+    return job_id
+
+
+def get_fill_job(job_id):
+    """Bản sao trạng thái job, None nếu không có (hoặc đã hết hạn)"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+def wait_for_fill_job_change(job_id, last_version, timeout=15):
+    """
+    Chờ tới khi job có version mới hơn last_version (hoặc hết timeout).
+    Trả về bản sao trạng thái job, None nếu job không tồn tại.
+    """
+    deadline = time.time() + timeout
+    with _jobs_lock:
+        while True:
+            job = _jobs.get(job_id)
+            if job is None or job['version'] > last_version:
+                return dict(job) if job is not None else None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return dict(job)
+            _jobs_changed.wait(remaining)
+
+
+def list_fill_jobs():
+    with _jobs_lock:
+        _prune_finished_jobs()
+        return sorted((dict(job) for job in _jobs.values()), key=lambda job: job['created_at'], reverse=True)
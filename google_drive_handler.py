@@ -5,11 +5,16 @@ Hỗ trợ batch upload và folder management
 
 import os
 import io
-import requests
-from typing import List, Optional, Dict
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Optional, Dict
 import tempfile
 from datetime import datetime
 
+from config import DRIVE_UPLOAD_WORKERS, DRIVE_API_RETRIES
+from http_fetcher import fetch_url
+
 # Google Drive API imports
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
@@ -17,6 +22,12 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.exceptions import RefreshError
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+
+DRIVE_FOLDER_MIME = 'application/vnd.google-apps.folder'
+DRIVE_BATCH_LIMIT = 100  # Drive API cho phép tối đa 100 request trong một batch
+DRIVE_LIST_PAGE_SIZE = 1000
 
 
 class GoogleDriveUploader:
@@ -25,18 +36,28 @@ class GoogleDriveUploader:
     # OAuth 2.0 scopes cần thiết
     SCOPES = ['https://www.googleapis.com/auth/drive.file']
     
-    def __init__(self, credentials_file: str = 'credentials.json', token_file: str = 'token.json'):
+    def __init__(self, credentials_file: str = 'credentials.json', token_file: str = 'token.json',
+                 service_factory: Optional[Callable] = None):
         """
         Initialize Google Drive uploader
         
         Args:
             credentials_file: Path đến file credentials.json từ Google Cloud Console
             token_file: Path đến file token.json (sẽ được tạo tự động)
+            service_factory: Hàm tạo Drive service mới (vd. fake service khi test), None = dùng OAuth
         """
         self.credentials_file = credentials_file
         self.token_file = token_file
         self.service = None
-        self._authenticate()
+        self.creds = None
+        self._service_factory = service_factory
+        # Service riêng cho từng luồng upload (httplib2.Http không thread-safe)
+        self._local = threading.local()
+        self._owner_thread = threading.get_ident()
+        if service_factory:
+            self.service = service_factory()
+        else:
+            self._authenticate()
     
     def _authenticate(self):
         """Authenticate với Google Drive API"""
@@ -68,9 +89,27 @@ class GoogleDriveUploader:
                 token.write(creds.to_json())
         
         # Build service object
+        self.creds = creds
         self.service = build('drive', 'v3', credentials=creds)
         print("✅ Google Drive authentication successful!")
     
+    def _get_service(self):
+        """
+        Drive service cho luồng hiện tại: luồng tạo uploader dùng self.service,
+        các luồng khác mỗi luồng một service với authorized http riêng
+        """
+        if threading.get_ident() == self._owner_thread:
+            return self.service
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            if self._service_factory:
+                service = self._service_factory()
+            else:
+                http = AuthorizedHttp(self.creds, http=httplib2.Http())
+                service = build('drive', 'v3', http=http)
+            self._local.service = service
+        return service
+    
     def create_folder(self, folder_name: str, parent_folder_id: Optional[str] = None) -> str:
         """
         Tạo folder trên Google Drive
@@ -128,6 +167,73 @@ class GoogleDriveUploader:
             print(f"❌ Error finding folder '{folder_name}': {str(e)}")
             return None
     
+    def list_child_folders(self, parent_folder_id: Optional[str] = None) -> Dict[str, str]:
+        """
+        Liệt kê toàn bộ folder con (1 query có phân trang thay vì 1 query cho mỗi tên folder)
+        
+        Args:
+            parent_folder_id: ID của parent folder (None = root)
+            
+        Returns:
+            Dict[str, str]: {tên folder: folder ID}
+        """
+        query = f"mimeType='{DRIVE_FOLDER_MIME}' and '{parent_folder_id or 'root'}' in parents and trashed=false"
+        folders = {}
+        page_token = None
+        while True:
+            response = self.service.files().list(
+                q=query,
+                fields='nextPageToken, files(id, name)',
+                pageSize=DRIVE_LIST_PAGE_SIZE,
+                pageToken=page_token
+            ).execute(num_retries=DRIVE_API_RETRIES)
+            for item in response.get('files', []):
+                folders.setdefault(item['name'], item['id'])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return folders
+    
+    def create_folders(self, folder_names: List[str], parent_folder_id: Optional[str] = None) -> Dict[str, str]:
+        """
+        Tạo nhiều folder bằng BatchHttpRequest (tối đa DRIVE_BATCH_LIMIT request mỗi batch)
+        
+        Args:
+            folder_names: Danh sách tên folder (không trùng nhau)
+            parent_folder_id: ID của parent folder (None = root)
+            
+        Returns:
+            Dict[str, str]: {tên folder: folder ID}, folder không tạo được không có trong kết quả
+        """
+        created = {}
+        failed = []
+        
+        def on_response(request_id, response, exception):
+            if exception is not None or not (response or {}).get('id'):
+                failed.append(request_id)
+            else:
+                created[request_id] = response['id']
+        
+        for start in range(0, len(folder_names), DRIVE_BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for folder_name in folder_names[start:start + DRIVE_BATCH_LIMIT]:
+                folder_metadata = {'name': folder_name, 'mimeType': DRIVE_FOLDER_MIME}
+                if parent_folder_id:
+                    folder_metadata['parents'] = [parent_folder_id]
+                batch.add(self.service.files().create(body=folder_metadata, fields='id'), request_id=folder_name)
+            batch.execute()
+        
+        # Request lỗi trong batch (rate limit...) được tạo lại từng cái
+        for folder_name in failed:
+            try:
+                folder_id = self.create_folder(folder_name, parent_folder_id)
+            except Exception:
+                folder_id = None
+            if folder_id:
+                created[folder_name] = folder_id
+        
+        print(f"✅ Created {len(created)} folders")
+        return created
+    
     def get_or_create_folder(self, folder_name: str, parent_folder_id: Optional[str] = None) -> str:
         """
         Lấy folder ID hoặc tạo mới nếu chưa tồn tại
@@ -157,19 +263,14 @@ class GoogleDriveUploader:
             Optional[io.BytesIO]: Image data nếu thành công, None nếu lỗi
         """
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            response = requests.get(image_url, headers=headers, timeout=30)
-            response.raise_for_status()
+            # Session dùng chung (keep-alive theo host, retry/backoff, giới hạn dung lượng)
+            content, content_type = fetch_url(image_url)
             
             # Kiểm tra content type
-            content_type = response.headers.get('content-type', '')
             if not content_type.startswith('image/'):
                 print(f"⚠️ Warning: URL may not be an image: {content_type}")
             
-            return io.BytesIO(response.content)
+            return io.BytesIO(content)
             
         except Exception as e:
             print(f"❌ Error downloading image from {image_url}: {str(e)}")
@@ -200,11 +301,11 @@ class GoogleDriveUploader:
             
             # Upload to Drive
             media = MediaIoBaseUpload(image_data, mimetype='image/jpeg', resumable=True)
-            file = self.service.files().create(
+            file = self._get_service().files().create(
                 body=file_metadata,
                 media_body=media,
                 fields='id'
-            ).execute()
+            ).execute(num_retries=DRIVE_API_RETRIES)
             
             file_id = file.get('id')
             print(f"✅ Uploaded '{filename}' to Google Drive: {file_id}")
@@ -214,14 +315,16 @@ class GoogleDriveUploader:
             print(f"❌ Error uploading image '{filename}': {str(e)}")
             return None
     
-    def batch_upload_images(self, image_data_list: List[Dict], base_folder_name: str = None, group_by_product: bool = True) -> Dict:
+    def batch_upload_images(self, image_data_list: List[Dict], base_folder_name: str = None, group_by_product: bool = True,
+                            max_workers: int = DRIVE_UPLOAD_WORKERS) -> Dict:
         """
-        Batch upload multiple images
+        Batch upload multiple images (song song, max_workers luồng)
         
         Args:
             image_data_list: List of dicts với keys: 'url', 'filename', 'product_name'
             base_folder_name: Tên folder chính để chứa tất cả (None = root)
             group_by_product: Nếu True, tạo subfolder cho mỗi product
+            max_workers: Số luồng upload song song
             
         Returns:
             Dict: Results với success_count, failed_count, uploaded_files
@@ -240,108 +343,80 @@ class GoogleDriveUploader:
             if base_folder_name:
                 base_folder_id = self.get_or_create_folder(base_folder_name)
             
-            print(f"🚀 Starting batch upload of {len(image_data_list)} images...")
+            print(f"🚀 Starting batch upload of {len(image_data_list)} images ({max_workers} workers)...")
+            
+            def failure(filename, error, product_name):
+                failed = {'filename': filename, 'error': error}
+                if product_name is not None:
+                    failed['product'] = product_name
+                results['failed_count'] += 1
+                results['failed_files'].append(failed)
             
+            # (image_data, filename, folder ID, product folder name hoặc None)
+            tasks = []
             if group_by_product:
                 # Group images by product name
                 product_groups = {}
                 for image_data in image_data_list:
                     product_name = image_data.get('product_name', 'Unknown Product')
                     # Clean product name for folder name
-                    import re
                     clean_name = re.sub(r'[^\w\s-]', '', product_name)
                     clean_name = re.sub(r'[-\s]+', '_', clean_name).strip('_')
-                    
-                    if clean_name not in product_groups:
-                        product_groups[clean_name] = []
-                    product_groups[clean_name].append(image_data)
+                    product_groups.setdefault(clean_name, []).append(image_data)
                 
                 print(f"📁 Grouped into {len(product_groups)} product folders")
                 
-                # Create subfolders and upload images
-                product_folder_cache = {}
+                # Lấy toàn bộ folder con 1 lần, folder còn thiếu được tạo bằng batch request
+                product_folder_ids = self.list_child_folders(base_folder_id)
+                missing_folders = [name for name in product_groups if name not in product_folder_ids]
+                if missing_folders:
+                    product_folder_ids.update(self.create_folders(missing_folders, base_folder_id))
+                results['folders_created'] = [name for name in product_groups if product_folder_ids.get(name)]
                 
                 for product_name, images in product_groups.items():
-                    print(f"\n📁 Processing product: {product_name} ({len(images)} images)")
-                    
-                    # Create product subfolder
-                    if product_name not in product_folder_cache:
-                        product_folder_id = self.get_or_create_folder(product_name, base_folder_id)
-                        product_folder_cache[product_name] = product_folder_id
-                        results['folders_created'].append(product_name)
-                        print(f"📁 Created subfolder: {product_name}")
-                    else:
-                        product_folder_id = product_folder_cache[product_name]
-                    
-                    # Upload images to product subfolder
+                    folder_id = product_folder_ids.get(product_name)
                     for i, image_data in enumerate(images, 1):
-                        image_url = image_data.get('url')
                         filename = image_data.get('filename', f'image_{i}.jpg')
-                        
-                        if not image_url:
-                            print(f"⚠️ Skipping {filename}: No image URL")
-                            results['failed_count'] += 1
-                            results['failed_files'].append({
-                                'filename': filename,
-                                'error': 'No image URL',
-                                'product': product_name
-                            })
+                        if not folder_id:
+                            # Không tạo được folder -> báo lỗi cả nhóm thay vì upload vào root
+                            failure(filename, 'Folder creation failed', product_name)
                             continue
-                        
-                        # Upload image to product subfolder
-                        file_id = self.upload_image_from_url(image_url, filename, product_folder_id)
-                        
-                        if file_id:
-                            results['success_count'] += 1
-                            results['uploaded_files'].append({
-                                'filename': filename,
-                                'file_id': file_id,
-                                'product_name': product_name,
-                                'folder': f"{base_folder_name}/{product_name}" if base_folder_name else product_name
-                            })
-                            print(f"✅ {filename} → {product_name}/")
-                        else:
-                            results['failed_count'] += 1
-                            results['failed_files'].append({
-                                'filename': filename,
-                                'error': 'Upload failed',
-                                'product': product_name
-                            })
-                            print(f"❌ Failed: {filename}")
-            
+                        tasks.append((image_data, filename, folder_id, product_name))
             else:
-                # Original logic - no grouping
                 for i, image_data in enumerate(image_data_list, 1):
-                    print(f"\n📷 Processing image {i}/{len(image_data_list)}: {image_data.get('filename', 'Unknown')}")
-                    
-                    image_url = image_data.get('url')
                     filename = image_data.get('filename', f'image_{i}.jpg')
-                    
-                    if not image_url:
-                        print(f"⚠️ Skipping item {i}: No image URL")
-                        results['failed_count'] += 1
-                        results['failed_files'].append({
-                            'filename': filename,
-                            'error': 'No image URL'
-                        })
+                    tasks.append((image_data, filename, base_folder_id, None))
+            
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                for task in tasks:
+                    image_data, filename, folder_id, product_name = task
+                    if not image_data.get('url'):
+                        print(f"⚠️ Skipping {filename}: No image URL")
+                        failure(filename, 'No image URL', product_name)
+                        continue
+                    future = executor.submit(self.upload_image_from_url, image_data['url'], filename, folder_id)
+                    futures[future] = task
+                
+                # Kết quả được gom ở luồng chính nên không cần lock
+                for future in as_completed(futures):
+                    image_data, filename, folder_id, product_name = futures[future]
+                    file_id = future.result()
+                    if not file_id:
+                        failure(filename, 'Upload failed', product_name)
+                        print(f"❌ Failed: {filename}")
                         continue
                     
-                    # Upload image
-                    file_id = self.upload_image_from_url(image_url, filename, base_folder_id)
-                    
-                    if file_id:
-                        results['success_count'] += 1
-                        results['uploaded_files'].append({
-                            'filename': filename,
-                            'file_id': file_id,
-                            'product_name': image_data.get('product_name', '')
-                        })
-                    else:
-                        results['failed_count'] += 1
-                        results['failed_files'].append({
-                            'filename': filename,
-                            'error': 'Upload failed'
-                        })
+                    results['success_count'] += 1
+                    uploaded = {
+                        'filename': filename,
+                        'file_id': file_id,
+                        'product_name': product_name if product_name is not None else image_data.get('product_name', '')
+                    }
+                    if product_name is not None:
+                        uploaded['folder'] = f"{base_folder_name}/{product_name}" if base_folder_name else product_name
+                        print(f"✅ {filename} → {product_name}/")
+                    results['uploaded_files'].append(uploaded)
             
             print(f"\n🎉 Batch upload completed!")
             print(f"📁 Created {len(results.get('folders_created', []))} product folders")
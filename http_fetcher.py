@@ -0,0 +1,107 @@
+"""
+HTTP client tải ảnh dùng chung cho S3 pipeline và Google Drive:
+- một requests.Session với connection pool keep-alive theo host (không bắt tay TCP/TLS lại cho mỗi ảnh)
+- retry + exponential backoff cho lỗi kết nối, 429 và 5xx (tôn trọng Retry-After)
+- giới hạn số request đồng thời của cả process
+- đọc stream, dừng ngay khi ảnh vượt quá dung lượng tối đa
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import (
+    HTTP_FETCH_MAX_CONCURRENCY, HTTP_FETCH_POOL_PER_HOST, HTTP_FETCH_POOL_HOSTS, HTTP_FETCH_MAX_BYTES,
+    HTTP_FETCH_TIMEOUT, HTTP_FETCH_RETRIES, HTTP_FETCH_BACKOFF
+)
+
+DEFAULT_USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class FetchTooLargeError(Exception):
+    """Ảnh vượt quá dung lượng tối đa cho phép"""
+
+
+class HttpFetcher:
+    """Tải nội dung URL qua session dùng chung, an toàn khi gọi từ nhiều luồng"""
+
+    def __init__(self, max_concurrency=HTTP_FETCH_MAX_CONCURRENCY, pool_per_host=HTTP_FETCH_POOL_PER_HOST,
+                 pool_hosts=HTTP_FETCH_POOL_HOSTS, max_bytes=HTTP_FETCH_MAX_BYTES, timeout=HTTP_FETCH_TIMEOUT, retries=HTTP_FETCH_RETRIES,
+                 backoff=HTTP_FETCH_BACKOFF):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        # pool_connections = số host giữ pool, pool_maxsize = số connection giữ lại cho mỗi host,
+        # pool_block để không mở vượt quá
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_per_host,
+                              max_retries=retry, pool_block=True)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = DEFAULT_USER_AGENT
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, url, headers=None):
+        """
+        Tải URL, trả về (content_bytes, content_type).
+        Raise requests.RequestException nếu lỗi (sau khi đã retry), FetchTooLargeError nếu quá max_bytes.
+        """
+        with self._slots:
+            with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+
+                content_length = response.headers.get('Content-Length')
+                if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+                    raise FetchTooLargeError(f"{url}: {content_length} bytes > {self.max_bytes}")
+
+                chunks = []
+                total = 0
+                for chunk in response.iter_content(READ_CHUNK_SIZE):
+                    total += len(chunk)
+                    if total > self.max_bytes:
+                        raise FetchTooLargeError(f"{url}: > {self.max_bytes} bytes")
+                    chunks.append(chunk)
+
+                return b''.join(chunks), response.headers.get('Content-Type', '')
+
+    def close(self):
+        self.session.close()
+
+
+_fetcher = None
+_fetcher_pid = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    """Fetcher dùng chung cho cả process (tạo lazy, tạo mới sau khi fork)"""
+    global _fetcher, _fetcher_pid
+    pid = os.getpid()
+    if _fetcher is not None and _fetcher_pid == pid:
+        return _fetcher
+    with _fetcher_lock:
+        if _fetcher is None or _fetcher_pid != pid:
+            _fetcher = HttpFetcher()
+            _fetcher_pid = pid
+    return _fetcher
+
+
+def fetch_url(url, headers=None):
+    """Tải URL bằng fetcher dùng chung, trả về (content_bytes, content_type)"""
+    return get_fetcher().fetch(url, headers=headers)
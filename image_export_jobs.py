@@ -0,0 +1,260 @@
+"""
+Job export ảnh sản phẩm lên S3 chạy nền, có manifest lưu trong MongoDB để resume:
+- image_export_jobs: trạng thái job, phase, số item theo state
+- image_export_items: mỗi URL ảnh của collection một item (pending/downloaded/uploaded/failed + lý do)
+Manifest được tạo bằng cursor qua toàn bộ collection. Chạy lại (resume) chỉ xử lý các item chưa
+uploaded, nên job bị dừng giữa chừng (lỗi, restart server) tiếp tục đúng chỗ cũ.
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import UpdateOne
+
+from config import get_database, IMAGE_EXPORT_JOB_WORKERS, IMAGE_EXPORT_STALE_SECONDS
+
+EXPORT_JOBS_COLLECTION = 'image_export_jobs'
+EXPORT_ITEMS_COLLECTION = 'image_export_items'
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+# Job queued/running nhưng không cập nhật quá IMAGE_EXPORT_STALE_SECONDS (server restart...)
+JOB_INTERRUPTED = 'interrupted'
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_INTERRUPTED)
+
+ITEM_PENDING = 'pending'
+ITEM_DOWNLOADED = 'downloaded'
+ITEM_UPLOADED = 'uploaded'
+ITEM_FAILED = 'failed'
+ITEM_STATES = (ITEM_PENDING, ITEM_DOWNLOADED, ITEM_UPLOADED, ITEM_FAILED)
+
+MANIFEST_WRITE_BATCH = 1000
+EXPORT_CHUNK_SIZE = 200      # số item mỗi lượt chạy pipeline (cũng là nhịp cập nhật tiến độ)
+ITEM_FLUSH_EVERY = 100       # số thay đổi state gom lại trước khi ghi manifest
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_EXPORT_JOB_WORKERS, thread_name_prefix='image-export')
+# Job đang chạy trong process này (tránh chạy trùng một job)
+_active_jobs = set()
+_active_lock = threading.Lock()
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def _collections():
+    global _indexes_ready
+    db = get_database()
+    jobs, items = db[EXPORT_JOBS_COLLECTION], db[EXPORT_ITEMS_COLLECTION]
+    if not _indexes_ready:
+        with _indexes_lock:
+            if not _indexes_ready:
+                items.create_index([('job_id', 1), ('url', 1)], unique=True, name='job_url_unique')
+                items.create_index([('job_id', 1), ('state', 1), ('_id', 1)], name='job_state')
+                jobs.create_index([('collection', 1), ('folder_name', 1), ('status', 1)], name='collection_folder_status')
+                jobs.create_index([('created_at', -1)], name='created_at')
+                _indexes_ready = True
+    return jobs, items
+
+
+def _public_job(job):
+    """Trạng thái job để trả về API / SSE (job queued/running bị bỏ dở hiện là interrupted)"""
+    job = dict(job)
+    job['job_id'] = job.pop('_id')
+    if job['status'] in (JOB_QUEUED, JOB_RUNNING) and job['updated_at'] < time.time() - IMAGE_EXPORT_STALE_SECONDS:
+        with _active_lock:
+            if job['job_id'] not in _active_jobs:
+                job['status'] = JOB_INTERRUPTED
+    return job
+
+
+def _update_job(job_id, **fields):
+    fields['updated_at'] = time.time()
+    jobs, _ = _collections()
+    jobs.update_one({'_id': job_id}, {'$set': fields, '$inc': {'version': 1}})
+
+
+def _refresh_counts(job_id, **fields):
+    """Đếm item theo state, cập nhật vào job (đồng thời là heartbeat của job đang chạy)"""
+    _, items = _collections()
+    counts = {state: 0 for state in ITEM_STATES}
+    for row in items.aggregate([{'$match': {'job_id': job_id}}, {'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+        counts[row['_id']] = row['count']
+    _update_job(job_id, counts=counts, total_items=sum(counts.values()), **fields)
+    return counts
+
+
+def _build_manifest(job):
+    """Tạo item cho mọi URL ảnh của collection (idempotent: item đã có giữ nguyên state)"""
+    from walmart import iter_products
+
+    _, items = _collections()
+    operations = []
+    seen = 0
+    for product in iter_products(job['collection']):
+        image_url = product.get('image')
+        if not isinstance(image_url, str) or not image_url.strip():
+            continue
+        operations.append(UpdateOne(
+            {'job_id': job['_id'], 'url': image_url},
+            {'$setOnInsert': {
+                'state': ITEM_PENDING,
+                'product_name': product.get('name'),
+                's3_url': None,
+                'reason': None,
+                'updated_at': time.time()
+            }},
+            upsert=True
+        ))
+        seen += 1
+        if len(operations) >= MANIFEST_WRITE_BATCH:
+            items.bulk_write(operations, ordered=False)
+            operations = []
+            _update_job(job['_id'], manifest_products=seen)
+    if operations:
+        items.bulk_write(operations, ordered=False)
+    _refresh_counts(job['_id'], manifest_complete=True, manifest_products=seen)
+
+
+def _run_image_export(job_id, retry_failed):
+    from aws_s3_handler import AWSS3Uploader
+
+    jobs, items = _collections()
+    try:
+        _update_job(job_id, status=JOB_RUNNING, phase='building_manifest', started_at=time.time(),
+                    finished_at=None, error=None)
+        job = jobs.find_one({'_id': job_id})
+        if not job.get('manifest_complete'):
+            _build_manifest(job)
+
+        uploader = AWSS3Uploader()
+        states = [ITEM_PENDING, ITEM_DOWNLOADED] + ([ITEM_FAILED] if retry_failed else [])
+        _refresh_counts(job_id, phase='exporting')
+
+        pending_updates = []
+        updates_lock = threading.Lock()
+
+        def flush_updates():
+            # Giữ lock khi ghi để thứ tự downloaded -> uploaded của một URL không bị đảo
+            with updates_lock:
+                if pending_updates:
+                    items.bulk_write(pending_updates, ordered=True)
+                    pending_updates.clear()
+
+        def on_item(url, state, s3_url, reason):
+            with updates_lock:
+                pending_updates.append(UpdateOne(
+                    {'job_id': job_id, 'url': url},
+                    {'$set': {'state': state, 's3_url': s3_url, 'reason': reason, 'updated_at': time.time()}}
+                ))
+                should_flush = len(pending_updates) >= ITEM_FLUSH_EVERY
+            if should_flush:
+                flush_updates()
+
+        # Duyệt theo _id tăng dần: item lỗi trong lượt này không bị lấy lại trong cùng lượt
+        last_id = None
+        while True:
+            query = {'job_id': job_id, 'state': {'$in': states}}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            chunk = list(items.find(query, {'url': 1}).sort('_id', 1).limit(EXPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            last_id = chunk[-1]['_id']
+            uploader.run_image_pipeline([item['url'] for item in chunk], folder=job['folder_name'], on_item=on_item)
+            flush_updates()
+            _refresh_counts(job_id)
+
+        _refresh_counts(job_id, status=JOB_DONE, phase='done', finished_at=time.time())
+    except Exception as e:
+        print(f"Image export job {job_id} lỗi: {e}")
+        _update_job(job_id, status=JOB_FAILED, phase='failed', error=str(e), finished_at=time.time())
+    finally:
+        with _active_lock:
+            _active_jobs.discard(job_id)
+
+
+def _start(job_id, retry_failed=True):
+    with _active_lock:
+        if job_id in _active_jobs:
+            return
+        _active_jobs.add(job_id)
+    _executor.submit(_run_image_export, job_id, retry_failed)
+
+
+def submit_image_export(collection_name, folder_name):
+    """
+    Tạo job export ảnh của collection vào folder S3, trả về job ID.
+    Nếu đã có job chưa xong cho cùng collection + folder thì dùng lại (đang chạy) hoặc resume (bị ngắt).
+    """
+    jobs, _ = _collections()
+    existing = jobs.find_one(
+        {'collection': collection_name, 'folder_name': folder_name, 'status': {'$in': [JOB_QUEUED, JOB_RUNNING]}},
+        sort=[('created_at', -1)]
+    )
+    if existing is not None:
+        if _public_job(existing)['status'] == JOB_INTERRUPTED:
+            resume_image_export(existing['_id'])
+        return existing['_id']
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    jobs.insert_one({
+        '_id': job_id,
+        'collection': collection_name,
+        'folder_name': folder_name,
+        'status': JOB_QUEUED,
+        'phase': 'queued',
+        'manifest_complete': False,
+        'manifest_products': 0,
+        'counts': {state: 0 for state in ITEM_STATES},
+        'total_items': 0,
+        'error': None,
+        'created_at': now,
+        'started_at': None,
+        'finished_at': None,
+        'updated_at': now,
+        'version': 0
+    })
+    _start(job_id)
+    return job_id
+
+
+def resume_image_export(job_id, retry_failed=True):
+    """
+    Chạy tiếp job (item pending/downloaded, và failed nếu retry_failed), item đã uploaded giữ nguyên.
+    Trả về trạng thái job, None nếu không có job.
+    """
+    job = get_image_export(job_id)
+    if job is None:
+        return None
+    if job['status'] in (JOB_QUEUED, JOB_RUNNING):
+        return job
+    _update_job(job_id, status=JOB_QUEUED, phase='queued', error=None)
+    _start(job_id, retry_failed)
+    return get_image_export(job_id)
+
+
+def get_image_export(job_id):
+    """Trạng thái job, None nếu không có"""
+    jobs, _ = _collections()
+    job = jobs.find_one({'_id': job_id})
+    return _public_job(job) if job is not None else None
+
+
+def list_image_exports(limit=20):
+    jobs, _ = _collections()
+    return [_public_job(job) for job in jobs.find().sort('created_at', -1).limit(limit)]
+
+
+def list_image_export_items(job_id, state=None, limit=100):
+    """Item của job (lọc theo state, vd. 'failed' để xem lý do lỗi)"""
+    _, items = _collections()
+    query = {'job_id': job_id}
+    if state:
+        query['state'] = state
+    cursor = items.find(query, {'_id': 0, 'job_id': 0}).sort('_id', 1).limit(limit)
+    return list(cursor)
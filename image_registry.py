@@ -0,0 +1,90 @@
+"""
+Registry ảnh đã upload lên S3 trong MongoDB, theo URL nguồn và hash nội dung ảnh gốc.
+Mỗi document là một object S3 (bucket + key) kèm các URL nguồn đã cho ra object đó, nhờ vậy
+upload lại cùng ảnh (cùng URL, hoặc URL khác nhưng cùng nội dung) không phải tải/nén/upload lại:
+- object đã có đúng key đích -> bỏ qua
+- object ở folder khác -> copy server-side (copy_object) sang key mới
+"""
+
+import hashlib
+import threading
+from datetime import datetime
+
+from config import get_database
+
+IMAGE_REGISTRY_COLLECTION = 'image_registry'
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def _registry_collection():
+    global _indexes_ready
+    collection = get_database()[IMAGE_REGISTRY_COLLECTION]
+    if not _indexes_ready:
+        with _indexes_lock:
+            if not _indexes_ready:
+                collection.create_index([('bucket', 1), ('key', 1)], unique=True, name='bucket_key_unique')
+                collection.create_index([('bucket', 1), ('source_urls', 1)], name='bucket_source_url')
+                collection.create_index([('bucket', 1), ('content_hash', 1)], name='bucket_content_hash')
+                _indexes_ready = True
+    return collection
+
+
+def content_hash(content):
+    """Hash nội dung ảnh gốc (trước khi nén)"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def find_image(bucket, source_url=None, content_digest=None, preferred_key=None):
+    """
+    Tìm object đã upload theo URL nguồn hoặc hash nội dung (truyền một trong hai).
+    Ưu tiên object có key = preferred_key (ảnh đã có sẵn ở key đích), None nếu chưa có.
+    """
+    query = {'bucket': bucket}
+    if source_url is not None:
+        query['source_urls'] = source_url
+    else:
+        query['content_hash'] = content_digest
+    collection = _registry_collection()
+    if preferred_key:
+        entry = collection.find_one(dict(query, key=preferred_key))
+        if entry is not None:
+            return entry
+    return collection.find_one(query, sort=[('registered_at', -1)])
+
+
+def register_image(bucket, key, source_url, content_digest, size=None, content_type=None):
+    """
+    Ghi (hoặc cập nhật) object S3 vào registry, thêm source_url vào danh sách URL nguồn.
+    Nếu key bị ghi đè bằng nội dung khác thì các URL nguồn cũ bị bỏ (không còn trỏ tới ảnh này).
+    """
+    collection = _registry_collection()
+    fields = {
+        'content_hash': content_digest,
+        'size': size,
+        'content_type': content_type,
+        'registered_at': datetime.now()
+    }
+    result = collection.update_one(
+        {'bucket': bucket, 'key': key, 'content_hash': content_digest},
+        {'$set': fields, '$addToSet': {'source_urls': source_url}}
+    )
+    if result.matched_count:
+        return
+    # Object mới hoặc nội dung đã đổi
+    collection.update_one(
+        {'bucket': bucket, 'key': key},
+        {'$set': dict(fields, source_urls=[source_url])},
+        upsert=True
+    )
+
+
+def add_source_url(bucket, key, source_url):
+    """Ghi nhận thêm một URL nguồn cho object đã có (lần sau khớp theo URL, không cần tải)"""
+    _registry_collection().update_one({'bucket': bucket, 'key': key}, {'$addToSet': {'source_urls': source_url}})
+
+
+def forget_image(bucket, key):
+    """Xóa object khỏi registry (object không còn trên S3)"""
+    _registry_collection().delete_one({'bucket': bucket, 'key': key})
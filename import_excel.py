@@ -3,6 +3,10 @@ import os
 from typing import Optional, Dict, Any, List
 from werkzeug.utils import secure_filename
 import uuid
+import hashlib
+import threading
+from itertools import islice
+from config import BATCH_FILL_MAX_WORKERS
 from datetime import datetime
 import numpy as np
 
@@ -115,6 +119,34 @@ def save_uploaded_file(file_storage, custom_filename: Optional[str] = None) -> D
             'error': str(e)
         }
 
+def _sheet_data_summary(sheet_metadata: Optional[Dict[str, Any]], sample_rows: int = 5) -> Dict[str, Any]:
+    """
+    Tóm tắt dữ liệu sheet từ template metadata: dòng 1 là header, số dòng dữ liệu tới dòng cuối
+    có dữ liệu, dữ liệu mẫu lấy từ các dòng header đã đọc sẵn
+    """
+    if not sheet_metadata:
+        # .xls: metadata chỉ có tên sheet
+        return {'total_rows': None, 'total_columns': None, 'columns': [], 'sample_data': []}
+
+    header_rows = sheet_metadata['header_rows']
+    columns = [
+        str(value) if _has_cell_data(value) else f"Unnamed: {index}"
+        for index, value in enumerate(header_rows[0] if header_rows else [])
+    ]
+    sample_data = []
+    for row in header_rows[1:sample_rows + 1]:
+        if any(_has_cell_data(value) for value in row):
+            sample_data.append({
+                column: '' if value is None else (value if isinstance(value, (int, float)) else str(value))
+                for column, value in zip(columns, row)
+            })
+    return {
+        'total_rows': max(sheet_metadata['last_data_row'] - 1, 0),
+        'total_columns': sheet_metadata['max_column'],
+        'columns': columns,
+        'sample_data': sample_data
+    }
+
 def process_uploaded_excel(file_info: Dict[str, Any]) -> Dict[str, Any]:
     """
     Xử lý và phân tích file Excel đã upload
@@ -131,28 +163,19 @@ def process_uploaded_excel(file_info: Dict[str, Any]) -> Dict[str, Any]:
         
         file_path = file_info['file_path']
         
-        # Lấy thông tin Excel
+        # Lấy thông tin Excel (metadata parse một lần, được cache cho preview/fill sau)
         excel_info = get_excel_info(file_path)
+        metadata = get_template_metadata(file_path)
         
-        # Đọc sheet đầu tiên
-        df = read_excel_file(file_path)
-        
-        # Tạo summary
+        # Tóm tắt sheet đầu tiên từ metadata, không đọc lại cả sheet bằng pandas
+        first_sheet = metadata['sheets'].get(metadata['sheet_names'][0]) if metadata['sheet_names'] else None
         result = {
             'success': True,
             'file_info': file_info,
             'excel_info': excel_info,
-            'data_summary': {
-                'total_rows': len(df),
-                'total_columns': len(df.columns),
-                'columns': list(df.columns),
-                'dtypes': {col: str(dtype) for col, dtype in df.dtypes.items()},
-                'null_counts': {col: int(count) for col, count in df.isnull().sum().items()},
-                'sample_data': _safe_dict_records(df.head(5)) if not df.empty else []
-            }
+            'data_summary': _sheet_data_summary(first_sheet)
         }
         
-        
         return result
         
     except Exception as e:
@@ -196,6 +219,7 @@ def delete_uploaded_file(filename: str) -> bool:
         file_path = os.path.join(UPLOAD_FOLDER, secure_filename(filename))
         if os.path.exists(file_path):
             os.remove(file_path)
+            invalidate_template_metadata(file_path)
             return True
         else:
             return False
@@ -234,6 +258,144 @@ def read_excel_file(file_path: str, sheet_name: Optional[str] = None) -> pd.Data
     except Exception as e:
         raise
 
+# Cache metadata của template đã parse theo nội dung file: {sha256: metadata}
+# Upload lại cùng template (tên file mới, nội dung giống) dùng lại metadata, không parse lại.
+# Hash của từng file được nhớ theo (tên file, mtime_ns, size): file bị ghi đè sẽ được hash lại
+TEMPLATE_HEADER_ROWS = 6
+TEMPLATE_METADATA_CACHE_MAX_ENTRIES = 128
+_template_metadata_cache = {}
+_template_hash_cache = {}
+_template_metadata_lock = threading.Lock()
+
+
+def _has_cell_data(value) -> bool:
+    return value is not None and str(value).strip() != ''
+
+
+def _template_cache_key(file_path: str):
+    file_stat = os.stat(file_path)
+    return (os.path.basename(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def file_content_hash(file_path: str) -> str:
+    """SHA-256 nội dung file (đọc theo từng block để không load cả file vào memory)"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _build_sheet_metadata(worksheet) -> Dict[str, Any]:
+    """Đọc một sheet (read-only) một lượt: header, dòng cuối có dữ liệu, vùng dữ liệu và number format từng cột"""
+    from openpyxl.utils import get_column_letter
+
+    header_rows = []
+    style_map = {}
+    max_row = 0
+    max_column = 0
+    last_data_row = 0
+    for row_idx, row in enumerate(worksheet.iter_rows(), 1):
+        max_row = row_idx
+        values = [getattr(cell, 'value', None) for cell in row]
+        max_column = max(max_column, len(values))
+        if any(_has_cell_data(value) for value in values):
+            last_data_row = row_idx
+        if row_idx <= TEMPLATE_HEADER_ROWS:
+            header_rows.append(values)
+        elif row_idx == TEMPLATE_HEADER_ROWS + 1:
+            # Format của dòng dữ liệu đầu tiên (dòng template sẽ được copy khi fill)
+            for col_idx, cell in enumerate(row, 1):
+                number_format = getattr(cell, 'number_format', 'General')
+                if number_format and number_format != 'General':
+                    style_map[get_column_letter(col_idx)] = number_format
+
+    column_letters = [get_column_letter(col_idx) for col_idx in range(1, max_column + 1)]
+    return {
+        'title': worksheet.title,
+        'max_row': max_row,
+        'max_column': max_column,
+        'column_letters': column_letters,
+        'header_rows': header_rows,
+        'last_data_row': last_data_row,
+        'data_range': f"A1:{column_letters[-1]}{last_data_row}" if last_data_row and column_letters else None,
+        'style_map': style_map
+    }
+
+
+def _build_template_metadata(file_path: str) -> Dict[str, Any]:
+    """Parse workbook: tên sheet, sheet active và metadata từng sheet (chỉ phụ thuộc nội dung file)"""
+    metadata = {'sheets': {}}
+
+    if file_path.lower().endswith('.xlsx'):
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(file_path, read_only=True)
+        try:
+            metadata['sheet_names'] = workbook.sheetnames
+            metadata['active_sheet'] = workbook.active.title if workbook.active else None
+            for worksheet in workbook.worksheets:
+                metadata['sheets'][worksheet.title] = _build_sheet_metadata(worksheet)
+        finally:
+            workbook.close()
+    else:
+        # .xls: openpyxl không đọc được, chỉ lấy tên sheet
+        excel_file = pd.ExcelFile(file_path)
+        metadata['sheet_names'] = excel_file.sheet_names
+        metadata['active_sheet'] = excel_file.sheet_names[0] if excel_file.sheet_names else None
+
+    metadata['number_of_sheets'] = len(metadata['sheet_names'])
+    return metadata
+
+
+def get_template_metadata(file_path: str) -> Dict[str, Any]:
+    """
+    Metadata của file Excel đã upload (tên sheet, header, cột, vùng dữ liệu, style map).
+    Parse một lần rồi cache theo nội dung file (SHA-256) cho các lần preview/fill sau.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File không tồn tại: {file_path}")
+
+    file_key = _template_cache_key(file_path)
+    with _template_metadata_lock:
+        content_key = _template_hash_cache.get(file_key)
+    if content_key is None:
+        content_key = file_content_hash(file_path)
+        with _template_metadata_lock:
+            # Bỏ hash cũ của cùng file (file bị ghi đè)
+            for key in [key for key in _template_hash_cache if key[0] == file_key[0]]:
+                del _template_hash_cache[key]
+            if len(_template_hash_cache) >= TEMPLATE_METADATA_CACHE_MAX_ENTRIES:
+                _template_hash_cache.pop(next(iter(_template_hash_cache)))
+            _template_hash_cache[file_key] = content_key
+
+    with _template_metadata_lock:
+        metadata = _template_metadata_cache.get(content_key)
+    if metadata is None:
+        metadata = _build_template_metadata(file_path)
+        with _template_metadata_lock:
+            if len(_template_metadata_cache) >= TEMPLATE_METADATA_CACHE_MAX_ENTRIES:
+                _template_metadata_cache.pop(next(iter(_template_metadata_cache)))
+            _template_metadata_cache[content_key] = metadata
+
+    file_stat = os.stat(file_path)
+    return dict(
+        metadata,
+        filename=os.path.basename(file_path),
+        file_size=file_stat.st_size,
+        mtime=file_stat.st_mtime,
+        content_hash=content_key
+    )
+
+
+def invalidate_template_metadata(filename: str) -> None:
+    """Quên hash đã cache của file (khi file bị xóa), metadata theo nội dung vẫn dùng được cho file giống hệt"""
+    filename = os.path.basename(filename)
+    with _template_metadata_lock:
+        for key in [key for key in _template_hash_cache if key[0] == filename]:
+            del _template_hash_cache[key]
+
+
 def get_excel_info(file_path: str) -> Dict[str, Any]:
     """
     Lấy thông tin về file Excel (số sheet, tên các sheet, etc.)
@@ -248,14 +410,14 @@ def get_excel_info(file_path: str) -> Dict[str, Any]:
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File không tồn tại: {file_path}")
         
-        # Đọc tất cả sheet names
-        excel_file = pd.ExcelFile(file_path)
+        # Tên các sheet lấy từ metadata đã cache
+        metadata = get_template_metadata(file_path)
         
         info = {
             'file_path': file_path,
-            'sheet_names': excel_file.sheet_names,
-            'number_of_sheets': len(excel_file.sheet_names),
-            'file_size_mb': round(os.path.getsize(file_path) / (1024 * 1024), 2)
+            'sheet_names': metadata['sheet_names'],
+            'number_of_sheets': metadata['number_of_sheets'],
+            'file_size_mb': round(metadata['file_size'] / (1024 * 1024), 2)
         }
         
         return info
@@ -358,21 +520,393 @@ def get_images_from_s3_folder(s3_handler, folder_name, max_images=None):
     except Exception as e:
         return None
 
-def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode='repeat', sku_column='A', batch_column='CU', image_column='T', fill_images_from_s3=False):
+# Engine ghi file khi fill:
+# - 'openpyxl': sửa trực tiếp workbook đã load (giữ nguyên mọi thứ của template)
+# - 'streaming': đọc template một lần rồi ghi từng dòng bằng write-only mode, memory không phụ thuộc số dòng
+# - 'auto': dùng streaming khi số dòng output lớn và template không có thành phần streaming không hỗ trợ
+FILL_ENGINES = ('auto', 'openpyxl', 'streaming')
+STREAMING_FILL_MIN_ROWS = 2000
+
+
+def _streaming_unsupported_reason(workbook, worksheet, start_row: int) -> Optional[str]:
+    """Trả về lý do không dùng được streaming engine cho template này (None = dùng được)"""
+    for ws in workbook.worksheets:
+        if getattr(ws, '_images', None) or getattr(ws, '_charts', None):
+            return f"sheet '{ws.title}' có ảnh/biểu đồ"
+    for merged in worksheet.merged_cells.ranges:
+        if merged.max_row >= start_row:
+            return 'có merged cells trong vùng dữ liệu'
+    return None
+
+
+def _collect_product_names(products, fill_mode, rows_needed):
+    """
+    Lấy tên sản phẩm từ nguồn (list hoặc cursor/generator), chỉ đọc phần cần dùng:
+    - duplicate: tất cả tên unique (giữ thứ tự xuất hiện)
+    - repeat: rows_needed tên đầu tiên (các dòng sau lặp lại danh sách)
+    Returns: (danh sách tên, số sản phẩm đã đọc)
+    """
+    products_seen = 0
+
+    def names():
+        nonlocal products_seen
+        for product in products:
+            products_seen += 1
+            product_name = (product.get('name') or '').strip()
+            if product_name:
+                yield product_name
+
+    if fill_mode == 'duplicate':
+        product_names = list(dict.fromkeys(names()))
+    else:
+        product_names = list(islice(names(), rows_needed))
+    return product_names, products_seen
+
+
+def _iter_fill_rows(product_names, fill_mode, start_row, original_rows_to_fill, skus, batch_id,
+                    column, sku_column, batch_column, image_column, sequential_images):
+    """
+    Sinh kế hoạch fill theo thứ tự dòng: (target_row, source_row, {cột: giá trị}).
+    source_row là dòng template được copy sang target_row (bằng nhau nếu fill tại chỗ).
+    """
+    filled_count = 0
+    if fill_mode == 'duplicate':
+        # Mỗi sản phẩm unique có 1 nhóm dòng riêng (copy từ nhóm dòng gốc)
+        for group_index, product_name in enumerate(product_names):
+            for row_offset in range(original_rows_to_fill):
+                values = {
+                    column: product_name,
+                    sku_column: next(skus),
+                    batch_column: batch_id
+                }
+                if sequential_images:
+                    # Use modulo to cycle through images if we have more rows than images
+                    values[image_column] = sequential_images[(filled_count - 1) % len(sequential_images)]['url']
+                filled_count += 1
+                yield start_row + group_index * original_rows_to_fill + row_offset, start_row + row_offset, values
+    else:
+        # Lặp lại danh sách sản phẩm (cycle through products)
+        for row_offset in range(original_rows_to_fill):
+            values = {
+                column: product_names[row_offset % len(product_names)],
+                sku_column: next(skus),
+                batch_column: batch_id
+            }
+            if sequential_images:
+                values[image_column] = sequential_images[(filled_count - 1) % len(sequential_images)]['url']
+            filled_count += 1
+            yield start_row + row_offset, start_row + row_offset, values
+
+
+FILL_PROGRESS_EVERY_ROWS = 500
+
+
+def _track_fill_progress(fill_rows, progress_callback, total_rows):
+    """Bọc kế hoạch fill, báo tiến độ mỗi FILL_PROGRESS_EVERY_ROWS dòng"""
+    rows_filled = 0
+    for fill_row in fill_rows:
+        yield fill_row
+        rows_filled += 1
+        if rows_filled % FILL_PROGRESS_EVERY_ROWS == 0:
+            progress_callback('filling', rows_filled, total_rows)
+    progress_callback('filling', rows_filled, total_rows)
+
+
+def _apply_fill_rows_in_place(worksheet, fill_rows, protected_columns):
+    """Engine openpyxl: copy dòng template và ghi giá trị trực tiếp vào worksheet"""
+    from openpyxl.utils import get_column_letter
+
+    copy_columns = [
+        col_idx for col_idx in range(1, worksheet.max_column + 1)
+        if get_column_letter(col_idx) not in protected_columns
+    ]
+    filled_count = 0
+    for target_row, source_row, values in fill_rows:
+        if target_row != source_row:
+            # Copy value, style, format (trừ các cột sẽ fill mới)
+            for col_idx in copy_columns:
+                source_cell = worksheet.cell(row=source_row, column=col_idx)
+                target_cell = worksheet.cell(row=target_row, column=col_idx)
+                target_cell.value = source_cell.value
+                if hasattr(source_cell, '_style'):
+                    target_cell._style = source_cell._style
+        for col_letter, value in values.items():
+            worksheet[f"{col_letter}{target_row}"] = value
+        filled_count += 1
+    return filled_count
+
+
+class _StreamingSheetWriter:
+    """
+    Ghi các dòng của một sheet template sang sheet write-only.
+    Mỗi dòng template chỉ được dịch (giá trị + style) một lần; các dòng output sau đó dùng lại,
+    chỉ tạo cell mới cho các cột được fill.
+    """
+
+    def __init__(self, source_ws, target_ws):
+        self.source_ws = source_ws
+        self.target_ws = target_ws
+        self.max_column = source_ws.max_column
+        self._styles = {}
+        self._row_templates = {}
+
+    def _style_for(self, source_cell):
+        """Map style của template sang style của workbook output, mỗi style chỉ tạo một lần"""
+        from copy import copy
+        from openpyxl.cell import WriteOnlyCell
+
+        key = tuple(source_cell._style)
+        style = self._styles.get(key)
+        if style is None:
+            probe = WriteOnlyCell(self.target_ws)
+            probe.font = copy(source_cell.font)
+            probe.fill = copy(source_cell.fill)
+            probe.border = copy(source_cell.border)
+            probe.alignment = copy(source_cell.alignment)
+            probe.number_format = source_cell.number_format
+            probe.protection = copy(source_cell.protection)
+            style = probe._style
+            self._styles[key] = style
+        return style
+
+    def _new_cell(self, source_cell, value):
+        from copy import copy
+        from openpyxl.cell import WriteOnlyCell
+
+        cell = WriteOnlyCell(self.target_ws, value)
+        if source_cell is not None and source_cell.has_style:
+            cell._style = copy(self._style_for(source_cell))
+        return cell
+
+    def _row_template(self, source_row, blank_columns):
+        """List cell (theo thứ tự cột) của dòng template, các cột trong blank_columns để trống"""
+        key = (source_row, blank_columns)
+        template = self._row_templates.get(key)
+        if template is None:
+            from openpyxl.utils import get_column_letter
+
+            template = []
+            for col_idx in range(1, self.max_column + 1):
+                source_cell = self.source_ws._cells.get((source_row, col_idx))
+                value = None
+                if source_cell is not None and get_column_letter(col_idx) not in blank_columns:
+                    value = source_cell.value
+                template.append(self._new_cell(source_cell, value))
+            # Bỏ các ô trống ở cuối dòng cho file gọn hơn
+            while template and template[-1].value is None and not template[-1].has_style:
+                template.pop()
+            self._row_templates[key] = template
+        return template
+
+    def write_row(self, source_row, target_row, values=None, protected_columns=frozenset()):
+        """Ghi dòng template source_row ra vị trí target_row (đè các giá trị trong values)"""
+        from openpyxl.utils import column_index_from_string
+
+        # Dòng copy sang vị trí khác không mang theo giá trị của các cột sẽ fill mới
+        blank_columns = protected_columns if target_row != source_row else frozenset()
+        row_cells = list(self._row_template(source_row, blank_columns))
+        for col_letter, value in (values or {}).items():
+            col_idx = column_index_from_string(col_letter)
+            while len(row_cells) < col_idx:
+                row_cells.append(None)
+            row_cells[col_idx - 1] = self._new_cell(self.source_ws._cells.get((source_row, col_idx)), value)
+
+        source_dim = self.source_ws.row_dimensions.get(source_row)
+        if source_dim is not None and (source_dim.height is not None or source_dim.hidden):
+            target_dim = self.target_ws.row_dimensions[target_row]
+            target_dim.height = source_dim.height
+            target_dim.hidden = source_dim.hidden
+
+        # Write-only ghi dòng ra file ngay khi append, sau đó không cần giữ row dimension nữa
+        self.target_ws.append(row_cells)
+        self.target_ws.row_dimensions.pop(target_row, None)
+
+
+def _copy_sheet_layout(source_ws, target_ws, skip_merged_from_row=None):
+    """Copy độ rộng cột, freeze panes, merged cells, data validation... sang sheet write-only"""
+    from copy import copy
+    from openpyxl.worksheet.dimensions import ColumnDimension
+
+    for key, dim in source_ws.column_dimensions.items():
+        target_ws.column_dimensions[key] = ColumnDimension(
+            target_ws, index=dim.index, width=dim.width, bestFit=dim.bestFit, hidden=dim.hidden,
+            outlineLevel=dim.outlineLevel, collapsed=dim.collapsed, min=dim.min, max=dim.max
+        )
+    target_ws.sheet_format = copy(source_ws.sheet_format)
+    target_ws.sheet_properties = copy(source_ws.sheet_properties)
+    target_ws.sheet_state = source_ws.sheet_state
+    target_ws.freeze_panes = source_ws.freeze_panes
+    for merged in source_ws.merged_cells.ranges:
+        if skip_merged_from_row is None or merged.max_row < skip_merged_from_row:
+            target_ws.merged_cells.add(copy(merged))
+    for validation in source_ws.data_validations.dataValidation:
+        target_ws.data_validations.append(copy(validation))
+    target_ws.conditional_formatting = source_ws.conditional_formatting
+    for name, defined_name in source_ws.defined_names.items():
+        target_ws.defined_names[name] = copy(defined_name)
+
+
+def _write_streaming_workbook(workbook, new_file_path, sheet_fills, protected_columns):
+    """
+    Engine streaming: ghi workbook mới bằng write-only mode.
+    Template (đã load) chỉ được đọc; các dòng output được ghi ra file ngay nên memory không tăng theo số dòng.
+    sheet_fills: {tên sheet: (fill_rows, start_row)} cho các sheet cần fill, các sheet khác copy nguyên.
+    Returns: {tên sheet: số dòng đã fill}
+    """
+    import openpyxl
+
+    output = openpyxl.Workbook(write_only=True)
+    for name, defined_name in workbook.defined_names.items():
+        output.defined_names[name] = defined_name
+
+    filled_counts = {}
+    for source_ws in workbook.worksheets:
+        target_ws = output.create_sheet(source_ws.title)
+        fill_rows, start_row = sheet_fills.get(source_ws.title, (None, None))
+        _copy_sheet_layout(source_ws, target_ws, skip_merged_from_row=start_row)
+        writer = _StreamingSheetWriter(source_ws, target_ws)
+        max_row = source_ws.max_row if source_ws._cells else 0
+
+        if fill_rows is None:
+            for row_idx in range(1, max_row + 1):
+                writer.write_row(row_idx, row_idx)
+            continue
+
+        # Header giữ nguyên
+        for row_idx in range(1, start_row):
+            writer.write_row(row_idx, row_idx)
+
+        # Các dòng fill (target_row tăng dần liên tục từ start_row)
+        last_row = start_row - 1
+        filled_count = 0
+        for target_row, source_row, values in fill_rows:
+            writer.write_row(source_row, target_row, values, protected_columns)
+            last_row = target_row
+            filled_count += 1
+        filled_counts[source_ws.title] = filled_count
+
+        # Các dòng template còn lại sau vùng fill giữ nguyên như engine openpyxl
+        for row_idx in range(last_row + 1, max_row + 1):
+            writer.write_row(row_idx, row_idx)
+
+    output.active = workbook.worksheets.index(workbook.active)
+    output.save(new_file_path)
+    return filled_counts
+
+
+def _rows_to_fill(file_path: str, sheet_name: str, start_row: int) -> Optional[int]:
+    """Số dòng template (start_row -> dòng cuối có dữ liệu) của sheet, lấy từ metadata đã cache"""
+    sheet_metadata = get_template_metadata(file_path)['sheets'].get(sheet_name)
+    if sheet_metadata is None:
+        return None
+    actual_last_row = sheet_metadata['last_data_row'] or sheet_metadata['max_row']
+    # Nếu file quá ngắn, fill ít nhất 10 dòng (từ start_row đến start_row+9)
+    fill_until_row = start_row + 9 if actual_last_row < start_row else actual_last_row
+    return fill_until_row - start_row + 1
+
+
+def _fill_file_task(task, progress_callback=None):
+    """
+    Fill một file template theo kế hoạch đã tính sẵn (tên sản phẩm, SKU, Batch ID, ảnh).
+    Không truy cập database nên chạy được trong process pool (task chỉ chứa dữ liệu picklable).
+    
+    task: {'file_path', 'output_path', 'engine', 'fill_mode', 'product_names', 'batch_id', 'columns': {...},
+           'images': [...], 'sheets': [{'sheet', 'start_row', 'rows_per_group', 'skus'}]}
+    Returns: {'engine', 'sheets': {tên sheet: số dòng đã fill}}
+    """
+    import openpyxl
+
+    if progress_callback is None:
+        progress_callback = lambda phase, rows_filled, total_rows: None
+
+    columns = task['columns']
+    # Không copy các cột sẽ fill mới
+    protected_columns = frozenset((columns['column'], columns['sku_column'], columns['batch_column']))
+    total_rows = sum(len(sheet_plan['skus']) for sheet_plan in task['sheets'])
+
+    progress_callback('loading_template', 0, total_rows)
+    workbook = openpyxl.load_workbook(task['file_path'])
+    try:
+        def plan_rows(sheet_plan):
+            fill_rows = _iter_fill_rows(
+                task['product_names'], task['fill_mode'], sheet_plan['start_row'], sheet_plan['rows_per_group'],
+                iter(sheet_plan['skus']), task['batch_id'], columns['column'], columns['sku_column'],
+                columns['batch_column'], columns['image_column'], task['images']
+            )
+            return _track_fill_progress(fill_rows, progress_callback, len(sheet_plan['skus']))
+
+        engine = task['engine']
+        reasons = [
+            _streaming_unsupported_reason(workbook, workbook[sheet_plan['sheet']], sheet_plan['start_row'])
+            for sheet_plan in task['sheets']
+        ]
+        reason = next((reason for reason in reasons if reason), None)
+        if engine == 'auto':
+            use_streaming = total_rows >= STREAMING_FILL_MIN_ROWS and reason is None
+        elif engine == 'streaming':
+            if reason:
+                raise ValueError(f'Template không dùng được streaming engine: {reason}')
+            use_streaming = True
+        else:
+            use_streaming = False
+
+        if use_streaming:
+            sheet_fills = {
+                sheet_plan['sheet']: (plan_rows(sheet_plan), sheet_plan['start_row'])
+                for sheet_plan in task['sheets']
+            }
+            filled_counts = _write_streaming_workbook(workbook, task['output_path'], sheet_fills, protected_columns)
+        else:
+            filled_counts = {}
+            for sheet_plan in task['sheets']:
+                filled_counts[sheet_plan['sheet']] = _apply_fill_rows_in_place(
+                    workbook[sheet_plan['sheet']], plan_rows(sheet_plan), protected_columns
+                )
+            # Lưu file mới
+            progress_callback('saving', sum(filled_counts.values()), total_rows)
+            workbook.save(task['output_path'])
+    finally:
+        workbook.close()
+
+    return {'engine': 'streaming' if use_streaming else 'openpyxl', 'sheets': filled_counts}
+
+
+def _load_fill_images(fill_images_from_s3):
+    """Danh sách ảnh S3 để fill tuần tự ([] nếu tắt hoặc không kết nối được S3)"""
+    if not fill_images_from_s3:
+        return []
+    try:
+        from aws_s3_handler import AWSS3Uploader
+        # Get all images from S3 bucket sequentially (index MongoDB, không giới hạn 1000 ảnh)
+        return AWSS3Uploader().list_images()
+    except Exception as e:
+        print(f"Không lấy được ảnh từ S3: {e}")
+        return []
+
+
+def _filled_filename(filename: str, timestamp: str) -> str:
+    """Tên file output, có suffix ngẫu nhiên để các job fill cùng template trong cùng giây không ghi đè nhau"""
+    name_part, ext = os.path.splitext(filename)
+    return f"{name_part}_filled_{timestamp}_{uuid.uuid4().hex[:8]}{ext}"
+
+
+def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode='repeat', sku_column='A', batch_column='CU', image_column='T', fill_images_from_s3=False, engine='auto', progress_callback=None, sheet_name=None):
     """
     Fill dữ liệu từ database vào file Excel
     
     Args:
         filename (str): Tên file Excel cần fill
-        products (list): Danh sách sản phẩm từ database
+        products (iterable): Sản phẩm từ database (list hoặc walmart.iter_products), chỉ dùng field 'name'
         column (str): Cột cần fill (mặc định 'E')
         start_row (int): Dòng bắt đầu fill (mặc định 7)
+        engine (str): 'auto', 'openpyxl' hoặc 'streaming' (xem FILL_ENGINES)
+        progress_callback (callable, optional): Gọi với (phase, rows_filled, total_rows) để báo tiến độ
+        sheet_name (str, optional): Sheet cần fill (mặc định sheet đang active)
     
     Returns:
         dict: Kết quả fill dữ liệu
     """
     try:
-        import openpyxl
         from datetime import datetime
         
         ensure_upload_folder()
@@ -384,21 +918,36 @@ def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode=
                 'error': f'File không tồn tại: {filename}'
             }
         
-        # Đọc file Excel
-        workbook = openpyxl.load_workbook(file_path)
-        worksheet = workbook.active
+        if engine not in FILL_ENGINES:
+            return {
+                'success': False,
+                'error': f"Engine không hợp lệ: {engine}. Chỉ chấp nhận: {', '.join(FILL_ENGINES)}"
+            }
         
-        # Nếu không có sản phẩm thì không làm gì
-        if not products:
+        if progress_callback is None:
+            progress_callback = lambda phase, rows_filled, total_rows: None
+        
+        # Tự động phát hiện dòng cuối thực sự có dữ liệu (metadata đã cache từ lúc upload)
+        sheet_name = sheet_name or get_template_metadata(file_path)['active_sheet']
+        original_rows_to_fill = _rows_to_fill(file_path, sheet_name, start_row)
+        if original_rows_to_fill is None:
             return {
                 'success': False,
-                'error': 'Không có sản phẩm trong collection'
+                'error': f'Sheet không tồn tại: {sheet_name}'
             }
+        fill_until_row = start_row + original_rows_to_fill - 1
         
         # Lọc sản phẩm có tên
-        valid_products = [product for product in products if product.get('name', '').strip()]
+        product_names, products_seen = _collect_product_names(products, fill_mode, original_rows_to_fill)
         
-        if not valid_products:
+        # Nếu không có sản phẩm thì không làm gì
+        if not products_seen:
+            return {
+                'success': False,
+                'error': 'Không có sản phẩm trong collection'
+            }
+        
+        if not product_names:
             return {
                 'success': False,
                 'error': 'Không có sản phẩm nào có tên trong collection'
@@ -408,205 +957,42 @@ def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode=
         from walmart import generate_batch_id
         batch_id = generate_batch_id()
         
-        # Initialize AWS S3 handler if needed for images
-        s3_handler = None
-        if fill_images_from_s3:
-            try:
-                from aws_s3_handler import AWSS3Uploader
-                s3_handler = AWSS3Uploader()
-            except Exception as e:
-                fill_images_from_s3 = False
-        
-        # Tự động phát hiện dòng cuối thực sự có dữ liệu
-        last_data_row = worksheet.max_row
-        
-        # Scan từ cuối lên để tìm dòng cuối thực sự có dữ liệu (không phải dòng trống)
-        actual_last_row = last_data_row
-        for row_num in range(last_data_row, 0, -1):
-            has_data = False
-            for col_idx in range(1, worksheet.max_column + 1):
-                cell_value = worksheet.cell(row=row_num, column=col_idx).value
-                if cell_value is not None and str(cell_value).strip() != '':
-                    has_data = True
-                    break
-            if has_data:
-                actual_last_row = row_num
-                break
-        
-        # Tính số dòng cần fill từ start_row đến actual_last_row
-        if actual_last_row < start_row:
-            # Nếu file quá ngắn, fill ít nhất 10 dòng
-            fill_until_row = start_row + 9  # fill từ start_row đến start_row+9 (10 dòng)
-        else:
-            fill_until_row = actual_last_row
-        
-        original_rows_to_fill = fill_until_row - start_row + 1
-        
         # Prepare sequential image list if needed
-        sequential_images = []
-        if fill_images_from_s3 and s3_handler:
-            # Get all images from S3 bucket sequentially
-            try:
-                response = s3_handler.s3.list_objects_v2(
-                    Bucket=s3_handler.BUCKET_NAME,
-                    Prefix=f"{s3_handler.FOLDER_NAME}/",
-                    MaxKeys=1000  # Limit to 1000 images
-                )
-                
-                if 'Contents' in response:
-                    for obj in response['Contents']:
-                        object_key = obj['Key']
-                        object_name = object_key.split('/')[-1]
-                        
-                        # Skip if it's a folder (ends with /)
-                        if not object_name or object_name.endswith('/'):
-                            continue
-                            
-                        # Create URL
-                        image_url = f"{s3_handler.BUCKET_HOSTING_URL}/{object_key}"
-                        
-                        sequential_images.append({
-                            'name': object_name,
-                            'url': image_url,
-                            'key': object_key
-                        })
-                
-            except Exception as e:
-                fill_images_from_s3 = False
-        
-        filled_count = 0
+        sequential_images = _load_fill_images(fill_images_from_s3)
+        fill_images_from_s3 = bool(sequential_images)
         
+        # Số dòng output để cấp phát SKU một lần cho toàn bộ file
         if fill_mode == 'duplicate':
-            # DUPLICATE MODE: Mỗi sản phẩm unique sẽ có 1 nhóm dòng riêng
-            unique_products = []
-            seen_names = set()
-            for product in valid_products:
-                name = product.get('name', '').strip()
-                if name and name not in seen_names:
-                    unique_products.append(product)
-                    seen_names.add(name)
-            
-            current_row = start_row
-            
-            for group_index, unique_product in enumerate(unique_products):
-                product_name = unique_product.get('name', '').strip()
-                
-                # Copy structure từ original rows nếu không phải group đầu tiên
-                if group_index > 0:
-                    # Copy tất cả cells từ original group (start_row -> fill_until_row) 
-                    # sang group hiện tại (current_row -> current_row + original_rows_to_fill - 1)
-                    for row_offset in range(original_rows_to_fill):
-                        source_row = start_row + row_offset
-                        target_row = current_row + row_offset
-                        
-                        # Copy tất cả cells trong dòng (trừ cột product name, SKU, và batch ID)
-                        for col_idx in range(1, worksheet.max_column + 1):
-                            col_letter = worksheet.cell(row=1, column=col_idx).column_letter
-                            if col_letter not in [column, sku_column, batch_column]:  # Không copy các cột sẽ fill mới
-                                source_cell = worksheet.cell(row=source_row, column=col_idx)
-                                target_cell = worksheet.cell(row=target_row, column=col_idx)
-                                
-                                # Copy value, style, format
-                                target_cell.value = source_cell.value
-                                if hasattr(source_cell, '_style'):
-                                    target_cell._style = source_cell._style
-                
-                # Fill product name, SKU, và Batch ID vào tất cả dòng của group này
-                for row_offset in range(original_rows_to_fill):
-                    target_row = current_row + row_offset
-                    
-                    # Fill product name
-                    product_cell_address = f"{column}{target_row}"
-                    worksheet[product_cell_address] = product_name
-                    
-                    # Generate và fill unique SKU  
-                    from walmart import generate_unique_sku, mark_sku_used
-                    unique_sku = generate_unique_sku()
-                    sku_cell_address = f"{sku_column}{target_row}"
-                    worksheet[sku_cell_address] = unique_sku
-                    mark_sku_used(unique_sku)
-                    
-                    # Fill Batch ID (cùng giá trị cho tất cả dòng)
-                    batch_cell_address = f"{batch_column}{target_row}"
-                    worksheet[batch_cell_address] = batch_id
-                    
-                    # Fill image from AWS S3 sequentially
-                    if fill_images_from_s3 and len(sequential_images) > 0:
-                        # Use modulo to cycle through images if we have more rows than images
-                        image_index = (filled_count - 1) % len(sequential_images)
-                        image_data = sequential_images[image_index]
-                        image_url = image_data['url']
-                        image_cell_address = f"{image_column}{target_row}"
-                        worksheet[image_cell_address] = image_url
-                        
-                    filled_count += 1
-                
-                # Move to next group
-                current_row += original_rows_to_fill
-            
-            total_filled_rows = len(unique_products) * original_rows_to_fill
-            
+            unique_count = len(product_names)
+            total_rows = unique_count * original_rows_to_fill
         else:
-            # REPEAT MODE: Lặp lại danh sách sản phẩm như cũ
-            current_row = start_row
-            product_index = 0
-            
-            while filled_count < original_rows_to_fill and current_row <= fill_until_row:
-                # Lấy sản phẩm theo vòng lặp (cycle through products)
-                product = valid_products[product_index % len(valid_products)]
-                product_name = product.get('name', '').strip()
-                
-                if product_name:
-                    # Fill product name
-                    product_cell_address = f"{column}{current_row}"
-                    worksheet[product_cell_address] = product_name
-                    
-                    # Generate và fill unique SKU
-                    from walmart import generate_unique_sku, mark_sku_used
-                    unique_sku = generate_unique_sku()
-                    sku_cell_address = f"{sku_column}{current_row}"
-                    worksheet[sku_cell_address] = unique_sku
-                    mark_sku_used(unique_sku)
-                    
-                    # Fill Batch ID (cùng giá trị cho tất cả dòng)
-                    batch_cell_address = f"{batch_column}{current_row}"
-                    worksheet[batch_cell_address] = batch_id
-                    
-                    # Fill image from AWS S3 sequentially
-                    if fill_images_from_s3 and len(sequential_images) > 0:
-                        # Use modulo to cycle through images if we have more rows than images
-                        image_index = (filled_count - 1) % len(sequential_images)
-                        image_data = sequential_images[image_index]
-                        image_url = image_data['url']
-                        image_cell_address = f"{image_column}{current_row}"
-                        worksheet[image_cell_address] = image_url
-                        
-                    filled_count += 1
-                    
-                    current_row += 1
-                    product_index += 1
-                else:
-                    # Skip sản phẩm không có tên
-                    product_index += 1
-                    continue
+            total_rows = original_rows_to_fill
         
+        progress_callback('allocating_skus', 0, total_rows)
+        from walmart import allocate_skus
+        skus = allocate_skus(total_rows, batch_id)
         
         # Tạo tên file mới
-        name_part, ext = os.path.splitext(filename)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        new_filename = f"{name_part}_filled_{timestamp}{ext}"
-        new_file_path = os.path.join(UPLOAD_FOLDER, new_filename)
+        new_filename = _filled_filename(filename, datetime.now().strftime("%Y%m%d_%H%M%S"))
         
-        # Lưu file mới
-        workbook.save(new_file_path)
-        workbook.close()
+        task_result = _fill_file_task({
+            'file_path': file_path,
+            'output_path': os.path.join(UPLOAD_FOLDER, new_filename),
+            'engine': engine,
+            'fill_mode': fill_mode,
+            'product_names': product_names,
+            'batch_id': batch_id,
+            'columns': {'column': column, 'sku_column': sku_column, 'batch_column': batch_column, 'image_column': image_column},
+            'images': sequential_images,
+            'sheets': [{'sheet': sheet_name, 'start_row': start_row, 'rows_per_group': original_rows_to_fill, 'skus': skus}]
+        }, progress_callback)
+        filled_count = task_result['sheets'][sheet_name]
         
         # Mark Batch ID as used
         from walmart import mark_batch_used
         mark_batch_used(batch_id, filled_count)
         
         if fill_mode == 'duplicate':
-            unique_count = len(set(p.get('name', '').strip() for p in valid_products if p.get('name', '').strip()))
             base_message = f'Chế độ duplicate: {unique_count} sản phẩm unique × {original_rows_to_fill} dòng = {filled_count} tổng dòng đã fill (Product Name + SKU + Batch ID: {batch_id}'
             if fill_images_from_s3:
                 image_count = len(sequential_images)
@@ -625,6 +1011,7 @@ def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode=
             'success': True,
             'filled_count': filled_count,
             'new_filename': new_filename,
+            'sheet_name': sheet_name,
             'column': column,
             'sku_column': sku_column,
             'batch_column': batch_column,
@@ -634,6 +1021,7 @@ def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode=
             'start_row': start_row,
             'end_row': end_row,
             'fill_mode': fill_mode,
+            'engine': task_result['engine'],
             'total_rows_detected': original_rows_to_fill,
             'message': message
         }
@@ -643,3 +1031,186 @@ def fill_excel_with_data(filename, products, column='E', start_row=7, fill_mode=
             'success': False,
             'error': f'Lỗi khi fill dữ liệu: {str(e)}'
         }
+
+
+def fill_excel_batch(targets, products, column='E', start_row=7, fill_mode='repeat', sku_column='A', batch_column='CU', image_column='T', fill_images_from_s3=False, engine='auto', progress_callback=None, max_workers=None):
+    """
+    Fill nhiều file / nhiều sheet từ cùng một collection, trả về một file zip chứa các file kết quả.
+    Sản phẩm, ảnh S3, Batch ID và SKU chỉ được lấy / cấp phát một lần cho cả batch;
+    các file được fill song song trong process pool.
+    
+    Args:
+        targets (list): [{'filename': str, 'sheets': [str] (tùy chọn, mặc định sheet đang active)}]
+        products (iterable): Sản phẩm từ database (list hoặc walmart.iter_products)
+        max_workers (int, optional): Số process tối đa (mặc định BATCH_FILL_MAX_WORKERS)
+        Các tham số khác giống fill_excel_with_data
+    
+    Returns:
+        dict: Kết quả batch fill (zip_filename, kết quả từng file)
+    """
+    import shutil
+    import tempfile
+    import zipfile
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    work_dir = None
+    try:
+        ensure_upload_folder()
+        
+        if not targets:
+            return {'success': False, 'error': 'Không có file nào để fill'}
+        
+        if engine not in FILL_ENGINES:
+            return {
+                'success': False,
+                'error': f"Engine không hợp lệ: {engine}. Chỉ chấp nhận: {', '.join(FILL_ENGINES)}"
+            }
+        
+        if progress_callback is None:
+            progress_callback = lambda phase, rows_filled, total_rows: None
+        
+        # Gộp các sheet của cùng một file (mỗi file chỉ load/ghi một lần)
+        file_sheets = {}
+        for target in targets:
+            filename = os.path.basename(target.get('filename') or '')
+            file_path = os.path.join(UPLOAD_FOLDER, filename)
+            if not filename or not os.path.exists(file_path):
+                return {'success': False, 'error': f"File không tồn tại: {target.get('filename')}"}
+            sheets = target.get('sheets') or [get_template_metadata(file_path)['active_sheet']]
+            for sheet_name in sheets:
+                if sheet_name not in file_sheets.setdefault(filename, []):
+                    file_sheets[filename].append(sheet_name)
+        
+        # Số dòng template của từng sheet (metadata đã cache từ lúc upload)
+        sheet_rows = {}
+        for filename, sheets in file_sheets.items():
+            for sheet_name in sheets:
+                rows = _rows_to_fill(os.path.join(UPLOAD_FOLDER, filename), sheet_name, start_row)
+                if rows is None:
+                    return {'success': False, 'error': f'Sheet không tồn tại: {filename} / {sheet_name}'}
+                sheet_rows[(filename, sheet_name)] = rows
+        
+        # Lấy sản phẩm một lần cho cả batch
+        product_names, products_seen = _collect_product_names(products, fill_mode, max(sheet_rows.values()))
+        if not products_seen:
+            return {'success': False, 'error': 'Không có sản phẩm trong collection'}
+        if not product_names:
+            return {'success': False, 'error': 'Không có sản phẩm nào có tên trong collection'}
+        
+        # Một Batch ID + một lần cấp phát SKU cho toàn bộ batch
+        from walmart import generate_batch_id, allocate_skus, mark_batch_used
+        batch_id = generate_batch_id()
+        sequential_images = _load_fill_images(fill_images_from_s3)
+        
+        def output_rows(rows_per_group):
+            return len(product_names) * rows_per_group if fill_mode == 'duplicate' else rows_per_group
+        
+        total_rows = sum(output_rows(rows) for rows in sheet_rows.values())
+        progress_callback('allocating_skus', 0, total_rows)
+        skus = allocate_skus(total_rows, batch_id)
+        
+        work_dir = tempfile.mkdtemp(prefix='batch_fill_', dir=UPLOAD_FOLDER)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        columns = {'column': column, 'sku_column': sku_column, 'batch_column': batch_column, 'image_column': image_column}
+        tasks = []
+        sku_offset = 0
+        for filename, sheets in file_sheets.items():
+            sheet_plans = []
+            for sheet_name in sheets:
+                rows_per_group = sheet_rows[(filename, sheet_name)]
+                sheet_total = output_rows(rows_per_group)
+                sheet_plans.append({
+                    'sheet': sheet_name,
+                    'start_row': start_row,
+                    'rows_per_group': rows_per_group,
+                    'skus': skus[sku_offset:sku_offset + sheet_total]
+                })
+                sku_offset += sheet_total
+            new_filename = _filled_filename(filename, timestamp)
+            tasks.append({
+                'filename': filename,
+                'new_filename': new_filename,
+                'file_path': os.path.join(UPLOAD_FOLDER, filename),
+                'output_path': os.path.join(work_dir, new_filename),
+                'engine': engine,
+                'fill_mode': fill_mode,
+                'product_names': product_names,
+                'batch_id': batch_id,
+                'columns': columns,
+                'images': sequential_images,
+                'sheets': sheet_plans
+            })
+        
+        files = []
+        errors = []
+        rows_done = 0
+        progress_callback('filling', 0, total_rows)
+        
+        def collect(task, task_result=None, error=None):
+            nonlocal rows_done
+            if error is not None:
+                errors.append({'filename': task['filename'], 'error': str(error)})
+                return
+            rows_done += sum(task_result['sheets'].values())
+            files.append({
+                'filename': task['filename'],
+                'new_filename': task['new_filename'],
+                'engine': task_result['engine'],
+                'sheets': task_result['sheets'],
+                'filled_count': sum(task_result['sheets'].values())
+            })
+            progress_callback('filling', rows_done, total_rows)
+        
+        workers = min(max_workers or BATCH_FILL_MAX_WORKERS, len(tasks))
+        if workers <= 1:
+            for task in tasks:
+                try:
+                    collect(task, _fill_file_task(task))
+                except Exception as e:
+                    collect(task, error=e)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(_fill_file_task, task): task for task in tasks}
+                for future in as_completed(futures):
+                    try:
+                        collect(futures[future], future.result())
+                    except Exception as e:
+                        collect(futures[future], error=e)
+        
+        if not files:
+            return {
+                'success': False,
+                'error': 'Không fill được file nào',
+                'errors': errors
+            }
+        
+        # Gói kết quả vào một file zip (xlsx đã nén sẵn nên chỉ lưu, không nén lại)
+        progress_callback('saving', rows_done, total_rows)
+        zip_filename = f"batch_fill_{timestamp}_{batch_id}.zip"
+        with zipfile.ZipFile(os.path.join(UPLOAD_FOLDER, zip_filename), 'w', zipfile.ZIP_STORED) as archive:
+            for file_result in sorted(files, key=lambda item: item['new_filename']):
+                archive.write(os.path.join(work_dir, file_result['new_filename']), arcname=file_result['new_filename'])
+        
+        # Mark Batch ID as used
+        mark_batch_used(batch_id, rows_done)
+        
+        return {
+            'success': True,
+            'zip_filename': zip_filename,
+            'batch_id': batch_id,
+            'fill_mode': fill_mode,
+            'filled_count': rows_done,
+            'files': files,
+            'errors': errors,
+            'images_filled': len(sequential_images),
+            'message': f'Đã fill {len(files)}/{len(tasks)} file ({rows_done} dòng, Batch ID: {batch_id})'
+        }
+        
+    except Exception as e:
+        return {
+            'success': False,
+            'error': f'Lỗi khi fill batch: {str(e)}'
+        }
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
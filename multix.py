@@ -410,7 +410,7 @@ def save_automation_token_to_db(workspace_id, email, automation_token, expiratio
         }
         
         # Sử dụng upsert để update hoặc insert
-        collection_log.update_one(
+        get_log_collection().update_one(
             {
                 "workspace_id": workspace_id,
                 "email": email,
@@ -445,7 +445,7 @@ def get_automation_token_from_db(workspace_id, email):
         Dict chứa token info hoặc None
     """
     try:
-        token_doc = collection_log.find_one({
+        token_doc = get_log_collection().find_one({
             "workspace_id": workspace_id,
             "email": email,
             "type": "automation_token"
@@ -505,7 +505,7 @@ def is_token_valid(token_info):
 def clean_expired_tokens():
     """Xóa các token đã hết hạn từ database"""
     try:
-        result = collection_log.delete_many({
+        result = get_log_collection().delete_many({
             "type": "automation_token",
             "expiration_date": {"$lt": datetime.now()}
         })
@@ -0,0 +1,130 @@
+"""
+Index object S3 lưu trong MongoDB (theo bucket + prefix) để fill ảnh Excel không phải list
+toàn bộ bucket mỗi lần. Index được cập nhật bởi:
+- upload_to_s3 (record_s3_object) ngay khi upload xong
+- sync_s3_prefix: list bucket có phân trang (ContinuationToken), incremental từ key cuối đã thấy,
+  full sync định kỳ (S3_INDEX_FULL_SYNC_SECONDS) để bỏ các object đã bị xóa
+"""
+
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from config import get_database, S3_INDEX_FULL_SYNC_SECONDS
+
+S3_INDEX_COLLECTION = 's3_image_index'
+S3_INDEX_STATE_COLLECTION = 's3_image_index_state'
+S3_LIST_PAGE_SIZE = 1000
+S3_INDEX_WRITE_BATCH = 1000
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def _index_collection():
+    global _indexes_ready
+    collection = get_database()[S3_INDEX_COLLECTION]
+    if not _indexes_ready:
+        with _indexes_lock:
+            if not _indexes_ready:
+                collection.create_index([('bucket', 1), ('key', 1)], unique=True, name='bucket_key_unique')
+                _indexes_ready = True
+    return collection
+
+
+def _prefix_filter(bucket, prefix):
+    # Regex neo đầu chuỗi dùng được index (bucket, key)
+    return {'bucket': bucket, 'key': {'$regex': f"^{re.escape(prefix)}"}}
+
+
+def iter_s3_objects(s3_client, bucket, prefix, start_after=None, page_size=S3_LIST_PAGE_SIZE):
+    """List tất cả object dưới prefix (theo thứ tự key), tự phân trang bằng ContinuationToken"""
+    params = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': page_size}
+    if start_after:
+        params['StartAfter'] = start_after
+    while True:
+        response = s3_client.list_objects_v2(**params)
+        for obj in response.get('Contents', []):
+            # Bỏ qua "folder" (key kết thúc bằng /)
+            if obj['Key'].endswith('/'):
+                continue
+            yield obj
+        if not response.get('IsTruncated'):
+            return
+        params['ContinuationToken'] = response['NextContinuationToken']
+        params.pop('StartAfter', None)
+
+
+def _object_update(bucket, key, size=None, etag=None, last_modified=None, sync_id=None):
+    fields = {
+        'bucket': bucket,
+        'key': key,
+        'name': key.split('/')[-1],
+        'size': size,
+        'etag': etag,
+        'last_modified': last_modified,
+        'indexed_at': datetime.now()
+    }
+    if sync_id:
+        fields['sync_id'] = sync_id
+    return UpdateOne({'bucket': bucket, 'key': key}, {'$set': fields}, upsert=True)
+
+
+def record_s3_object(bucket, key, size=None, etag=None, last_modified=None):
+    """Ghi object vừa upload vào index (gọi từ upload path)"""
+    _index_collection().bulk_write([_object_update(bucket, key, size, etag, last_modified or datetime.now())])
+
+
+def sync_s3_prefix(s3_client, bucket, prefix, full=False):
+    """
+    Đồng bộ index của prefix với S3.
+    Incremental: chỉ list các key sau key lớn nhất đã thấy (StartAfter).
+    Full (lần đầu, quá hạn S3_INDEX_FULL_SYNC_SECONDS hoặc full=True): list lại cả prefix và xóa khỏi index
+    các object không còn trên S3.
+    """
+    collection = _index_collection()
+    state_collection = get_database()[S3_INDEX_STATE_COLLECTION]
+    state = state_collection.find_one({'bucket': bucket, 'prefix': prefix}) or {}
+
+    now = time.time()
+    full = full or not state.get('last_full_sync_at') or now - state['last_full_sync_at'] >= S3_INDEX_FULL_SYNC_SECONDS
+    sync_id = uuid.uuid4().hex
+    last_key = None if full else state.get('last_key')
+
+    listed = 0
+    max_key = last_key
+    operations = []
+    for obj in iter_s3_objects(s3_client, bucket, prefix, start_after=last_key):
+        operations.append(_object_update(bucket, obj['Key'], obj.get('Size'), obj.get('ETag'),
+                                         obj.get('LastModified'), sync_id))
+        listed += 1
+        if max_key is None or obj['Key'] > max_key:
+            max_key = obj['Key']
+        if len(operations) >= S3_INDEX_WRITE_BATCH:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+    removed = 0
+    state_update = {'bucket': bucket, 'prefix': prefix, 'last_key': max_key, 'last_sync_at': now}
+    if full:
+        query = _prefix_filter(bucket, prefix)
+        query['sync_id'] = {'$ne': sync_id}
+        removed = collection.delete_many(query).deleted_count
+        state_update['last_full_sync_at'] = now
+    state_collection.update_one({'bucket': bucket, 'prefix': prefix}, {'$set': state_update}, upsert=True)
+
+    return {'listed': listed, 'removed': removed, 'full': full}
+
+
+def list_indexed_objects(s3_client, bucket, prefix, refresh=True):
+    """Danh sách key (theo thứ tự như S3 list) dưới prefix từ index, sync incremental trước nếu refresh=True"""
+    if refresh:
+        sync_s3_prefix(s3_client, bucket, prefix)
+    cursor = _index_collection().find(_prefix_filter(bucket, prefix), {'key': 1, '_id': 0}).sort('key', 1)
+    return [doc['key'] for doc in cursor]
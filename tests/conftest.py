@@ -0,0 +1,89 @@
+"""
+Fixture dùng chung cho test: S3 giả lập bằng moto, MongoDB giả lập bằng mongomock.
+Test không gọi AWS / MongoDB thật và không cần mạng.
+
+Chạy:
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import io
+import os
+import sys
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Đặt trước khi import config (dotenv không ghi đè biến đã có): credentials giả cho moto,
+# không dùng endpoint S3 tùy chỉnh trong .env
+os.environ['AWS_ACCESS_KEY'] = 'testing'
+os.environ['AWS_SECRET_KEY'] = 'testing'
+os.environ['S3_ENDPOINT_URL'] = ''
+
+
+class ListCallRecorder:
+    """Bọc S3 client, ghi lại tham số các lần gọi list_objects_v2"""
+
+    def __init__(self, client):
+        self.client = client
+        self.list_calls = []
+
+    def list_objects_v2(self, **params):
+        self.list_calls.append(dict(params))
+        return self.client.list_objects_v2(**params)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """S3 client (moto) dùng chung của aws_s3_handler, bucket AWS_BUCKET_NAME đã được tạo"""
+    moto = pytest.importorskip('moto')
+    import aws_s3_handler
+
+    with moto.mock_aws():
+        monkeypatch.setattr(aws_s3_handler, '_s3_client', None)
+        client = aws_s3_handler.get_s3_client()
+        client.create_bucket(
+            Bucket=aws_s3_handler.BUCKET_NAME,
+            CreateBucketConfiguration={'LocationConstraint': aws_s3_handler.REGION}
+        )
+        yield client
+
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    """Database mongomock thay cho get_database() của các module index/registry"""
+    mongomock = pytest.importorskip('mongomock')
+    import image_registry
+    import s3_image_index
+
+    db = mongomock.MongoClient()['test']
+    for module in (s3_image_index, image_registry):
+        monkeypatch.setattr(module, 'get_database', lambda: db)
+        monkeypatch.setattr(module, '_indexes_ready', False)
+    return db
+
+
+def fake_image(url, size=(64, 64)):
+    """JPEG nhỏ, màu theo URL (URL khác nhau -> nội dung khác nhau)"""
+    from PIL import Image
+
+    color = zlib.crc32(url.encode()) & 0xFFFFFF
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (color >> 16, (color >> 8) & 0xFF, color & 0xFF)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def uploader(s3, monkeypatch):
+    """
+    AWSS3Uploader trên bucket moto: ảnh được "tải" từ fake_image, registry ảnh và S3 index
+    (MongoDB) được tắt nên pipeline chạy không cần mạng và MongoDB
+    """
+    import aws_s3_handler
+
+    monkeypatch.setattr(aws_s3_handler, 'fetch_url', lambda url, headers=None: (fake_image(url), 'image/jpeg'))
+    monkeypatch.setattr(aws_s3_handler, 'find_image', lambda *args, **kwargs: None)
+    for name in ('register_image', 'add_source_url', 'forget_image', 'record_s3_object'):
+        monkeypatch.setattr(aws_s3_handler, name, lambda *args, **kwargs: None)
+    return aws_s3_handler.AWSS3Uploader()
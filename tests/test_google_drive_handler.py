@@ -0,0 +1,202 @@
+"""GoogleDriveUploader với Drive service giả lập (service_factory): gom query folder, batch tạo folder, upload song song"""
+import itertools
+import re
+import threading
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+import google_drive_handler
+from google_drive_handler import GoogleDriveUploader, DRIVE_FOLDER_MIME
+
+
+class FakeRequest:
+    def __init__(self, drive, kind, run, body=None):
+        self.drive = drive
+        self.kind = kind
+        self.run = run
+        self.body = body
+
+    def execute(self, num_retries=0):
+        self.drive.count(self.kind)
+        return self.run()
+
+
+class FakeBatch:
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.drive.count('batch')
+        for request, request_id in self.requests:
+            if request.body['name'] in self.drive.fail_in_batch:
+                self.callback(request_id, None, Exception('rateLimitExceeded'))
+            else:
+                self.callback(request_id, request.run(), None)
+
+
+class FakeFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, fields=None, pageSize=100, pageToken=None):
+        parent = re.search(r"'([^']+)' in parents", q).group(1)
+
+        def run():
+            with self.drive.lock:
+                folders = [
+                    {'id': file_id, 'name': item['name']}
+                    for file_id, item in self.drive.files.items()
+                    if item['mimeType'] == DRIVE_FOLDER_MIME and item['parent'] == parent
+                ]
+            offset = int(pageToken or 0)
+            response = {'files': folders[offset:offset + pageSize]}
+            if offset + pageSize < len(folders):
+                response['nextPageToken'] = str(offset + pageSize)
+            return response
+
+        return FakeRequest(self.drive, 'list', run)
+
+    def create(self, body, fields=None, media_body=None):
+        def run():
+            if body['name'] in self.drive.fail_create:
+                raise Exception('backendError')
+            return {'id': self.drive.add_file(body, media_body)}
+
+        return FakeRequest(self.drive, 'create', run, body)
+
+
+class FakeService:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return FakeFiles(self.drive)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.drive, callback)
+
+
+class FakeDrive:
+    """
+    Drive giả lập trong memory, dùng chung cho mọi service của factory (mỗi luồng một service).
+    fail_in_batch: tên folder bị lỗi khi tạo trong batch, fail_create: tên luôn tạo lỗi.
+    """
+
+    def __init__(self, fail_in_batch=(), fail_create=()):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.calls = {}
+        self.services = 0
+        self.fail_in_batch = set(fail_in_batch)
+        self.fail_create = set(fail_create)
+        self._ids = itertools.count(1)
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def add_file(self, body, media_body=None):
+        with self.lock:
+            file_id = f"id{next(self._ids)}"
+            self.files[file_id] = {
+                'name': body['name'],
+                'mimeType': body.get('mimeType', 'image/jpeg'),
+                'parent': (body.get('parents') or ['root'])[0]
+            }
+            return file_id
+
+    def add_folder(self, name, parent='root'):
+        return self.add_file({'name': name, 'mimeType': DRIVE_FOLDER_MIME, 'parents': [parent]})
+
+    def service(self):
+        with self.lock:
+            self.services += 1
+        return FakeService(self)
+
+    def uploaded(self):
+        """{tên file: tên folder cha} của các ảnh đã upload"""
+        with self.lock:
+            return {
+                item['name']: self.files[item['parent']]['name'] if item['parent'] in self.files else item['parent']
+                for item in self.files.values() if item['mimeType'] != DRIVE_FOLDER_MIME
+            }
+
+
+@pytest.fixture(autouse=True)
+def fake_fetch(monkeypatch):
+    monkeypatch.setattr(google_drive_handler, 'fetch_url', lambda url, headers=None: (b'image', 'image/jpeg'))
+
+
+def images_for(products, per_product=2):
+    return [
+        {'url': f"https://cdn.example.com/{product}/{i}.jpg", 'filename': f"{product}_{i}.jpg", 'product_name': product}
+        for product in products for i in range(per_product)
+    ]
+
+
+def test_folders_resolved_with_one_list_and_batched_creates():
+    drive = FakeDrive()
+    existing = {name: drive.add_folder(name) for name in ('P0', 'P1')}
+    products = [f"P{i}" for i in range(152)]
+    uploader = GoogleDriveUploader(service_factory=drive.service)
+
+    results = uploader.batch_upload_images(images_for(products), max_workers=4)
+
+    assert results['success_count'] == 304
+    assert results['failed_count'] == 0
+    # 1 list cho toàn bộ folder con, 150 folder thiếu -> 2 batch (tối đa 100 request mỗi batch)
+    assert drive.calls['list'] == 1
+    assert drive.calls['batch'] == 2
+    assert drive.calls['create'] == 304
+    uploaded = drive.uploaded()
+    assert all(uploaded[f"{product}_{i}.jpg"] == product for product in products for i in range(2))
+    # Folder đã có được dùng lại, không tạo trùng
+    folder_ids = {item['name']: file_id for file_id, item in drive.files.items() if item['mimeType'] == DRIVE_FOLDER_MIME}
+    assert len(folder_ids) == 152
+    assert all(folder_ids[name] == folder_id for name, folder_id in existing.items())
+    # Các luồng upload dùng service riêng
+    assert drive.services > 1
+
+
+def test_list_child_folders_follows_page_tokens(monkeypatch):
+    monkeypatch.setattr(google_drive_handler, 'DRIVE_LIST_PAGE_SIZE', 2)
+    drive = FakeDrive()
+    expected = {f"F{i}": drive.add_folder(f"F{i}") for i in range(5)}
+    uploader = GoogleDriveUploader(service_factory=drive.service)
+
+    assert uploader.list_child_folders() == expected
+    assert drive.calls['list'] == 3
+
+
+def test_folder_failed_in_batch_is_created_individually():
+    drive = FakeDrive(fail_in_batch={'B'})
+    uploader = GoogleDriveUploader(service_factory=drive.service)
+
+    results = uploader.batch_upload_images(images_for(['A', 'B']))
+
+    assert results['success_count'] == 4
+    assert sorted(results['folders_created']) == ['A', 'B']
+    assert drive.uploaded()['B_0.jpg'] == 'B'
+
+
+def test_folder_that_cannot_be_created_fails_its_group():
+    drive = FakeDrive(fail_in_batch={'B'}, fail_create={'B'})
+    uploader = GoogleDriveUploader(service_factory=drive.service)
+
+    results = uploader.batch_upload_images(images_for(['A', 'B', 'C']))
+
+    assert results['success_count'] == 4
+    assert results['failed_count'] == 2
+    assert results['folders_created'] == ['A', 'C']
+    assert {failed['filename'] for failed in results['failed_files']} == {'B_0.jpg', 'B_1.jpg'}
+    assert all(failed['error'] == 'Folder creation failed' and failed['product'] == 'B'
+               for failed in results['failed_files'])
+    # Ảnh của nhóm lỗi không bị upload vào root
+    assert 'B_0.jpg' not in drive.uploaded()
@@ -0,0 +1,105 @@
+"""HttpFetcher với HTTP server local (http.server trong thread): retry 503, giới hạn dung lượng, giới hạn đồng thời"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from http_fetcher import HttpFetcher, FetchTooLargeError
+
+IMAGE_BYTES = b'\xff\xd8' + b'x' * 2048
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    /flaky: 503 cho 2 request đầu rồi 200, /large: khai báo Content-Length lớn,
+    /stream: không có Content-Length (đọc tới khi đóng kết nối), /slow: 200 sau SLOW_SECONDS
+    """
+    SLOW_SECONDS = 0.2
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_length=True):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        if content_length:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            hits = server.hits[self.path]
+
+        if self.path == '/flaky' and hits <= 2:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/large':
+            self.send_body(b'x' * 10000)
+        elif self.path == '/stream':
+            self.close_connection = True
+            self.send_body(b'x' * 10000, content_length=False)
+        elif self.path == '/slow':
+            with server.lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            time.sleep(self.SLOW_SECONDS)
+            with server.lock:
+                server.active -= 1
+            self.send_body(IMAGE_BYTES)
+        else:
+            self.send_body(IMAGE_BYTES)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    httpd.lock = threading.Lock()
+    httpd.hits = {}
+    httpd.active = 0
+    httpd.max_active = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_returns_content_and_type(server):
+    fetcher = HttpFetcher()
+    assert fetcher.fetch(f"{server.base_url}/image.jpg") == (IMAGE_BYTES, 'image/jpeg')
+    fetcher.close()
+
+
+def test_retries_503_then_succeeds(server):
+    fetcher = HttpFetcher(retries=3, backoff=0)
+    content, _ = fetcher.fetch(f"{server.base_url}/flaky")
+    assert content == IMAGE_BYTES
+    assert server.hits['/flaky'] == 3
+    fetcher.close()
+
+
+@pytest.mark.parametrize('path', ['/large', '/stream'])
+def test_stops_at_max_bytes(server, path):
+    # /large bị chặn theo Content-Length, /stream bị chặn khi đọc stream vượt max_bytes
+    fetcher = HttpFetcher(max_bytes=4096)
+    with pytest.raises(FetchTooLargeError):
+        fetcher.fetch(f"{server.base_url}{path}")
+    fetcher.close()
+
+
+def test_concurrency_is_bounded(server):
+    fetcher = HttpFetcher(max_concurrency=2, pool_per_host=4)
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(executor.map(lambda _: fetcher.fetch(f"{server.base_url}/slow"), range(6)))
+
+    assert all(content == IMAGE_BYTES for content, _ in results)
+    assert server.hits['/slow'] == 6
+    assert server.max_active == 2
+    fetcher.close()
@@ -0,0 +1,23 @@
+"""Registry ảnh đã upload (mongomock): URL nguồn theo đúng nội dung của object"""
+from image_registry import find_image, register_image
+
+
+def test_same_content_accumulates_source_urls(mongo_db):
+    register_image('bucket', 'images/a.jpg', 'https://cdn.example.com/1/a.jpg', 'hash-a')
+    register_image('bucket', 'images/a.jpg', 'https://cdn.example.com/2/a.jpg', 'hash-a')
+
+    entry = find_image('bucket', source_url='https://cdn.example.com/1/a.jpg')
+    assert entry['key'] == 'images/a.jpg'
+    assert entry['source_urls'] == ['https://cdn.example.com/1/a.jpg', 'https://cdn.example.com/2/a.jpg']
+
+
+def test_overwritten_key_drops_old_source_urls(mongo_db):
+    register_image('bucket', 'images/a.jpg', 'https://cdn.example.com/old/a.jpg', 'hash-old')
+    register_image('bucket', 'images/a.jpg', 'https://cdn.example.com/new/a.jpg', 'hash-new')
+
+    # URL cũ không còn khớp object đã bị ghi đè bằng ảnh khác
+    assert find_image('bucket', source_url='https://cdn.example.com/old/a.jpg') is None
+    entry = find_image('bucket', source_url='https://cdn.example.com/new/a.jpg')
+    assert entry['content_hash'] == 'hash-new'
+    assert entry['source_urls'] == ['https://cdn.example.com/new/a.jpg']
+    assert find_image('bucket', content_digest='hash-old') is None
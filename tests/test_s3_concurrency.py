@@ -0,0 +1,48 @@
+"""Nhiều batch upload chạy đồng thời trên cùng uploader, mỗi batch vào đúng folder của nó (moto)"""
+import threading
+
+import aws_s3_handler
+
+FOLDERS = ['shop_a', 'shop_b', 'shop_c', 'shop_d']
+IMAGES_PER_BATCH = 15
+
+
+def test_concurrent_batches_upload_into_their_own_folders(s3, uploader):
+    default_folder = aws_s3_handler.FOLDER_NAME
+    results = {}
+    errors = []
+    start = threading.Barrier(len(FOLDERS))
+
+    def run(folder):
+        # Cùng tên file ở mọi folder: key chỉ khác nhau ở folder
+        products = [{'url': f"https://cdn.example.com/{folder}/img_{i}.jpg"} for i in range(IMAGES_PER_BATCH)]
+        try:
+            start.wait()
+            results[folder] = uploader.batch_upload_images(products, folder_name=folder)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(folder,)) for folder in FOLDERS]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    keys = [
+        obj['Key']
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=aws_s3_handler.BUCKET_NAME)
+        for obj in page.get('Contents', [])
+    ]
+    for folder in FOLDERS:
+        result = results[folder]
+        assert result['success_count'] == IMAGES_PER_BATCH
+        assert result['folders_created'] == [folder]
+        assert all(f"/{folder}/" in url for url in result['uploaded_files'])
+        assert sorted(key for key in keys if key.startswith(f"{folder}/")) == sorted(
+            f"{folder}/img_{i}.jpg" for i in range(IMAGES_PER_BATCH)
+        )
+    # Không có key nào ngoài các folder của batch, folder mặc định không bị đổi
+    assert len(keys) == len(FOLDERS) * IMAGES_PER_BATCH
+    assert aws_s3_handler.FOLDER_NAME == default_folder
+    assert uploader.FOLDER_NAME == default_folder
@@ -0,0 +1,67 @@
+"""Index object S3 trong MongoDB: list có phân trang và sync incremental (moto + mongomock)"""
+import aws_s3_handler
+from conftest import ListCallRecorder
+from s3_image_index import iter_s3_objects, sync_s3_prefix, list_indexed_objects
+
+BUCKET = aws_s3_handler.BUCKET_NAME
+
+
+def put_images(s3, keys):
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'image')
+
+
+def test_iter_s3_objects_follows_continuation_tokens(s3):
+    keys = [f"images/img_{i:03d}.jpg" for i in range(25)]
+    put_images(s3, keys + ['images/', 'other/img.jpg'])
+    recorder = ListCallRecorder(s3)
+
+    listed = [obj['Key'] for obj in iter_s3_objects(recorder, BUCKET, 'images/', page_size=10)]
+
+    # Bỏ "folder" images/ và key ngoài prefix, đủ key theo thứ tự qua 3 trang
+    assert listed == keys
+    assert len(recorder.list_calls) == 3
+    assert 'ContinuationToken' not in recorder.list_calls[0]
+    assert all('ContinuationToken' in params for params in recorder.list_calls[1:])
+
+
+def test_iter_s3_objects_start_after(s3):
+    keys = [f"images/img_{i:03d}.jpg" for i in range(12)]
+    put_images(s3, keys)
+    recorder = ListCallRecorder(s3)
+
+    listed = [obj['Key'] for obj in iter_s3_objects(recorder, BUCKET, 'images/', start_after=keys[4], page_size=5)]
+
+    assert listed == keys[5:]
+    assert recorder.list_calls[0]['StartAfter'] == keys[4]
+    # Trang sau chỉ dùng ContinuationToken
+    assert all('StartAfter' not in params for params in recorder.list_calls[1:])
+
+
+def test_sync_is_incremental_after_first_full_sync(s3, mongo_db):
+    first = [f"images/a_{i:02d}.jpg" for i in range(5)]
+    put_images(s3, first)
+
+    result = sync_s3_prefix(s3, BUCKET, 'images/')
+    assert result == {'listed': 5, 'removed': 0, 'full': True}
+
+    later = [f"images/b_{i:02d}.jpg" for i in range(3)]
+    put_images(s3, later)
+    recorder = ListCallRecorder(s3)
+
+    result = sync_s3_prefix(recorder, BUCKET, 'images/')
+    assert result == {'listed': 3, 'removed': 0, 'full': False}
+    assert recorder.list_calls[0]['StartAfter'] == first[-1]
+    assert list_indexed_objects(s3, BUCKET, 'images/', refresh=False) == first + later
+
+
+def test_full_sync_removes_deleted_objects(s3, mongo_db):
+    keys = [f"images/img_{i:02d}.jpg" for i in range(4)]
+    put_images(s3, keys)
+    sync_s3_prefix(s3, BUCKET, 'images/')
+
+    s3.delete_object(Bucket=BUCKET, Key=keys[1])
+    result = sync_s3_prefix(s3, BUCKET, 'images/', full=True)
+
+    assert result == {'listed': 3, 'removed': 1, 'full': True}
+    assert list_indexed_objects(s3, BUCKET, 'images/', refresh=False) == [keys[0], keys[2], keys[3]]
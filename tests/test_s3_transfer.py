@@ -0,0 +1,54 @@
+"""Upload S3 (moto): thống kê transfer_metrics cho batch, multipart và lỗi theo mã"""
+import io
+
+import aws_s3_handler
+from aws_s3_handler import TransferMetrics
+
+
+def test_batch_upload_reports_transfer_metrics(s3, uploader):
+    products = [{'url': f"https://cdn.example.com/img_{i}.jpg"} for i in range(8)]
+
+    results = uploader.batch_upload_images(products, folder_name='metrics_batch')
+
+    assert results['success_count'] == 8
+    assert results['failed_count'] == 0
+    transfer = results['transfer_metrics']
+    assert transfer['objects'] == 8
+    assert transfer['failed'] == 0
+    assert transfer['errors'] == {}
+    assert transfer['bytes'] > 0
+    assert transfer['p95_latency_ms'] is not None
+    assert transfer['p50_latency_ms'] <= transfer['p95_latency_ms']
+
+
+def test_large_upload_uses_multipart(s3, uploader):
+    size = 12 * 1024 * 1024
+    metrics = TransferMetrics()
+
+    url = uploader.upload_to_s3('large.bin', io.BytesIO(bytes(size)), 'application/octet-stream',
+                                metrics=metrics, folder='multipart')
+
+    assert url.endswith('/multipart/large.bin')
+    head = s3.head_object(Bucket=aws_s3_handler.BUCKET_NAME, Key='multipart/large.bin')
+    assert head['ContentLength'] == size
+    # ETag của object multipart có dạng "<md5>-<số part>"
+    assert '-' in head['ETag']
+    snapshot = metrics.snapshot()
+    assert snapshot['objects'] == 1
+    assert snapshot['bytes'] == size
+    assert snapshot['failed'] == 0
+    assert snapshot['p95_latency_ms'] is not None
+
+
+def test_upload_errors_are_counted_by_code(s3, uploader, monkeypatch):
+    monkeypatch.setattr(aws_s3_handler, 'BUCKET_NAME', 'bucket-does-not-exist')
+    metrics = TransferMetrics()
+
+    url = uploader.upload_to_s3('missing.jpg', io.BytesIO(b'image'), 'image/jpeg', metrics=metrics, folder='errors')
+
+    assert url is None
+    snapshot = metrics.snapshot()
+    assert snapshot['objects'] == 0
+    assert snapshot['failed'] == 1
+    assert snapshot['errors'] == {'NoSuchBucket': 1}
+    assert snapshot['p95_latency_ms'] is None
@@ -6,11 +6,14 @@ from selenium.webdriver.common.keys import Keys
 import re
 import logging
 import pandas as pd
-from pymongo import MongoClient
 import dotenv
 import os
+import secrets
+import string
 from bson import ObjectId
 from datetime import datetime
+from cache import notify_collection_write
+from config import get_database
 
 # Cấu hình logging
 logging.basicConfig(
@@ -195,6 +198,110 @@ def extract_options(driver, link):
     return options
 
 
+def _parse_price(value):
+    """Chuyển giá (số hoặc chuỗi kiểu "$1,299.00") sang float, None nếu không đọc được"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = re.search(r"\d+(?:\.\d+)?", value.replace(",", ""))
+        if match:
+            return float(match.group())
+    return None
+
+def _offer_prices(offers):
+    # ld+json có thể để offers là dict hoặc list
+    if isinstance(offers, dict):
+        offers = [offers]
+    if not isinstance(offers, list):
+        return []
+    prices = []
+    for offer in offers:
+        if isinstance(offer, dict):
+            price = _parse_price(offer.get('price'))
+            if price is not None:
+                prices.append(price)
+    return prices
+
+def extract_price_fields(product):
+    """
+    Tính các field giá dạng số để filter/index:
+    - price_primary: giá hiển thị (offer đầu của variant đầu tiên, fallback offers của sản phẩm)
+    - price_min: giá thấp nhất trong tất cả variants và offers
+    """
+    variants = product.get('hasVariant')
+    if not isinstance(variants, list):
+        variants = []
+
+    price_primary = None
+    all_prices = []
+    for index, variant in enumerate(variants):
+        if not isinstance(variant, dict):
+            continue
+        variant_prices = _offer_prices(variant.get('offers'))
+        if index == 0 and variant_prices:
+            price_primary = variant_prices[0]
+        all_prices.extend(variant_prices)
+
+    own_prices = _offer_prices(product.get('offers'))
+    if price_primary is None and own_prices:
+        price_primary = own_prices[0]
+    all_prices.extend(own_prices)
+
+    return {
+        'price_primary': price_primary,
+        'price_min': min(all_prices) if all_prices else None
+    }
+
+def ensure_price_indexes(collection):
+    """Tạo index cho các field giá (idempotent)"""
+    collection.create_index([('price_primary', 1)], name='price_primary_1')
+    collection.create_index([('price_min', 1)], name='price_min_1')
+
+# Đánh dấu collection đã backfill giá xong (lưu trong MongoDB để còn sau khi restart)
+PRICE_BACKFILL_STATE_COLLECTION = 'price_backfill_state'
+
+def is_price_backfilled(collection):
+    """True nếu collection đã backfill price_primary/price_min xong (filter giá dùng được field số)"""
+    state = collection.database[PRICE_BACKFILL_STATE_COLLECTION].find_one({'_id': collection.name})
+    return state is not None
+
+def backfill_price_fields(collection, batch_size=500):
+    """
+    Tính price_primary/price_min cho các document cũ chưa có (crawl trước khi có field này).
+    Chạy lại an toàn vì chỉ xử lý document còn thiếu field. Xong thì ghi marker (xem is_price_backfilled).
+
+    Returns:
+        int: Số document đã cập nhật
+    """
+    from pymongo import UpdateOne
+
+    updated = 0
+    operations = []
+    cursor = collection.find(
+        {'price_primary': {'$exists': False}},
+        {'hasVariant.offers': 1, 'offers': 1}
+    )
+    for product in cursor:
+        operations.append(UpdateOne({'_id': product['_id']}, {'$set': extract_price_fields(product)}))
+        if len(operations) >= batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+
+    ensure_price_indexes(collection)
+    collection.database[PRICE_BACKFILL_STATE_COLLECTION].update_one(
+        {'_id': collection.name},
+        {'$set': {'completed_at': datetime.now(), 'updated': updated}},
+        upsert=True
+    )
+    # Luôn báo: kết quả filter giá trước đó dùng fallback offers.price
+    notify_collection_write(collection.name)
+    print(f"Backfill giá cho collection '{collection.name}': {updated} documents")
+    return updated
+
 def start_crawl(driver, collection, link, url):
     print("==> start_crawl called with link:", link)
     """
@@ -317,12 +424,15 @@ def start_crawl(driver, collection, link, url):
         json_dict['shipping_intent'] = shipping_intent
         json_dict['reseller'] = data
         json_dict.pop('review', None)
+        json_dict.update(extract_price_fields(json_dict))
         print("Saving to MongoDB:", json_dict)
-        collection.update_one(
+        result = collection.update_one(
             {"link": json_dict.get("link")},
             {"$set": json_dict},
             upsert=True
         )
+        # Chỉ document mới mới được cộng dồn vào thống kê; ghi đè document cũ -> thống kê tính lại
+        notify_collection_write(collection.name, json_dict if result.upserted_id is not None else None)
 
         print("Dữ liệu đã được lưu vào MongoDB")
         return link, "thành công", json_dict
@@ -332,7 +442,64 @@ def start_crawl(driver, collection, link, url):
         logging.error(f"Đã xảy ra lỗi với {link}: %s", e)
         return link, e, None
 
-def get_products(collection_name):
+# Ảnh đầu tiên của sản phẩm: image_url -> image -> image của variant đầu tiên
+FIRST_IMAGE_EXPR = {
+    '$ifNull': ['$image_url', {'$ifNull': ['$image', {
+        '$cond': [{'$isArray': '$hasVariant'}, {'$arrayElemAt': ['$hasVariant.image', 0]}, None]
+    }]}]
+}
+# Tên sản phẩm bỏ khoảng trắng đầu/cuối (tên không phải chuỗi giữ nguyên) để gộp tên giống khi fill
+TRIMMED_NAME_EXPR = {
+    '$cond': [{'$eq': [{'$type': '$name'}, 'string']}, {'$trim': {'input': '$name'}}, '$name']
+}
+PRODUCT_CURSOR_BATCH_SIZE = 1000
+
+
+def iter_products(collection_name, unique_names=False, limit=None, batch_size=PRODUCT_CURSOR_BATCH_SIZE, match=None):
+    """
+    Duyệt sản phẩm của collection theo cursor (không load cả collection vào memory)
+    
+    Args:
+        collection_name (str): Tên collection MongoDB
+        unique_names (bool): Gộp các sản phẩm trùng tên (đã bỏ khoảng trắng đầu/cuối) ở phía MongoDB ($group),
+            giữ sản phẩm đầu tiên
+        limit (int, optional): Số sản phẩm tối đa (đẩy xuống MongoDB)
+        batch_size (int): Số document mỗi lần lấy từ server
+        match (dict, optional): Điều kiện lọc sản phẩm ($match, áp dụng trước khi gộp tên)
+    
+    Yields:
+        dict: {'_id', 'name', 'image'} - image là ảnh đầu tiên (có thể None)
+    """
+    db = get_database()
+    if not db.list_collection_names(filter={'name': collection_name}):
+        print(f"Collection '{collection_name}' không tồn tại trong database '{db.name}'")
+        return
+
+    pipeline = [{'$match': match}] if match else []
+    if unique_names:
+        # Sort theo _id để $first lấy sản phẩm được thêm vào sớm nhất (giống thứ tự find())
+        pipeline += [
+            {'$match': {'name': {'$nin': [None, '']}}},
+            {'$sort': {'_id': 1}},
+            {'$group': {'_id': TRIMMED_NAME_EXPR, 'product_id': {'$first': '$_id'}, 'image': {'$first': FIRST_IMAGE_EXPR}}},
+            {'$match': {'_id': {'$ne': ''}}},
+            {'$sort': {'product_id': 1}},
+            {'$project': {'_id': '$product_id', 'name': '$_id', 'image': 1}}
+        ]
+    else:
+        pipeline.append({'$project': {'name': 1, 'image': FIRST_IMAGE_EXPR}})
+    if limit:
+        pipeline.append({'$limit': int(limit)})
+
+    cursor = db[collection_name].aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    try:
+        for product in cursor:
+            yield product
+    finally:
+        cursor.close()
+
+
+def get_products(collection_name, unique_names=False, limit=None):
     """
     Lấy danh sách sản phẩm từ MongoDB collection
     
@@ -340,52 +507,16 @@ def get_products(collection_name):
         collection_name (str): Tên collection MongoDB
     
     Returns:
-        list: Danh sách sản phẩm
+        list: Danh sách sản phẩm ({'_id', 'name', 'image'}), xem iter_products
     """
     try:
-        client = MongoClient(os.getenv("MONGO_URI"))
-        db = client['walmart']
-        collection = db[collection_name]
-        
-        # Debug info
-        print(f"Checking collection '{collection_name}' in database 'walmart'")
-        
-        # Kiểm tra collection có tồn tại không
-        if collection_name not in db.list_collection_names():
-            print(f"Collection '{collection_name}' không tồn tại trong database 'walmart'")
-            print(f"Available collections: {db.list_collection_names()}")
-            return []
-        
-        # Đếm tổng số documents
-        total_count = collection.count_documents({})
-        print(f"Collection '{collection_name}' có {total_count} documents tổng cộng")
-        
-        # Lấy tất cả sản phẩm, bao gồm fields cần thiết cho images
-        products = list(collection.find({}, {
-            'name': 1, 
-            '_id': 1,  # Cần _id cho filename 
-            'image': 1, 
-            'image_url': 1, 
-            'hasVariant': 1  # Cần hasVariant để lấy images
-        }))
-        
-        # Debug chi tiết
-        products_with_name = [p for p in products if p.get('name')]
-        print(f"Đã lấy {len(products)} documents, {len(products_with_name)} có field 'name'")
-        
-        if len(products) > 0:
-            print(f"Sample data: {products[0]}")
-        
-        print(f"Returning {len(products_with_name)} products with names")
-        return products
-        
+        return list(iter_products(collection_name, unique_names=unique_names, limit=limit))
     except Exception as e:
         print(f"Error getting products from collection '{collection_name}': {str(e)}")
         return []
 
 def get_trademark_collection():
-    client = MongoClient(os.getenv("MONGO_URI"))
-    db = client['test']
+    db = get_database('test')
     return db['trademark_ids']
 
 def generate_unique_sku():
@@ -397,8 +528,7 @@ def generate_unique_sku():
     import string
     
     try:
-        client = MongoClient(os.getenv("MONGO_URI"))
-        db = client['walmart']
+        db = get_database()
         sku_collection = db['generated_skus']  # Collection lưu SKU đã sinh
         
         # Characters để sinh SKU: chữ hoa + chữ thường + số
@@ -455,8 +585,7 @@ def mark_sku_used(sku):
     Đánh dấu SKU đã được sử dụng trong database
     """
     try:
-        client = MongoClient(os.getenv("MONGO_URI"))
-        db = client['walmart']
+        db = get_database()
         sku_collection = db['generated_skus']
         
         # Tăng used_count
@@ -476,6 +605,95 @@ def mark_sku_used(sku):
     except Exception as e:
         print(f"Error marking SKU as used: {str(e)}")
 
+SKU_LENGTH = 50
+SKU_CHARS = string.ascii_letters + string.digits  # A-Z, a-z, 0-9
+SKU_ALLOCATE_MAX_ATTEMPTS = 5
+
+_sku_index_ready = False
+
+def _random_sku():
+    return ''.join(secrets.choice(SKU_CHARS) for _ in range(SKU_LENGTH))
+
+def _ensure_sku_index(sku_collection):
+    """Unique index trên generated_skus.sku để Mongo tự phát hiện SKU trùng khi insert"""
+    global _sku_index_ready
+    if _sku_index_ready:
+        return
+    try:
+        sku_collection.create_index([('sku', 1)], unique=True, name='sku_unique')
+        _sku_index_ready = True
+    except Exception as e:
+        print(f"Không tạo được unique index cho generated_skus.sku: {e}")
+
+def allocate_skus(count, batch_id=None):
+    """
+    Sinh `count` SKU unique (50 ký tự) cho một lần fill file.
+
+    SKU được sinh trong memory rồi lưu bằng một lần insert_many(ordered=False),
+    unique index trên `sku` sẽ báo những SKU bị trùng để sinh lại riêng chúng.
+    SKU được đánh dấu đã dùng (used_count=1) ngay trong cùng lần ghi.
+
+    Returns:
+        list: Danh sách `count` SKU
+    """
+    from pymongo.errors import BulkWriteError
+
+    if count <= 0:
+        return []
+
+    pending = set()
+    while len(pending) < count:
+        pending.add(_random_sku())
+    pending = list(pending)
+    # SKU đã insert thành công (đã giữ chỗ trong generated_skus)
+    skus = []
+
+    try:
+        db = get_database()
+        sku_collection = db['generated_skus']
+        _ensure_sku_index(sku_collection)
+
+        for attempt in range(SKU_ALLOCATE_MAX_ATTEMPTS):
+            now = datetime.now()
+            docs = [{
+                'sku': sku,
+                'created_at': now,
+                'used_count': 1,
+                'last_used_at': now,
+                'batch_id': batch_id
+            } for sku in pending]
+            try:
+                sku_collection.insert_many(docs, ordered=False)
+                skus.extend(pending)
+                pending = []
+                break
+            except BulkWriteError as e:
+                write_errors = e.details.get('writeErrors', [])
+                if any(err.get('code') != 11000 for err in write_errors):
+                    raise
+                duplicated = {err['index'] for err in write_errors}
+                skus.extend(sku for index, sku in enumerate(pending) if index not in duplicated)
+                print(f"SKU collision detected (attempt {attempt + 1}): {len(duplicated)} SKU")
+                pending = [_random_sku() for _ in duplicated]
+
+        if pending:
+            raise Exception(f"Không sinh được {len(pending)} SKU unique sau {SKU_ALLOCATE_MAX_ATTEMPTS} lần thử")
+
+        print(f"Allocated {len(skus)} unique SKUs")
+        return skus
+
+    except Exception as e:
+        print(f"Error allocating SKUs: {str(e)}")
+        # Emergency fallback: giữ các SKU đã insert, phần còn thiếu là SKU ngẫu nhiên 50 ký tự mới
+        # (không dùng lại pending vì có thể vừa bị báo trùng), xác suất trùng không đáng kể
+        allocated = set(skus)
+        while len(skus) < count:
+            sku = _random_sku()
+            if sku not in allocated:
+                allocated.add(sku)
+                skus.append(sku)
+        return skus
+
 def generate_batch_id():
     """
     Tạo Batch ID 5 ký tự unique cho mỗi lần fill file
@@ -485,8 +703,7 @@ def generate_batch_id():
     import string
     
     try:
-        client = MongoClient(os.getenv("MONGO_URI"))
-        db = client['walmart']
+        db = get_database()
         batch_collection = db['batch_ids']  # Collection lưu Batch ID đã sinh
         
         # Characters để sinh Batch ID: chữ hoa + số
@@ -544,8 +761,7 @@ def mark_batch_used(batch_id, rows_filled):
     Đánh dấu Batch ID đã được sử dụng và cập nhật thống kê
     """
     try:
-        client = MongoClient(os.getenv("MONGO_URI"))
-        db = client['walmart']
+        db = get_database()
         batch_collection = db['batch_ids']
         
         # Tăng used_count và file_count